@@ -0,0 +1,170 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import order
+import ordertask
+from storage import Cursor, Storage
+
+
+
+TableSpec = Tuple[str, str, str] #table, archive table, condition for archiving a row
+
+#Value of PRAGMA auto_vacuum:
+AUTO_VACUUM_INCREMENTAL = 2 #type: int
+
+
+def getTableSpecs() -> List[TableSpec]:
+	'''
+	Returns the archived tables, in the order in which they must be
+	archived: transactions first, so their orders are no longer referenced.
+	'''
+	finishedTransaction = '`status` IN (%d, %d)' % \
+		(ordertask.TX_STATUS_FINISHED, ordertask.TX_STATUS_CANCELED) #type: str
+	finishedOrder = \
+		'`status` IN ({completed}, {canceled}) AND NOT EXISTS ' \
+		'(SELECT 1 FROM `{t}` WHERE `{t}`.`{c}` = `{o}`.`ID`)'
+	completed = order.ORDER_STATUS_COMPLETED #type: int
+	canceled = order.ORDER_STATUS_CANCELED #type: int
+
+	return \
+	[
+	('buyTransactions' , 'archivedBuyTransactions' , finishedTransaction),
+	('sellTransactions', 'archivedSellTransactions', finishedTransaction),
+	('buyOrders' , 'archivedBuyOrders' , finishedOrder.format(
+		completed=completed, canceled=canceled, t='buyTransactions' , c='buyOrder' , o='buyOrders' )),
+	('sellOrders', 'archivedSellOrders', finishedOrder.format(
+		completed=completed, canceled=canceled, t='sellTransactions', c='sellOrder', o='sellOrders')),
+	]
+
+
+
+class Archiver:
+	'''
+	Periodically moves finished transactions, and finished orders without
+	unfinished transactions, to archive tables in the same database.
+	This keeps the tables that are used for trading small, while history
+	remains queryable.
+
+	Rows are moved in small batches, each in its own database transaction,
+	and other tasks get to run between batches. Afterwards, the freed
+	pages are returned to the file system with an incremental vacuum.
+	Databases that were created without incremental vacuum are converted
+	the first time rows are archived.
+
+	The row with the highest ID of a table is never archived: SQLite gives
+	new rows an ID above the highest existing one, so this prevents
+	IDs of archived rows from being re-used.
+	'''
+
+	def __init__(self,
+		storage: Storage,
+		interval: float = 3600.0,
+		batchSize: int = 100,
+		vacuumPages: int = 1000,
+		) -> None:
+
+		self.storage = storage #type: Storage
+		self.interval = interval #type: float
+		self.batchSize = batchSize #type: int
+		self.vacuumPages = vacuumPages #type: int
+
+		self.task = None #type: Optional[asyncio.Future]
+
+
+	def startup(self) -> None:
+		self.task = asyncio.ensure_future(self.run()) #type: ignore #mypy has weird ideas about ensure_future
+
+
+	async def shutdown(self) -> None:
+		if self.task is not None:
+			self.task.cancel()
+			await asyncio.wait([self.task])
+			self.task = None
+
+
+	async def run(self) -> None:
+		try:
+			while True:
+				try:
+					await self.archiveAll()
+				except asyncio.CancelledError:
+					raise
+				except:
+					logging.exception('Exception while archiving:')
+				await asyncio.sleep(self.interval)
+		except asyncio.CancelledError:
+			pass #We're cancelled, so just quit the function
+
+
+	async def archiveAll(self) -> int:
+		'Archives all rows that can be archived, and returns their number.'
+		total = 0 #type: int
+		for table, archiveTable, condition in getTableSpecs():
+			while True:
+				count = await self.archiveBatch(table, archiveTable, condition) #type: int
+				if count == 0:
+					break
+				total += count
+
+		if total > 0:
+			logging.info('Archived %d rows' % total)
+			await self.enableIncrementalVacuum()
+			#PRAGMA doesn't support parameters:
+			self.storage.execute('PRAGMA incremental_vacuum(%d)' % self.vacuumPages)
+			await self.storage.flush()
+
+		return total
+
+
+	async def enableIncrementalVacuum(self) -> None:
+		cursor = self.storage.executeRead('PRAGMA auto_vacuum') #type: Cursor
+		if cursor.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+			return
+
+		#Changing auto_vacuum only takes effect after a full vacuum.
+		#This is a one-time cost.
+		logging.warning(
+			'Converting the database to incremental vacuum. '
+			'This rewrites the entire database file, and delays all other '
+			'database writes until it is finished.')
+		self.storage.execute('PRAGMA auto_vacuum = INCREMENTAL')
+		self.storage.execute('VACUUM')
+		await self.storage.flush()
+		logging.info('Finished converting the database to incremental vacuum')
+
+
+	async def archiveBatch(self, table: str, archiveTable: str, condition: str) -> int:
+		#Both statements select the same rows, since the first one doesn't
+		#change table.
+		selection = \
+			'SELECT `ID` FROM `{t}` WHERE {condition} AND `ID` < (SELECT MAX(`ID`) FROM `{t}`) ORDER BY `ID` LIMIT ?'.format(
+			t=table, condition=condition) #type: str
+		with self.storage.transaction():
+			cursor = self.storage.execute(
+				'INSERT INTO `%s` SELECT * FROM `%s` WHERE `ID` IN (%s)' % (archiveTable, table, selection),
+				[self.batchSize]) #type: Cursor
+			self.storage.execute(
+				'DELETE FROM `%s` WHERE `ID` IN (%s)' % (table, selection),
+				[self.batchSize])
+
+		#Lets other tasks run, without blocking on the writer thread:
+		await self.storage.flush()
+		return cursor.rowcount
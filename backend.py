@@ -24,10 +24,14 @@ from bl4p_api import offer
 if TYPE_CHECKING:
 	import bl4p_plugin #pragma: nocover
 
+import archiver
 import configuration
 import messages
+import metrics
+import offersearch
 import order
 from order import BuyOrder, SellOrder
+import orderscheduler
 import ordertask
 import settings
 from simplestruct import Struct
@@ -76,24 +80,64 @@ class Backend(messages.Handler):
 
 		self.client = client #type: bl4p_plugin.BL4PClient
 		self.orderTasks = {} #type: Dict[int, ordertask.OrderTask] #localID -> OrderTask
+		self.orderScheduler = orderscheduler.OrderScheduler() #type: orderscheduler.OrderScheduler
+		self.offerSearchScheduler = offersearch.OfferSearchScheduler(self.orderScheduler) #type: offersearch.OfferSearchScheduler
 
 
 	def startup(self, DBFile: str) -> None:
-		self.storage = storage.Storage(DBFile) #type: storage.Storage
+		self.storage = storage.AsyncStorage(DBFile) #type: storage.Storage
 		self.configuration = configuration.Configuration(self.storage) #type: configuration.Configuration
+		self.archiver = archiver.Archiver(self.storage) #type: archiver.Archiver
+		self.archiver.startup()
 
 		#Loading existing orders and initializing order tasks:
-		def loadOrders(tableName: str, orderClass: Type[Union[SellOrder, BuyOrder]], address: str) -> None:
-			query = 'SELECT `ID` FROM `%s` WHERE `status` = %d OR `status` = %d' % \
-				(tableName, order.ORDER_STATUS_ACTIVE, order.ORDER_STATUS_CANCEL_REQUESTED) #type: str
-			cursor = self.storage.execute(query) #type: storage.Cursor
-			for row in cursor:
-				ID = row[0] #type: int
-				orderObj = orderClass(self.storage, ID, address) #type: Union[SellOrder, BuyOrder]
-				self.addOrder(orderObj)
-
-		loadOrders('sellOrders', SellOrder, self.BL4PAddress)
-		loadOrders('buyOrders' , BuyOrder , self.LNAddress  )
+		self.loadOrders('sellOrders', SellOrder, self.BL4PAddress, 'sellTransactions', ordertask.SellTransaction, 'sellOrder')
+		self.loadOrders('buyOrders' , BuyOrder , self.LNAddress  , 'buyTransactions' , ordertask.BuyTransaction , 'buyOrder' )
+
+
+	def loadOrders(self,
+		orderTable: str, orderClass: Type[Union[SellOrder, BuyOrder]], address: str,
+		transactionTable: str, transactionClass: Type[Union[ordertask.SellTransaction, ordertask.BuyTransaction]], orderColumn: str,
+		) -> None:
+		'''
+		Loads all unfinished orders of one type, together with their unfinished
+		transactions and the counter offers of those, and starts trading them.
+		The number of queries doesn't depend on the number of orders.
+		'''
+
+		condition = \
+			'(`{o}`.`status` = {active} OR `{o}`.`status` = {cancelRequested})'.format(
+			o=orderTable,
+			active=order.ORDER_STATUS_ACTIVE,
+			cancelRequested=order.ORDER_STATUS_CANCEL_REQUESTED,
+			) #type: str
+		transactionJoin = \
+			'JOIN `{o}` ON `{t}`.`{c}` = `{o}`.`ID` WHERE {condition} AND `{t}`.`status` != {finished} AND `{t}`.`status` != {canceled}'.format(
+			o=orderTable, t=transactionTable, c=orderColumn,
+			condition=condition,
+			finished=ordertask.TX_STATUS_FINISHED,
+			canceled=ordertask.TX_STATUS_CANCELED,
+			) #type: str
+
+		transactions = {} #type: Dict[int, List[storage.StoredObject]] #order ID -> transactions
+		query = 'SELECT `%s`.* FROM `%s` %s' % \
+			(transactionTable, transactionTable, transactionJoin) #type: str
+		for values in storage.StoredObject.loadStoredObjects(self.storage, query):
+			transactions.setdefault(values[orderColumn], []).append(
+				transactionClass(self.storage, values['ID'], values))
+
+		counterOffers = {} #type: Dict[int, offer.Offer] #counter offer ID -> counter offer
+		if transactionClass is ordertask.SellTransaction:
+			query = 'SELECT DISTINCT `counterOffers`.* FROM `counterOffers` JOIN `%s` ON `%s`.`counterOffer` = `counterOffers`.`ID` %s' % \
+				(transactionTable, transactionTable, transactionJoin)
+			for values in storage.StoredObject.loadStoredObjects(self.storage, query):
+				counterOffers[values['ID']] = \
+					ordertask.CounterOffer(self.storage, values['ID'], values).counterOffer
+
+		query = 'SELECT * FROM `%s` WHERE %s' % (orderTable, condition)
+		for values in storage.StoredObject.loadStoredObjects(self.storage, query):
+			orderObj = orderClass(self.storage, values['ID'], address, values) #type: Union[SellOrder, BuyOrder]
+			self.addOrder(orderObj, transactions.get(orderObj.ID, []), counterOffers)
 
 
 	async def shutdown(self) -> None:
@@ -102,6 +146,8 @@ class Backend(messages.Handler):
 		tasks = list(self.orderTasks.values()) #type: List[ordertask.OrderTask]
 		for task in tasks:
 			await task.shutdown()
+		await self.archiver.shutdown()
+		self.orderScheduler.shutdown()
 		self.storage.shutdown()
 
 
@@ -115,12 +161,12 @@ class Backend(messages.Handler):
 
 	@requireBL4PConnection
 	def handleBuyCommand(self, cmd: messages.BuyCommand) -> None:
-		ID = BuyOrder.create(
+		values = BuyOrder.insert(
 			self.storage,
 			limitRate = cmd.limitRate,
 			amount = cmd.amount,
-			) #type: int
-		order = BuyOrder(self.storage, ID, self.LNAddress) #type: BuyOrder
+			) #type: Dict[str, Any]
+		order = BuyOrder(self.storage, values['ID'], self.LNAddress, values) #type: BuyOrder
 		self.addOrder(order)
 
 		self.client.handleOutgoingMessage(messages.PluginCommandResult(
@@ -131,12 +177,12 @@ class Backend(messages.Handler):
 
 	@requireBL4PConnection
 	def handleSellCommand(self, cmd: messages.SellCommand) -> None:
-		ID = SellOrder.create(
+		values = SellOrder.insert(
 			self.storage,
 			limitRate = cmd.limitRate,
 			amount = cmd.amount,
-			) #type: int
-		order = SellOrder(self.storage, ID, self.BL4PAddress) #type: SellOrder
+			) #type: Dict[str, Any]
+		order = SellOrder(self.storage, values['ID'], self.BL4PAddress, values) #type: SellOrder
 		self.addOrder(order)
 
 		self.client.handleOutgoingMessage(messages.PluginCommandResult(
@@ -145,9 +191,23 @@ class Backend(messages.Handler):
 			))
 
 
-	def addOrder(self, order: Union[SellOrder, BuyOrder]) -> None:
-		self.orderTasks[order.ID] = ordertask.OrderTask(self.client, self.storage, order)
+	def addOrder(self,
+		order: Union[SellOrder, BuyOrder],
+		unfinishedTransactions: Optional[List[storage.StoredObject]] = None,
+		counterOffers: Optional[Dict[int, offer.Offer]] = None,
+		) -> None:
+
+		#By default, it's a new order, without transactions:
+		if unfinishedTransactions is None:
+			unfinishedTransactions = []
+		if counterOffers is None:
+			counterOffers = {}
+
+		self.orderTasks[order.ID] = ordertask.OrderTask(
+			self.client, self.storage, order,
+			unfinishedTransactions, counterOffers)
 		self.orderTasks[order.ID].startup()
+		metrics.registry.gauge('ordertask.active').set(len(self.orderTasks))
 
 
 	def handleListCommand(self, cmd: messages.ListCommand) -> None:
@@ -208,7 +268,7 @@ class Backend(messages.Handler):
 
 	def handleBL4PResult(self, result: messages.BL4PResult) -> None:
 		localID = result.request.localOrderID #type: int
-		self.orderTasks[localID].setCallResult(result)
+		self.handleCallResult(localID, result)
 
 
 	def handleLNIncoming(self, message: messages.LNIncoming) -> None:
@@ -225,10 +285,28 @@ class Backend(messages.Handler):
 
 	def handleLNPayResult(self, message: messages.LNPayResult) -> None:
 		localID = message.localOrderID #type: int
-		self.orderTasks[localID].setCallResult(message)
+		self.handleCallResult(localID, message)
+
+
+	def handleCallResult(self, localID: int, result: messages.AnyMessage) -> None:
+		'''
+		Handles a call result that was not routed to its caller,
+		e.g. because the call was interrupted.
+		'''
+		try:
+			task = self.orderTasks[localID] #type: ordertask.OrderTask
+		except KeyError:
+			logging.warning('Ignoring a call result for a non-existing order task: ' + str(result))
+			return
+
+		try:
+			task.setCallResult(result)
+		except ordertask.UnexpectedResult:
+			logging.exception('Ignoring an unexpected call result:')
 
 
 	def handleOrderTaskFinished(self, ID: int) -> None:
 		logging.info('Order task %d is finished, de-registering it' % ID)
 		del self.orderTasks[ID]
+		metrics.registry.gauge('ordertask.active').set(len(self.orderTasks))
 
@@ -20,7 +20,7 @@ import base64
 import hashlib
 import hmac
 import logging
-from typing import Any, Callable, Dict, Optional
+from typing import Any, Dict, List, Optional
 import websockets
 
 from .offer import Offer
@@ -33,7 +33,8 @@ class Bl4pApi:
 		#TODO (bug 21): to stop replay attacks, maybe start at a random number?
 		self.lastRequestID = 0 #type: int
 
-		self.handleResultOverride = None #type: Optional[Callable[[Any], None]]
+		#Results of these requests go to synCall instead of handleResult:
+		self.ongoingCalls = {} #type: Dict[int, asyncio.Future] #request ID -> result
 		self.receiveTask = None #type: Optional[asyncio.Future]
 		self.sendTask    = None #type: Optional[asyncio.Future]
 
@@ -75,20 +76,31 @@ class Bl4pApi:
 						break
 					result = deserialize(message) #type: Any
 					try:
-						if self.handleResultOverride is None:
+						callResult = self.ongoingCalls.pop(result.request, None) #type: Optional[asyncio.Future]
+						if callResult is None:
 							self.handleResult(result)
-						else:
-							self.handleResultOverride(result)
+						elif not callResult.done():
+							callResult.set_result(result)
 					except:
 						logging.exception('Exception when handing incoming data:')
 			except asyncio.CancelledError:
 				await self.websocket.close()
 				#We're cancelled, so just quit the function
 			except websockets.exceptions.ConnectionClosed:
-				#TODO: maybe complain in case there are ongoing calls?
 				pass #Connection closed, so just quit the function
 		except:
 			logging.exception('Exception in the receive task:')
+		finally:
+			self.failOngoingCalls()
+
+
+	def failOngoingCalls(self) -> None:
+		'Makes ongoing synCalls raise, since their results will never arrive.'
+		calls = list(self.ongoingCalls.values()) #type: List[asyncio.Future]
+		self.ongoingCalls = {}
+		for callResult in calls:
+			if not callResult.done():
+				callResult.set_exception(Exception('Connection closed during BL4P call'))
 
 
 	async def sendOutgoingData(self) -> None:
@@ -123,20 +135,19 @@ class Bl4pApi:
 
 
 	async def synCall(self, message: Any) -> Any:
+		'''
+		Sends a request and waits for its result.
+		Any number of calls can be ongoing at the same time.
+		'''
 		callResult = asyncio.Future() #type: asyncio.Future
 
+		#Note: no await between sending and registering,
+		#so the result can not arrive before we are waiting for it.
 		requestID = self.sendRequest(message) #type: int
+		self.ongoingCalls[requestID] = callResult
 
 		try:
-			def newHandleResult(message: Any) -> None:
-				assert message.request == requestID
-				callResult.set_result(message)
-
-			#Temporarily override the handleResult method to get our data:
-			self.handleResultOverride = newHandleResult
-
-			await callResult
-			return callResult.result()
+			return await callResult
 		finally:
-			self.handleResultOverride = None
+			self.ongoingCalls.pop(requestID, None)
 
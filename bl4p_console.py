@@ -82,6 +82,15 @@ def cmd_cancel():
 	return rpc.call('bl4p.cancel', {'orderID': ID})
 
 
+def cmd_stats():
+	'Show performance statistics'
+	stats = rpc.call('bl4p.stats', {})
+	for section in ['counters', 'gauges', 'histograms']:
+		print(section + ':')
+		for name, value in sorted(stats[section].items()):
+			print('  %s: %s' % (name, value))
+
+
 def cmd_login():
 	'Change BL4P login settings'
 	#TODO (bug 14): make URL configurable
@@ -155,6 +164,7 @@ commands = \
 'list'    : cmd_list,
 'cancel'  : cmd_cancel,
 'login'   : cmd_login,
+'stats'   : cmd_stats,
 }
 
 def handleCommand(cmd):
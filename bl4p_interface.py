@@ -16,8 +16,11 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+from fractions import Fraction
 import logging
-from typing import Any, Dict, Optional, TYPE_CHECKING
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, TYPE_CHECKING
 
 import secp256k1
 
@@ -30,6 +33,60 @@ if TYPE_CHECKING:
 	import bl4p_plugin #pragma: nocover
 
 import messages
+import metrics
+import order
+import orderbook
+
+
+
+QueryShape = Tuple[str, str, str, str, Tuple[Tuple[int, Tuple[int, int]], ...]]
+
+
+
+def getQueryShape(query: offer.Offer) -> QueryShape:
+	'''
+	Returns everything of a FindOffers query, except its amounts.
+	Queries with the same shape only differ in their limit rate.
+	'''
+	return \
+		(
+		query.bid.currency, query.bid.exchange,
+		query.ask.currency, query.ask.exchange,
+		tuple(sorted(query.conditions.items())),
+		)
+
+
+def isSameOffer(offer1: offer.Offer, offer2: offer.Offer) -> bool:
+	return \
+		offer1.ID         == offer2.ID and \
+		offer1.address    == offer2.address and \
+		offer1.bid        == offer2.bid and \
+		offer1.ask        == offer2.ask and \
+		offer1.conditions == offer2.conditions
+
+
+def getQueryWidth(query: offer.Offer) -> Tuple[bool, Fraction]:
+	'Queries with a larger width match more offers.'
+	if query.ask.max_amount <= 0:
+		return (True, Fraction(0)) #no limit rate
+	return (False, orderbook.getRate(query))
+
+
+
+class FindOffersRequest:
+	'''
+	A single FindOffers request to BL4P, on behalf of one or more
+	BL4PFindOffers messages with the same query shape.
+	'''
+
+	def __init__(self, shape: QueryShape) -> None:
+		self.shape = shape #type: QueryShape
+		self.messages = [] #type: List[messages.BL4PFindOffers]
+
+
+	def getWidestQuery(self) -> offer.Offer:
+		'Returns the query with the highest rate: it matches the most offers.'
+		return max((m.query for m in self.messages), key=getQueryWidth)
 
 
 
@@ -48,9 +105,20 @@ class BL4PInterface(bl4p.Bl4pApi, messages.Handler):
 			})
 		self.client = client #type: bl4p_plugin.BL4PClient
 		self.activeRequests = {} #type: Dict[int, messages.BL4PRequest]
+		self.coldStartTime = None #type: Optional[float] #seconds, measured in startupInterface
+
+		#For measuring round-trip times:
+		self.requestStartTimes = {} #type: Dict[int, Tuple[str, float]] #requestID -> (request name, perf_counter)
+
+		#FindOffers queries are coalesced:
+		self.pendingFindOffers = {} #type: Dict[QueryShape, FindOffersRequest] #not sent yet
+		self.activeFindOffers = {} #type: Dict[int, FindOffersRequest] #requestID -> request
+		self.activeFindOffersIDs = {} #type: Dict[QueryShape, int] #shape -> requestID
 
 
 	async def startupInterface(self, url: str, apiKey: str, apiSecret: str, signingPrivateKey: secp256k1.PrivateKey) -> None:
+		startTime = time.monotonic() #type: float
+
 		self.key = signingPrivateKey #type: secp256k1.PrivateKey
 		await bl4p.Bl4pApi.startup(self, url, apiKey, apiSecret)
 
@@ -58,13 +126,78 @@ class BL4PInterface(bl4p.Bl4pApi, messages.Handler):
 		result = await self.synCall(bl4p_pb2.BL4P_ListOffers()) #type: bl4p_pb2.BL4P_ListOffersResult
 		#TODO: runtime check that result is actually bl4p_pb2.BL4P_ListOffersResult
 
-		#Remove them one by one.
+		#Offers that are identical to what our orders would publish are kept,
+		#so the orders don't have to re-publish them.
+		#Buy and sell orders have separate IDs, so the market is part of the key.
+		unpublishedOrders = \
+		{
+		(orderbook.getMarketKey(task.order), task.order.ID): task.order
+		for task in self.client.backend.orderTasks.values()
+		if task.order.remoteOfferID is None
+		} #type: Dict[Tuple[orderbook.MarketKey, int], order.Order]
+
+		#Remove the others, without waiting for each individual result.
 		#When appropriate, they will be re-added later.
+		calls = [] #type: List[Awaitable[Any]]
+		numKept = 0 #type: int
 		for item in result.offers:
+			existingOffer = offer.Offer.fromPB2(item.offer) #type: offer.Offer
+			key = (orderbook.getMarketKey(existingOffer), existingOffer.ID) #type: Tuple[orderbook.MarketKey, int]
+			localOrder = unpublishedOrders.get(key) #type: Optional[order.Order]
+			if localOrder is not None and isSameOffer(existingOffer, localOrder):
+				logging.info('Keeping offer that existed before startup with ID %d' % item.offerID)
+				localOrder.remoteOfferID = item.offerID
+				del unpublishedOrders[key]
+				numKept += 1
+				continue
+
 			logging.warning('Removing offer that existed before startup with ID ' + str(item.offerID))
 			request = bl4p_pb2.BL4P_RemoveOffer() #type: bl4p_pb2.BL4P_RemoveOffer
 			request.offerID = item.offerID
-			await self.synCall(request)
+			calls.append(self.synCall(request))
+		await asyncio.gather(*calls)
+
+		self.coldStartTime = time.monotonic() - startTime
+		metrics.registry.gauge('bl4p.coldStartTime').set(self.coldStartTime)
+		logging.info('BL4P interface startup took %.3f s (kept %d offers, removed %d)' % \
+			(self.coldStartTime, numKept, len(calls)))
+
+
+	def sendRequest(self, request: Any) -> int:
+		requestID = bl4p.Bl4pApi.sendRequest(self, request) #type: int
+		name = request.__class__.__name__ #type: str
+		if name.startswith('BL4P_'):
+			name = name[5:]
+		self.requestStartTimes[requestID] = (name, time.perf_counter())
+		metrics.registry.gauge('bl4p.ongoingRequests').set(len(self.requestStartTimes))
+		return requestID
+
+
+	async def synCall(self, request: Any) -> Any:
+		try:
+			result = await bl4p.Bl4pApi.synCall(self, request) #type: Any
+		except:
+			#The result will never arrive:
+			self.popRequestStartTime(request.request)
+			raise
+		self.measureRoundTrip(result)
+		return result
+
+
+	def popRequestStartTime(self, requestID: int) -> Optional[Tuple[str, float]]:
+		ret = self.requestStartTimes.pop(requestID, None) #type: Optional[Tuple[str, float]]
+		metrics.registry.gauge('bl4p.ongoingRequests').set(len(self.requestStartTimes))
+		return ret
+
+
+	def measureRoundTrip(self, result: Any) -> None:
+		requestStart = self.popRequestStartTime(result.request) #type: Optional[Tuple[str, float]]
+		if requestStart is None:
+			return
+		name, startTime = requestStart
+		metrics.registry.histogram('bl4p.' + name).add(time.perf_counter() - startTime)
+		if isinstance(result, bl4p_pb2.Error):
+			metrics.registry.counter('bl4p.errors').increment()
 
 
 	def sendStart(self, message: messages.BL4PStart) -> None:
@@ -133,13 +266,83 @@ class BL4PInterface(bl4p.Bl4pApi, messages.Handler):
 
 
 	def sendFindOffers(self, message: messages.BL4PFindOffers) -> None:
+		#Queries of the current event loop iteration are collected,
+		#so that we can send one request per query shape.
+		shape = getQueryShape(message.query) #type: QueryShape
+		try:
+			pending = self.pendingFindOffers[shape] #type: FindOffersRequest
+		except KeyError:
+			pending = self.pendingFindOffers[shape] = FindOffersRequest(shape)
+			asyncio.get_event_loop().call_soon(self.sendPendingFindOffers, shape)
+		pending.messages.append(message)
+
+
+	def sendPendingFindOffers(self, shape: QueryShape) -> None:
+		pending = self.pendingFindOffers.pop(shape) #type: FindOffersRequest
+		query = pending.getWidestQuery() #type: offer.Offer
+
+		#If an ongoing request matches at least the same offers,
+		#its result can be shared:
+		try:
+			active = self.activeFindOffers[self.activeFindOffersIDs[shape]] #type: FindOffersRequest
+			if getQueryWidth(active.getWidestQuery()) >= getQueryWidth(query):
+				active.messages += pending.messages
+				return
+		except KeyError:
+			pass
+
 		request = bl4p_pb2.BL4P_FindOffers() #type: bl4p_pb2.BL4P_FindOffers
-		request.query.CopyFrom(message.query.toPB2())
-		requestID = self.sendRequest(request)
-		self.activeRequests[requestID] = message
+		request.query.CopyFrom(query.toPB2())
+		try:
+			requestID = self.sendRequest(request) #type: int
+		except Exception:
+			#This is called by the event loop, so the senders of the
+			#messages wouldn't notice the exception:
+			logging.exception('Failed to send a FindOffers request to BL4P:')
+			for message in pending.messages:
+				self.client.handleIncomingMessage(messages.BL4PError(
+					request = message,
+					))
+			return
+		self.activeFindOffers[requestID] = pending
+		self.activeFindOffersIDs[shape] = requestID
+
+
+	def handleFindOffersResult(self, result: Any) -> None:
+		request = self.activeFindOffers.pop(result.request) #type: FindOffersRequest
+		if self.activeFindOffersIDs.get(request.shape) == result.request:
+			del self.activeFindOffersIDs[request.shape]
+
+		if isinstance(result, bl4p_pb2.BL4P_FindOffersResult):
+			offers = \
+			[
+			offer.Offer.fromPB2(offer_PB2)
+			for offer_PB2 in result.offers
+			]
+			#Each query only gets the offers that match it:
+			for message in request.messages:
+				self.client.handleIncomingMessage(messages.BL4PFindOffersResult(
+					request = message,
+					offers = [o for o in offers if o.matches(message.query)],
+					))
+		elif isinstance(result, bl4p_pb2.Error):
+			logging.error('Got BL4P error (reason = %d)' % result.reason)
+			for message in request.messages:
+				self.client.handleIncomingMessage(messages.BL4PError(
+					request = message,
+					))
+		else:
+			logging.warning('Ignoring unrecognized message type from BL4P: ' + \
+				str(result.__class__))
 
 
 	def handleResult(self, result: Any) -> None:
+		self.measureRoundTrip(result)
+
+		if result.request in self.activeFindOffers:
+			self.handleFindOffersResult(result)
+			return
+
 		request = self.activeRequests[result.request] #type: messages.BL4PRequest
 		message = None #type: Optional[messages.AnyMessage]
 
@@ -176,15 +379,6 @@ class BL4PInterface(bl4p.Bl4pApi, messages.Handler):
 			message = messages.BL4PRemoveOfferResult(
 				request = request,
 				)
-		elif isinstance(result, bl4p_pb2.BL4P_FindOffersResult):
-			message = messages.BL4PFindOffersResult(
-				request = request,
-				offers = \
-				[
-				offer.Offer.fromPB2(offer_PB2)
-				for offer_PB2 in result.offers
-				])
-
 		elif isinstance(result, bl4p_pb2.Error):
 			logging.error('Got BL4P error (reason = %d)' % result.reason)
 			message = messages.BL4PError(
@@ -89,7 +89,7 @@ class BL4PClient:
 		logging.basicConfig(
 			filename=self.pluginInterface.logFile,
 			format = '%(asctime)s %(levelname)s: %(message)s',
-			level = logging.INFO,
+			level = self.pluginInterface.logLevel,
 			)
 		logging.info('\n\n\n\nOpened the log file')
 
@@ -98,9 +98,14 @@ class BL4PClient:
 		#Using this, we can create the RPC interface and start it up.
 		#This will give us our Lightning node ID.
 		reader, writer = await asyncio.open_unix_connection(path=self.pluginInterface.RPCPath) #type: ignore #mypy bug: it doesn't know open_unix_connection
-		self.rpcInterface = rpc_interface.RPCInterface(self, reader, writer) #type: rpc_interface.RPCInterface
+		self.rpcInterface = rpc_interface.RPCInterface(self, reader, writer,
+			maxPaymentsInFlight = self.pluginInterface.maxPaymentsInFlight,
+			) #type: rpc_interface.RPCInterface
 		await self.rpcInterface.startupRPC()
 
+		#Additional connections, so that slow calls don't delay other calls:
+		await self.rpcInterface.startupPool(self.pluginInterface.RPCPath)
+
 		#We can create the BL4P interface, but we cannot start it yet.
 		#Creating it doesn't really do anything and doesn't depend on anything.
 		self.bl4pInterface = bl4p_interface.BL4PInterface(self) #type: bl4p_interface.BL4PInterface
@@ -179,13 +184,13 @@ class BL4PClient:
 
 	def handleIncomingMessage(self, message: messages.AnyMessage) -> None:
 		#Process a single incoming message:
-		logging.info('<== ' + str(message))
+		logging.info('<== %s', message) #only formatted if it is logged
 		self.messageRouter.handleMessage(message)
 
 
 	def handleOutgoingMessage(self, message: messages.AnyMessage) -> None:
 		#Process a single outgoing message:
-		logging.info('==> ' + str(message))
+		logging.info('==> %s', message) #only formatted if it is logged
 		self.messageRouter.handleMessage(message)
 
 
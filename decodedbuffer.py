@@ -15,6 +15,16 @@
 #    You should have received a copy of the GNU General Public License
 #    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
+import codecs
+
+
+
+#Consumed data is only removed from the front of the buffer if it's at least
+#this much, and at least half of the buffer:
+MIN_COMPACTION_SIZE = 64*1024 #type: int
+
+
+
 class DecodedBuffer:
 	'''
 	A buffer for a byte stream that is to interpreted as a character stream.
@@ -23,68 +33,86 @@ class DecodedBuffer:
 	These typically originate from something like a recv() on a network
 	socket.
 
-	With the get() method, you can look at the decoded characters (str) that
-	are in the buffer.
+	With the find() method, you can search for a byte sequence (e.g. a
+	message delimiter) in the buffer contents.
 
-	With the set() method, you can replace the buffer contents.
-	This is typically done to remove parsed characters, e.g.
-	buffer.set(buffer.get()[length:])
+	With the decode() method, you can take characters (str) from the start
+	of the buffer.
+	The bytes are decoded incrementally, so a character that is split over
+	two decode() calls is decoded correctly.
 
-	The implementation assumes that all character boundaries are also byte
-	boundaries.
+	Taking data from the buffer does not copy the remaining contents:
+	only the offset of the start is increased.
+	The memory of consumed data is released once it makes up at least half
+	of the buffer, so the amortized cost of removing data is constant per
+	byte.
 	'''
 
-	def __init__(self, encoding) -> None:
-		self.encoding = encoding #type: str
-		self.decoded = '' #type: str
-		self.remainder = b'' #type: bytes
+	def __init__(self, encoding: str) -> None:
+		self.buffer = bytearray() #type: bytearray
+		self.start = 0 #type: int #everything before this has been consumed
+		self.decoder = codecs.getincrementaldecoder(encoding)() #type: codecs.IncrementalDecoder
+
+
+	def __len__(self) -> int:
+		'Returns the number of bytes in the buffer.'
+		return len(self.buffer) - self.start
 
 
 	def append(self, b: bytes) -> None:
 		'Append bytes from b to the buffer.'
+		self.buffer += b
 
-		self.remainder += b
-		for i in range(len(b)):
-			pos = len(self.remainder) - i #type: int
-			firstPart = self.remainder[:pos] #type: bytes
-			try:
-				self.decoded += firstPart.decode(self.encoding)
-				self.remainder = self.remainder[pos:]
-				break
-			except:
-				continue
 
+	def find(self, sub: bytes, start: int = 0) -> int:
+		'''
+		Returns the position of sub in the buffer, searching from position
+		start, or -1 if it is not found.
+		'''
+		pos = self.buffer.find(sub, self.start + start) #type: int
+		if pos < 0:
+			return -1
+		return pos - self.start
 
-	def get(self) -> str:
-		'Get the character contents of the buffer.'
 
-		return self.decoded
+	def decode(self, length: int) -> str:
+		'''
+		Removes length bytes from the start of the buffer, and returns them
+		as characters.
+		Bytes of an incomplete character at the end are remembered, and are
+		decoded together with the following bytes in the next call.
+		'''
+		with memoryview(self.buffer) as view, view[self.start:self.start + length] as data:
+			ret = self.decoder.decode(data) #type: str
+		self.consume(length)
+		return ret
 
 
-	def set(self, s: str) -> None:
-		'Replace the character buffer with s.'
+	def consume(self, length: int) -> None:
+		'Removes length bytes from the start of the buffer.'
+		self.start += min(length, len(self))
+		if self.start >= MIN_COMPACTION_SIZE and 2 * self.start >= len(self.buffer):
+			del self.buffer[:self.start]
+			self.start = 0
 
-		self.decoded = s
+
+	def clear(self) -> None:
+		'Removes all data from the buffer.'
+		self.buffer = bytearray()
+		self.start = 0
+		self.decoder.reset()
 
 
 
 def main(): #pragma: nocover
 	b = DecodedBuffer('UTF-8')
 	b.append(b'Corn\xc3')
-	print(b.get())
-	print(b.remainder)
-	b.set(b.get()[3:])
-	print(b.get())
-	print(b.remainder)
+	print(b.decode(len(b)))
 	b.append(b'\xa9 Plooy')
-	print(b.get())
-	print(b.remainder)
-	b.set(b.get()[3:])
-	print(b.get())
-	print(b.remainder)
+	print(b.find(b' '))
+	print(b.decode(len(b)))
 
 
 
 if __name__ == "__main__":
 	main() #pragma: nocover
-
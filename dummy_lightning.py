@@ -159,6 +159,7 @@ class Node:
 		#This is for RPC calls that have started, but for which no return data
 		#has been sent yet:
 		self.ongoingRequests = {} #ID -> (interface, methodname, metadata)
+		self.ongoingRequestIndex = {} #(methodname, paymentHash) -> IDs, oldest first
 
 		#Is set to the request ID if we're inside an RPC call
 		self.currentRequestID = None
@@ -191,6 +192,8 @@ class Node:
 		await self.pluginInterface.startup({
 			'bl4p.logfile': self.bl4pLogFile,
 			'bl4p.dbfile': self.bl4pDBFile,
+			'bl4p.loglevel': 'INFO',
+			'bl4p.maxpaymentsinflight': '100',
 			})
 		self.startupFinished = True
 
@@ -209,21 +212,37 @@ class Node:
 		await self.pluginProcess.wait()
 
 
-	def findOngoingRequest(self, name, func):
+	def findOngoingRequest(self, name, paymentHash):
 		'''
 		Return the ID of an ongoing request
 		name: the name of the called function
-		func: a function evaluating the metadata of the request
+		paymentHash: the paymentHash attribute of the request
 		'''
-		for ID, value in self.ongoingRequests.items():
-			interface, methodName, metadata = value
-			if methodName == name and func(metadata):
-				return ID
-		raise IndexError()
+		try:
+			return self.ongoingRequestIndex[(name, paymentHash)][0]
+		except KeyError:
+			raise IndexError()
 
 
 	def setOngoingRequestAttribute(self, name, value):
-		self.ongoingRequests[self.currentRequestID][2][name] = value
+		interface, methodName, metadata = self.ongoingRequests[self.currentRequestID]
+		metadata[name] = value
+		if name == 'paymentHash':
+			self.ongoingRequestIndex.setdefault((methodName, value), []).append(self.currentRequestID)
+
+
+	def removeOngoingRequest(self, ID):
+		'''
+		Remove an ongoing request, and return its interface.
+		'''
+		interface, methodName, metadata = self.ongoingRequests.pop(ID)
+		if 'paymentHash' in metadata:
+			key = (methodName, metadata['paymentHash'])
+			IDs = self.ongoingRequestIndex[key]
+			IDs.remove(ID)
+			if not IDs:
+				del self.ongoingRequestIndex[key]
+		return interface
 
 
 	def sendDelayedResponse(self, ID, result):
@@ -231,8 +250,7 @@ class Node:
 		Send a response for an ongoing  request,
 		and remove the ongoing request, as it is now finished.
 		'''
-		interface = self.ongoingRequests[ID][0]
-		del self.ongoingRequests[ID]
+		interface = self.removeOngoingRequest(ID)
 		interface.sendResponse(ID, result)
 
 
@@ -241,8 +259,7 @@ class Node:
 		Send an error response for an ongoing  request,
 		and remove the ongoing request, as it is now finished.
 		'''
-		interface = self.ongoingRequests[ID][0]
-		del self.ongoingRequests[ID]
+		interface = self.removeOngoingRequest(ID)
 		interface.sendErrorResponse(ID, code, message)
 
 
@@ -282,7 +299,7 @@ class Node:
 			if result not in (NO_RESPONSE, DELAYED_RESPONSE):
 				interface.sendResponse(ID, result)
 			if result != DELAYED_RESPONSE and ID in self.ongoingRequests:
-				del self.ongoingRequests[ID]
+				self.removeOngoingRequest(ID)
 		finally:
 			self.currentRequestID = None
 
@@ -409,7 +426,7 @@ class Node:
 
 	def finishOutgoingTransaction(self, paymentHash, paymentResult):
 		try:
-			ID = self.findOngoingRequest('waitsendpay', lambda x: x['paymentHash'] == paymentHash)
+			ID = self.findOngoingRequest('waitsendpay', paymentHash)
 		except IndexError:
 			#waitsendpay was not yet called - store results for
 			#whenever it does get called
@@ -17,9 +17,10 @@
 #    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+from collections import deque
 import json
 import logging
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 import decodedbuffer
 
@@ -28,6 +29,11 @@ import decodedbuffer
 #DoS prevention measure:
 MAX_BUFFER_LENGTH = 1024*1024 #type: int
 
+#lightningd terminates every JSON message with this:
+FRAME_DELIMITER = b'\n\n' #type: bytes
+
+READ_SIZE = 64*1024 #type: int
+
 
 
 class JSONRPC:
@@ -39,6 +45,9 @@ class JSONRPC:
 		self.outputStream = outputStream #type: asyncio.StreamWriter
 
 		self.inputBuffer = decodedbuffer.DecodedBuffer('UTF-8') #type: decodedbuffer.DecodedBuffer
+		self.scanPosition = 0 #type: int #inputBuffer has no frame delimiter before this position
+		self.incompleteFrame = None #type: Optional[str] #decoded data that turned out to be incomplete JSON
+		self.parsedMessages = deque() #type: Deque[Dict[str, Any]]
 		self.outgoingRequestID = 0 #type: int
 		self.decoder = json.JSONDecoder() #type: json.JSONDecoder
 
@@ -73,25 +82,80 @@ class JSONRPC:
 
 
 	async def getNextJSON(self) -> Optional[Dict[str, Any]]:
-		while True:
-			try:
-				request, length = self.decoder.raw_decode(self.inputBuffer.get()) #Tuple[Dict, int]
-				assert type(request) == dict #TODO: unit test
-			except ValueError:
-				#probably the buffer is incomplete
-				newData = await self.inputStream.read(1024) #type: bytes
-				if not newData: #EOF
-					return None
-				self.inputBuffer.append(newData)
-				if len(self.inputBuffer.get()) > MAX_BUFFER_LENGTH:
-					logging.error('JSON RPC error: maximum buffer length exceeded. We\'re probably not receiving valid JSON.')
-					self.inputBuffer = decodedbuffer.DecodedBuffer('UTF-8') #replace with empty buffer
-					raise Exception('Maximum receive buffer length exceeded - throwing away data')
+		'''
+		Returns the next incoming JSON message, or None on EOF.
+
+		Incoming bytes are split into frames on FRAME_DELIMITER, and only
+		complete frames are decoded.
+		New data is only searched for the delimiter once, and is taken from
+		the buffer without copying the remaining data, so the cost of
+		receiving a large message is linear in its size.
+		'''
+		while not self.parsedMessages:
+			frameEnd = self.inputBuffer.find(FRAME_DELIMITER, self.scanPosition) #type: int
+			if frameEnd >= 0:
+				frame = self.inputBuffer.decode(frameEnd) #type: str
+				self.inputBuffer.consume(len(FRAME_DELIMITER))
+				self.scanPosition = 0
+				if self.incompleteFrame is not None:
+					frame = self.incompleteFrame + FRAME_DELIMITER.decode() + frame
+					self.incompleteFrame = None
+				try:
+					self.decodeFrame(frame)
+				except ValueError:
+					#The delimiter was part of the message; continue until the next one
+					self.incompleteFrame = frame
 				continue
 
-			self.inputBuffer.set(self.inputBuffer.get()[length:].lstrip())
-
-			return request
+			#No complete frame yet: don't search this data again
+			self.scanPosition = max(0, len(self.inputBuffer) - len(FRAME_DELIMITER) + 1)
+
+			newData = await self.inputStream.read(READ_SIZE) #type: bytes
+			if not newData: #EOF
+				#The peer may have omitted the delimiter after the last message:
+				frame = self.inputBuffer.decode(len(self.inputBuffer))
+				if self.incompleteFrame is not None:
+					frame = self.incompleteFrame + FRAME_DELIMITER.decode() + frame
+				self.clearInputBuffer()
+				try:
+					self.decodeFrame(frame)
+				except ValueError:
+					pass #incomplete data
+				break
+			self.inputBuffer.append(newData)
+			bufferLength = len(self.inputBuffer) #type: int
+			if self.incompleteFrame is not None:
+				bufferLength += len(self.incompleteFrame)
+			if bufferLength > MAX_BUFFER_LENGTH:
+				logging.error('JSON RPC error: maximum buffer length exceeded. We\'re probably not receiving valid JSON.')
+				self.clearInputBuffer() #throw away data
+				raise Exception('Maximum receive buffer length exceeded - throwing away data')
+
+		if not self.parsedMessages:
+			return None
+		return self.parsedMessages.popleft()
+
+
+	def clearInputBuffer(self) -> None:
+		self.inputBuffer.clear()
+		self.scanPosition = 0
+		self.incompleteFrame = None
+
+
+	def decodeFrame(self, frame: str) -> None:
+		'Decodes the JSON messages in frame; normally there is exactly one.'
+		messages = [] #type: List[Dict[str, Any]]
+		pos = 0 #type: int
+		while True:
+			#Skip whitespace:
+			while pos < len(frame) and frame[pos].isspace():
+				pos += 1
+			if pos == len(frame):
+				break
+			message, pos = self.decoder.raw_decode(frame, pos) #Tuple[Dict, int]
+			assert type(message) == dict #TODO: unit test
+			messages.append(message)
+		self.parsedMessages.extend(messages)
 
 
 	def handleJSON(self, request: Dict[str, Any]) -> None:
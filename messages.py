@@ -17,12 +17,15 @@
 #    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from typing import Callable, Dict, List, Optional, Type, Union, cast
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union, cast
 
 from simplestruct import Struct
 
 from bl4p_api import offer as _offer
 
+import metrics
+
 
 
 class PluginCommand(Struct):
@@ -179,6 +182,10 @@ class LNFail(Struct):
 	paymentHash = b'' #type: bytes
 
 
+class LNBlockAdded(Struct):
+	height = 0 #type: int
+
+
 class LNPayResult(Struct):
 	localOrderID       = 0    #type: int
 
@@ -203,6 +210,7 @@ AnyMessage = Union[
 	LNIncoming,
 	LNFinish,
 	LNFail,
+	LNBlockAdded,
 	LNPayResult,
 	]
 
@@ -235,11 +243,31 @@ AnyMessageHandler = Union[
 	Callable[[LNIncoming], None],
 	Callable[[LNFinish], None],
 	Callable[[LNFail], None],
+	Callable[[LNBlockAdded], None],
 	Callable[[LNPayResult], None],
 	]
 
 
 
+CallKey = Tuple[str, Any]
+
+
+
+def getCallKey(message: AnyMessage) -> Optional[CallKey]:
+	'''
+	Returns the key that links a call request to its result,
+	or None if message is not part of a call.
+	'''
+	if isinstance(message, BL4PRequest):
+		return ('BL4P', id(message))
+	if isinstance(message, BL4PResult):
+		return ('BL4P', id(message.request))
+	if isinstance(message, (LNPay, LNPayResult)):
+		return ('LNPay', message.paymentHash)
+	return None
+
+
+
 class NoMessageHandler(Exception):
 	pass
 
@@ -255,20 +283,53 @@ class Handler:
 
 
 	def handleMessage(self, message: AnyMessage) -> None:
-		try:
-			handler = cast(Callable[[AnyMessage], None], self.handlerMethods[message.__class__])
-		except KeyError:
+		handler = self.handlerMethods.get(message.__class__) #type: Any
+		if handler is None:
 			raise NoMessageHandler('No message handler registered for ' + str(message.__class__))
 		handler(message)
 
 
 
+#How the router treats a message class:
+DISPATCH_OTHER   = 0 #type: int
+DISPATCH_REQUEST = 1 #type: int #call request: gets an entry in the routing table
+DISPATCH_RESULT  = 2 #type: int #call result: routed to its caller if possible
+
+
+#kind, class handler, histogram of handling times:
+DispatchEntry = Tuple[int, Optional[Callable[[AnyMessage], None]], metrics.Histogram]
+
+
+
 class Router(Handler):
+	'''
+	Forwards messages to the handler of their class.
+
+	Results of calls can also be routed to the call that is waiting for
+	them: call requests that pass through the router get an entry in the
+	routing table, and the caller attaches its result handler with
+	addRoute.
+	A result that arrives before its handler is attached is kept until
+	addRoute is called.
+	Results of calls that are not in the routing table are forwarded to
+	the handler of their class.
+
+	Everything the router needs to know about a message class is looked up
+	once, and kept in a dispatch table. The router also measures how long
+	it takes to handle the messages of each class, in the
+	message.<class name> histograms.
+	'''
+
 	def __init__(self) -> None:
 		Handler.__init__(self)
 		self.messagingStarted = False #type: bool
 		self.storedMessages = [] #type: List[AnyMessage]
 
+		self.routes = {} #type: Dict[CallKey, Optional[Callable[[AnyMessage], None]]] #None: not yet attached
+		self.earlyResults = {} #type: Dict[CallKey, AnyMessage]
+
+		self.dispatchTable = {} #type: Dict[type, DispatchEntry]
+
 
 	def addHandler(self, handler: Handler) -> None:
 		for msgClass, method in handler.handlerMethods.items():
@@ -276,20 +337,90 @@ class Router(Handler):
 				raise Exception(
 					'Router: cannot have multiple handlers for a single message class')
 			self.handlerMethods[msgClass] = method
+		self.dispatchTable = {}
+
+
+	def getDispatchEntry(self, msgClass: type) -> DispatchEntry:
+		if issubclass(msgClass, (BL4PRequest, LNPay)):
+			kind = DISPATCH_REQUEST #type: int
+		elif issubclass(msgClass, (BL4PResult, LNPayResult)):
+			kind = DISPATCH_RESULT
+		else:
+			kind = DISPATCH_OTHER
+
+		handler = self.handlerMethods.get(msgClass) #type: Any
+		histogram = metrics.registry.histogram('message.' + msgClass.__name__) #type: metrics.Histogram
+		entry = (kind, handler, histogram) #type: DispatchEntry
+		self.dispatchTable[msgClass] = entry
+		return entry
+
+
+	def addRoute(self, request: AnyMessage, handler: Callable[[AnyMessage], None]) -> None:
+		'''
+		Routes the result of request to handler.
+		If the result has already arrived, it is handled immediately.
+		'''
+		key = cast(CallKey, getCallKey(request))
+		try:
+			result = self.earlyResults.pop(key) #type: AnyMessage
+		except KeyError:
+			self.routes[key] = handler
+			return
+		self.routes.pop(key, None)
+		handler(result)
+
+
+	def removeRoute(self, request: AnyMessage) -> None:
+		'''
+		Removes the routing table entry of request.
+		Results that arrive later are forwarded to the handler of their class.
+		'''
+		key = cast(CallKey, getCallKey(request))
+		self.routes.pop(key, None)
+		self.earlyResults.pop(key, None)
 
 
 	def handleMessage(self, message: AnyMessage) -> None:
 		if self.messagingStarted:
-			return Handler.handleMessage(self, message)
+			return self.dispatchMessage(message)
 
-		logging.info('Storing message because we haven\'t finished startup yet: ' + str(message.__class__))
+		logging.info('Storing message because we haven\'t finished startup yet: %s', message.__class__)
 		self.storedMessages.append(message)
 
 
+	def dispatchMessage(self, message: AnyMessage) -> None:
+		try:
+			kind, handler, histogram = self.dispatchTable[message.__class__]
+		except KeyError:
+			kind, handler, histogram = self.getDispatchEntry(message.__class__)
+
+		startTime = time.perf_counter() #type: float
+		try:
+			if kind == DISPATCH_REQUEST:
+				self.routes.setdefault(cast(CallKey, getCallKey(message)), None)
+			elif kind == DISPATCH_RESULT:
+				key = cast(CallKey, getCallKey(message))
+				if key in self.routes:
+					routedHandler = self.routes[key] #type: Optional[Callable[[AnyMessage], None]]
+					if routedHandler is None:
+						logging.info('Storing a result that arrived before its caller waits for it')
+						self.earlyResults[key] = message
+					else:
+						del self.routes[key]
+						routedHandler(message)
+					return
+
+			if handler is None:
+				raise NoMessageHandler('No message handler registered for ' + str(message.__class__))
+			handler(message)
+		finally:
+			histogram.add(time.perf_counter() - startTime)
+
+
 	def startMessaging(self) -> None:
 		self.messagingStarted = True
 		
 		for message in self.storedMessages:
-			logging.info('Handling stored message: ' + str(message.__class__))
-			Handler.handleMessage(self, message)
+			logging.info('Handling stored message: %s', message.__class__)
+			self.dispatchMessage(message)
 
@@ -0,0 +1,196 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from typing import Any, Dict, List
+
+
+
+#Number of buckets per power of two in histograms.
+#Values in the same bucket differ by at most 1 / SUB_BUCKETS (relative).
+SUB_BUCKETS = 16 #type: int
+
+#Bucket of values <= 0:
+ZERO_BUCKET = -2**31 #type: int
+
+PERCENTILES = [50, 90, 99] #type: List[int]
+
+
+
+def getBucketIndex(value: float) -> int:
+	if value <= 0.0:
+		return ZERO_BUCKET
+	mantissa, exponent = math.frexp(value) #value = mantissa * 2**exponent, 0.5 <= mantissa < 1
+	return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+
+def getBucketLimit(index: int) -> float:
+	'Returns the upper limit (exclusive) of the values in a bucket.'
+	if index == ZERO_BUCKET:
+		return 0.0
+	exponent, subBucket = divmod(index, SUB_BUCKETS)
+	return math.ldexp(0.5 + (subBucket + 1) / (2 * SUB_BUCKETS), exponent)
+
+
+
+class Counter:
+	'Number of times something happened.'
+
+	def __init__(self) -> None:
+		self.value = 0 #type: int
+
+
+	def increment(self, amount: int = 1) -> None:
+		self.value += amount
+
+
+	def getInfo(self) -> int:
+		return self.value
+
+
+
+class Gauge:
+	'Current value of something, e.g. the number of ongoing requests.'
+
+	def __init__(self) -> None:
+		self.value = 0 #type: float
+
+
+	def set(self, value: float) -> None:
+		self.value = value
+
+
+	def increment(self, amount: float = 1) -> None:
+		self.value += amount
+
+
+	def decrement(self, amount: float = 1) -> None:
+		self.value -= amount
+
+
+	def getInfo(self) -> float:
+		return self.value
+
+
+
+class Histogram:
+	'''
+	Distribution of measured values, e.g. durations in seconds.
+
+	Like in HDR histograms, buckets have a fixed relative width instead of
+	a fixed absolute width, so any range of values is covered with the same
+	relative precision. Only buckets that contain values take memory.
+	'''
+
+	def __init__(self) -> None:
+		self.buckets = {} #type: Dict[int, int] #bucket index -> count
+		self.count = 0 #type: int
+		self.total = 0.0 #type: float
+		self.min = 0.0 #type: float
+		self.max = 0.0 #type: float
+
+
+	def add(self, value: float) -> None:
+		if self.count == 0 or value < self.min:
+			self.min = value
+		if self.count == 0 or value > self.max:
+			self.max = value
+		self.count += 1
+		self.total += value
+		index = getBucketIndex(value) #type: int
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+
+
+	def getPercentile(self, percentile: float) -> float:
+		'''
+		Returns a value that is not exceeded by percentile % of the values.
+		It is at most 1 / SUB_BUCKETS (relative) larger than the exact value.
+		'''
+		if self.count == 0:
+			return 0.0
+		rank = max(1, math.ceil(self.count * percentile / 100)) #type: int
+		seen = 0 #type: int
+		for index in sorted(self.buckets.keys()):
+			seen += self.buckets[index]
+			if seen >= rank:
+				return min(getBucketLimit(index), self.max)
+		return self.max #pragma: nocover
+
+
+	def getInfo(self) -> Dict[str, Any]:
+		ret = \
+		{
+		'count': self.count,
+		'total': self.total,
+		'min'  : self.min,
+		'max'  : self.max,
+		'mean' : self.total / self.count if self.count else 0.0,
+		} #type: Dict[str, Any]
+		for p in PERCENTILES:
+			ret['p%d' % p] = self.getPercentile(p)
+		return ret
+
+
+
+class Registry:
+	'''
+	Named counters, gauges and histograms.
+	Metrics are created the first time they are used.
+	'''
+
+	def __init__(self) -> None:
+		self.counters = {} #type: Dict[str, Counter]
+		self.gauges = {} #type: Dict[str, Gauge]
+		self.histograms = {} #type: Dict[str, Histogram]
+
+
+	def counter(self, name: str) -> Counter:
+		try:
+			return self.counters[name]
+		except KeyError:
+			ret = self.counters[name] = Counter()
+			return ret
+
+
+	def gauge(self, name: str) -> Gauge:
+		try:
+			return self.gauges[name]
+		except KeyError:
+			ret = self.gauges[name] = Gauge()
+			return ret
+
+
+	def histogram(self, name: str) -> Histogram:
+		try:
+			return self.histograms[name]
+		except KeyError:
+			ret = self.histograms[name] = Histogram()
+			return ret
+
+
+	def getInfo(self) -> Dict[str, Dict[str, Any]]:
+		return \
+		{
+		'counters'  : {name: m.getInfo() for name, m in self.counters.items()},
+		'gauges'    : {name: m.getInfo() for name, m in self.gauges.items()},
+		'histograms': {name: m.getInfo() for name, m in self.histograms.items()},
+		}
+
+
+
+#The registry of this process:
+registry = Registry() #type: Registry
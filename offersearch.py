@@ -0,0 +1,111 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+from typing import Dict, FrozenSet, Tuple, TYPE_CHECKING
+
+from bl4p_api.offer import Offer
+
+if TYPE_CHECKING:
+	from orderscheduler import OrderScheduler #pragma: nocover
+
+
+
+PairKey = FrozenSet[Tuple[str, str]] #{(currency, exchange), (currency, exchange)}
+
+
+
+def getPairKey(o: Offer) -> PairKey:
+	'Returns the key of the market of o, regardless of its trading direction.'
+	return frozenset([(o.bid.currency, o.bid.exchange), (o.ask.currency, o.ask.exchange)])
+
+
+
+class SearchState:
+	def __init__(self, pairKey: PairKey, interval: float) -> None:
+		self.pairKey = pairKey #type: PairKey
+		self.interval = interval #type: float
+
+
+
+class OfferSearchScheduler:
+	'''
+	Decides when orders search for offers on BL4P.
+
+	As long as an order doesn't find any offers, the interval between its
+	searches grows exponentially, from minInterval up to maxInterval.
+	Jitter is applied to spread the searches of different orders over time.
+
+	Relevant events (like a fill, or an offer being removed) wake up the
+	orders in the market where they happened, and reset their interval.
+	The waiting itself is done by the order scheduler.
+	'''
+
+	def __init__(self,
+		orderScheduler: 'OrderScheduler',
+		minInterval: float = 1.0,
+		maxInterval: float = 30.0,
+		backoffFactor: float = 2.0,
+		jitter: float = 0.1,
+		) -> None:
+
+		self.minInterval = minInterval #type: float
+		self.maxInterval = maxInterval #type: float
+		self.backoffFactor = backoffFactor #type: float
+		self.jitter = jitter #type: float
+		self.orderScheduler = orderScheduler #type: OrderScheduler
+
+		self.searches = {} #type: Dict[int, SearchState] #local order ID -> SearchState
+
+
+	def register(self, order: Offer) -> None:
+		if order.ID not in self.searches:
+			self.searches[order.ID] = SearchState(getPairKey(order), self.minInterval)
+
+
+	def unregister(self, orderID: int) -> None:
+		try:
+			del self.searches[orderID]
+		except KeyError:
+			pass
+
+
+	def getDelay(self, state: SearchState) -> float:
+		return state.interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+
+	def getNextSearchDelay(self, orderID: int) -> float:
+		'''
+		Returns the delay until the next search of an order.
+		If nothing wakes up the order before that, the search after that one
+		is backed off.
+		'''
+		state = self.searches[orderID] #type: SearchState
+		delay = self.getDelay(state) #type: float
+		state.interval = min(state.interval * self.backoffFactor, self.maxInterval)
+		return delay
+
+
+	def reportOffersFound(self, orderID: int) -> None:
+		self.searches[orderID].interval = self.minInterval
+
+
+	def wakeMarket(self, pairKey: PairKey) -> None:
+		for orderID, state in self.searches.items():
+			if state.pairKey == pairKey:
+				state.interval = self.minInterval
+				self.orderScheduler.wake(orderID)
@@ -16,7 +16,7 @@
 #    along with BL4P client. If not, see <http://www.gnu.org/licenses/>.
 
 import decimal
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from bl4p_api import offer
 import settings
@@ -58,6 +58,7 @@ class Order(offer.Offer, StoredObject):
 	amount              stored                                      mCent                 mSatoshi
 	status              stored
 	perTxMaxAmount      = amount (for now)                          mCent                 mSatoshi
+	reservedAmount      reserved by ongoing transactions            mCent                 mSatoshi
 	limitRateInverted   determined by derived class
 	remoteOfferID       determined on publishing
 	'''
@@ -68,11 +69,12 @@ class Order(offer.Offer, StoredObject):
 	status    = None #type: int
 
 
-	def __init__(self, storage: storage.Storage, tableName: str, ID: int, limitRateInverted: int, **kwargs) -> None:
+	def __init__(self, storage: storage.Storage, tableName: str, ID: int, limitRateInverted: int, values: Optional[Dict[str, Any]] = None, **kwargs) -> None:
 		offer.Offer.__init__(self, ID=ID, **kwargs)
-		StoredObject.__init__(self, storage, tableName, ID)
+		StoredObject.__init__(self, storage, tableName, ID, values)
 
 		self.remoteOfferID = None #type: Optional[int]
+		self.reservedAmount = 0 #type: int #not stored: it is re-determined on startup
 
 		self.perTxMaxAmount = self.amount #type: int #TODO (bug 18)
 		self.limitRateInverted = limitRateInverted #type: int
@@ -121,17 +123,28 @@ class BuyOrder(Order):
 		limitRate: int, # fiat / crypto
 		amount   : int, # fiat
 		) -> int:
-		return StoredObject.createStoredObject(storage, 'buyOrders',
+		return BuyOrder.insert(storage, limitRate, amount)['ID']
+
+
+	@staticmethod
+	def insert(
+		storage: storage.Storage,
+		limitRate: int, # fiat / crypto
+		amount   : int, # fiat
+		) -> Dict[str, Any]:
+		'Like create, but returns the values of the new row.'
+		return StoredObject.insertStoredObject(storage, 'buyOrders',
 			limitRate = limitRate,
 			amount = amount,
 			status = ORDER_STATUS_ACTIVE,
 			)
 
 
-	def __init__(self, storage: storage.Storage, ID: int, LNAddress: str) -> None:
+	def __init__(self, storage: storage.Storage, ID: int, LNAddress: str, values: Optional[Dict[str, Any]] = None) -> None:
 		Order.__init__(self,
 			storage, 'buyOrders', ID,
 			limitRateInverted=False,
+			values=values,
 
 			address=LNAddress,
 
@@ -160,16 +173,27 @@ class SellOrder(Order):
 		limitRate: int, # fiat / crypto
 		amount   : int, # fiat
 		) -> int:
-		return StoredObject.createStoredObject(storage, 'sellOrders',
+		return SellOrder.insert(storage, limitRate, amount)['ID']
+
+
+	@staticmethod
+	def insert(
+		storage: storage.Storage,
+		limitRate: int, # fiat / crypto
+		amount   : int, # fiat
+		) -> Dict[str, Any]:
+		'Like create, but returns the values of the new row.'
+		return StoredObject.insertStoredObject(storage, 'sellOrders',
 			limitRate = limitRate,
 			amount = amount,
 			status = ORDER_STATUS_ACTIVE,
 			)
 
-	def __init__(self, storage: storage.Storage, ID: int, Bl4PAddress: str) -> None:
+	def __init__(self, storage: storage.Storage, ID: int, Bl4PAddress: str, values: Optional[Dict[str, Any]] = None) -> None:
 		Order.__init__(self,
 			storage, 'sellOrders', ID,
 			limitRateInverted=True,
+			values=values,
 
 			address=Bl4PAddress,
 
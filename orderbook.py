@@ -0,0 +1,136 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+from fractions import Fraction
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bl4p_api.offer import Offer
+
+
+
+MarketKey = Tuple[str, str, str, str] #bid currency, bid exchange, ask currency, ask exchange
+
+
+
+def getMarketKey(o: Offer) -> MarketKey:
+	return (o.bid.currency, o.bid.exchange, o.ask.currency, o.ask.exchange)
+
+
+def getCounterMarketKey(o: Offer) -> MarketKey:
+	'Returns the market key of offers that can match with o.'
+	return (o.ask.currency, o.ask.exchange, o.bid.currency, o.bid.exchange)
+
+
+def getRate(o: Offer) -> Fraction:
+	'''
+	Returns the exact exchange rate of an offer: what it bids per unit of
+	what it asks.
+
+	Two offers have compatible limit rates if the product of their rates is
+	at least one; this is equivalent to the check in Offer.verifyMatches.
+	'''
+	return Fraction(
+		o.bid.max_amount * o.ask.max_amount_divisor,
+		o.bid.max_amount_divisor * o.ask.max_amount
+		)
+
+
+def conditionsOverlap(offer1: Offer, offer2: Offer) -> bool:
+	for key in set(offer1.conditions.keys()) & set(offer2.conditions.keys()):
+		range1 = offer1.conditions[key] #type: Tuple[int, int]
+		range2 = offer2.conditions[key] #type: Tuple[int, int]
+		if range1[0] > range2[1] or range2[0] > range1[1]:
+			return False
+	return True
+
+
+
+class Market:
+	'''
+	The offers for a single combination of bid and ask assets,
+	sorted on their rate, best (highest) rate first.
+	'''
+
+	def __init__(self) -> None:
+		self.keys = [] #type: List[Fraction] #negated rates, in ascending order
+		self.offers = [] #type: List[Offer]
+
+
+	def add(self, o: Offer) -> None:
+		key = -getRate(o) #type: Fraction
+		index = bisect.bisect_right(self.keys, key) #type: int
+		self.keys.insert(index, key)
+		self.offers.insert(index, o)
+
+
+	def iterateFrom(self, minRate: Fraction) -> Iterator[Offer]:
+		'Iterates over offers with a rate of at least minRate, best first.'
+		end = bisect.bisect_right(self.keys, -minRate) #type: int
+		for index in range(end):
+			yield self.offers[index]
+
+
+
+class OrderBook:
+	'''
+	Local index of offers, keyed by the currencies and exchanges they
+	trade, and sorted on their exchange rate.
+
+	To find the best offer for an order, the limit rate of the order is
+	looked up with a bisection; offers that don't meet it are never looked
+	at. Only the remaining offers get their conditions checked.
+	'''
+
+	def __init__(self) -> None:
+		self.markets = {} #type: Dict[MarketKey, Market]
+
+
+	def addOffer(self, o: Offer) -> None:
+		if o.ask.max_amount <= 0 or o.bid.max_amount_divisor <= 0 or o.ask.max_amount_divisor <= 0:
+			logging.debug('Ignoring offer with a nonsensical amount: ' + str(o))
+			return
+		self.markets.setdefault(getMarketKey(o), Market()).add(o)
+
+
+	def getMatchingOffers(self, order: Offer) -> Iterator[Offer]:
+		'Iterates over offers that match order, best rate first.'
+
+		if order.bid.max_amount <= 0:
+			return
+
+		try:
+			market = self.markets[getCounterMarketKey(order)] #type: Market
+		except KeyError:
+			return
+
+		#rate(offer) * rate(order) >= 1
+		if order.ask.max_amount <= 0:
+			minRate = Fraction(0) #type: Fraction
+		else:
+			minRate = 1 / getRate(order)
+
+		for o in market.iterateFrom(minRate):
+			if conditionsOverlap(o, order):
+				yield o
+
+
+	def getBestOffer(self, order: Offer) -> Optional[Offer]:
+		for o in self.getMatchingOffers(order):
+			return o
+		return None
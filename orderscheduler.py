@@ -0,0 +1,154 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import OrderedDict
+import heapq
+import logging
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from ordertask import OrderTask #pragma: nocover
+
+
+
+class OrderScheduler:
+	'''
+	Drives idle order tasks from a single event queue and a single timer.
+
+	An order task only has an asyncio task while it is doing something.
+	When it becomes idle, it is parked here, until it is woken up: when
+	its timer expires, when something happened in its market, or when one
+	of its transactions is finished.
+
+	Memory use of a parked order is a dictionary entry, plus a heap entry
+	if it has a timer.
+	'''
+
+	def __init__(self) -> None:
+		self.parkedTasks = {} #type: Dict[int, OrderTask] #local order ID -> OrderTask
+		self.wokenTasks = OrderedDict() #type: OrderedDict[int, OrderTask] #local order ID -> OrderTask, in order of waking up
+		self.processingScheduled = False #type: bool
+
+		self.timers = [] #type: List[Tuple[float, int, int]] #heap of (deadline, sequence number, local order ID)
+		self.deadlines = {} #type: Dict[int, float] #local order ID -> deadline of its timer
+		self.timerSequence = 0 #type: int
+		self.timerHandle = None #type: Optional[asyncio.TimerHandle]
+		self.timerHandleDeadline = None #type: Optional[float]
+
+
+	def park(self, task: 'OrderTask', delay: Optional[float] = None) -> None:
+		'''
+		Parks an idle order task.
+		If delay is given, the task is woken up after delay seconds.
+		'''
+		ID = task.order.ID #type: int
+		self.parkedTasks[ID] = task
+		if delay is not None:
+			self.setTimer(ID, delay)
+
+
+	def unpark(self, ID: int) -> Optional['OrderTask']:
+		'''
+		Removes a parked order task without waking it up.
+		If it was already woken up, but its event was not handled yet,
+		the event is dropped.
+		'''
+		self.deadlines.pop(ID, None)
+		task = self.parkedTasks.pop(ID, None) #type: Optional[OrderTask]
+		if task is None:
+			task = self.wokenTasks.pop(ID, None)
+		return task
+
+
+	def isParked(self, ID: int) -> bool:
+		return ID in self.parkedTasks
+
+
+	def wake(self, ID: int) -> bool:
+		'''
+		Wakes up a parked order task.
+		Returns whether the order task was parked.
+		'''
+		self.deadlines.pop(ID, None)
+		task = self.parkedTasks.pop(ID, None) #type: Optional[OrderTask]
+		if task is None:
+			return False
+
+		self.wokenTasks[ID] = task
+		if not self.processingScheduled:
+			self.processingScheduled = True
+			asyncio.get_event_loop().call_soon(self.processEvents)
+		return True
+
+
+	def processEvents(self) -> None:
+		self.processingScheduled = False
+		#Tasks that were unparked (e.g. stopped) after waking up are no
+		#longer in wokenTasks, so they are not handled here.
+		while self.wokenTasks:
+			ID, task = self.wokenTasks.popitem(last=False)
+			try:
+				task.handleEvent()
+			except:
+				logging.exception('Exception when handling an order event:')
+
+
+	def setTimer(self, ID: int, delay: float) -> None:
+		deadline = asyncio.get_event_loop().time() + delay #type: float
+		self.deadlines[ID] = deadline
+		heapq.heappush(self.timers, (deadline, self.timerSequence, ID))
+		self.timerSequence += 1
+		self.updateTimerHandle()
+
+
+	def updateTimerHandle(self) -> None:
+		#Drop timers that were canceled or replaced:
+		while self.timers and self.deadlines.get(self.timers[0][2]) != self.timers[0][0]:
+			heapq.heappop(self.timers)
+
+		deadline = self.timers[0][0] if self.timers else None #type: Optional[float]
+		if deadline == self.timerHandleDeadline:
+			return
+
+		if self.timerHandle is not None:
+			self.timerHandle.cancel()
+			self.timerHandle = None
+		if deadline is not None:
+			self.timerHandle = asyncio.get_event_loop().call_at(deadline, self.handleTimers)
+		self.timerHandleDeadline = deadline
+
+
+	def handleTimers(self) -> None:
+		self.timerHandle = None
+		self.timerHandleDeadline = None
+
+		now = asyncio.get_event_loop().time() #type: float
+		while self.timers and self.timers[0][0] <= now:
+			deadline, sequence, ID = heapq.heappop(self.timers)
+			if self.deadlines.get(ID) == deadline:
+				self.wake(ID)
+
+		self.updateTimerHandle()
+
+
+	def shutdown(self) -> None:
+		self.wokenTasks.clear()
+		if self.timerHandle is not None:
+			self.timerHandle.cancel()
+			self.timerHandle = None
+			self.timerHandleDeadline = None
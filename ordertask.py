@@ -17,10 +17,12 @@
 #    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+from collections import OrderedDict
 import copy
 import hashlib
 import logging
-from typing import TYPE_CHECKING, cast, Any, Awaitable, Callable, Dict, List, Optional, Type, Union
+import time
+from typing import TYPE_CHECKING, cast, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type, Union
 
 from bl4p_api import offer
 from bl4p_api import offer_pb2
@@ -28,12 +30,17 @@ from bl4p_api.offer import Offer, Asset
 
 if TYPE_CHECKING:
 	import bl4p_plugin #pragma: nocover
+	from offersearch import OfferSearchScheduler #pragma: nocover
+	from orderscheduler import OrderScheduler #pragma: nocover
 
 import messages
+import metrics
+from offersearch import getPairKey
 from order import BuyOrder, SellOrder, Order
 import order
+from orderbook import OrderBook
 import settings
-from storage import StoredObject, Storage, Cursor
+from storage import getContentHash, StoredObject, Storage, Cursor
 
 
 
@@ -95,6 +102,14 @@ TX_STATUS_FINISHED          : 'finished',
 TX_STATUS_CANCELED          : 'canceled',
 }
 
+OrderStatus2str = \
+{
+order.ORDER_STATUS_ACTIVE          : 'active',
+order.ORDER_STATUS_COMPLETED       : 'completed',
+order.ORDER_STATUS_CANCEL_REQUESTED: 'cancel requested',
+order.ORDER_STATUS_CANCELED        : 'canceled',
+}
+
 
 
 class BuyTransaction(StoredObject):
@@ -112,7 +127,16 @@ class BuyTransaction(StoredObject):
 		buyOrder: int, fiatAmount: int, cryptoAmount: int, paymentHash: bytes
 		) -> int:
 
-		return StoredObject.createStoredObject(
+		return BuyTransaction.insert(storage, buyOrder, fiatAmount, cryptoAmount, paymentHash)['ID']
+
+
+	@staticmethod
+	def insert(storage: Storage,
+		buyOrder: int, fiatAmount: int, cryptoAmount: int, paymentHash: bytes
+		) -> Dict[str, Any]:
+		'Like create, but returns the values of the new row.'
+
+		return StoredObject.insertStoredObject(
 			storage, 'buyTransactions',
 
 			buyOrder = buyOrder,
@@ -127,8 +151,8 @@ class BuyTransaction(StoredObject):
 			)
 
 
-	def __init__(self, storage: Storage, ID: int) -> None:
-		StoredObject.__init__(self, storage, 'buyTransactions', ID)
+	def __init__(self, storage: Storage, ID: int, values: Optional[Dict[str, Any]] = None) -> None:
+		StoredObject.__init__(self, storage, 'buyTransactions', ID, values)
 
 
 	def getListInfo(self) -> Dict[str, Any]:
@@ -164,7 +188,18 @@ class SellTransaction(StoredObject):
 		sellOrder: int, counterOffer: int, buyerFiatAmount: int, buyerCryptoAmount: int, senderTimeoutDelta: int, lockedTimeoutDelta: int, CLTVExpiryDelta: int
 		) -> int:
 
-		return StoredObject.createStoredObject(
+		return SellTransaction.insert(storage,
+			sellOrder, counterOffer, buyerFiatAmount, buyerCryptoAmount, senderTimeoutDelta, lockedTimeoutDelta, CLTVExpiryDelta
+			)['ID']
+
+
+	@staticmethod
+	def insert(storage: Storage,
+		sellOrder: int, counterOffer: int, buyerFiatAmount: int, buyerCryptoAmount: int, senderTimeoutDelta: int, lockedTimeoutDelta: int, CLTVExpiryDelta: int
+		) -> Dict[str, Any]:
+		'Like create, but returns the values of the new row.'
+
+		return StoredObject.insertStoredObject(
 			storage, 'sellTransactions',
 
 			sellOrder  = sellOrder,
@@ -187,8 +222,8 @@ class SellTransaction(StoredObject):
 			)
 
 
-	def __init__(self, storage: Storage, ID: int) -> None:
-		StoredObject.__init__(self, storage, 'sellTransactions', ID)
+	def __init__(self, storage: Storage, ID: int, values: Optional[Dict[str, Any]] = None) -> None:
+		StoredObject.__init__(self, storage, 'sellTransactions', ID, values)
 
 
 	def getListInfo(self) -> Dict[str, Any]:
@@ -206,23 +241,89 @@ class SellTransaction(StoredObject):
 
 
 class CounterOffer(StoredObject):
+	'''
+	Counter offers are stored only once: transactions with identical
+	counter offers refer to the same record, which is found through the
+	hash of its blob.
+	'''
+
 	#This initialization is just to inform Mypy about data types.
 	#TODO: find a way to make sure Storage respects these types
 	blob = None #type: bytes
+	hash = None #type: bytes
+
+	#blob -> parsed counter offer, least recently used first.
+	#Parsed counter offers are shared, so they must not be modified.
+	parsedOffers = OrderedDict() #type: OrderedDict[bytes, Offer]
+
+	#hash -> ID of counter offers, least recently used first.
+	#Only used with storages that allocate IDs: with those, the database
+	#doesn't show stored counter offers before their transaction is committed.
+	storedIDs = OrderedDict() #type: OrderedDict[bytes, int]
 
 	@staticmethod
 	def create(storage: Storage, counterOffer: offer.Offer) -> int:
-		return StoredObject.createStoredObject(
-			storage, 'counterOffers',
-			blob = counterOffer.toPB2().SerializeToString(),
-			)
+		blob = counterOffer.toPB2().SerializeToString() #type: bytes
+		contentHash = getContentHash(blob) #type: bytes
+
+		newID = storage.allocateID('counterOffers') #type: Optional[int]
+		if newID is None:
+			#Statements are executed immediately, so the database is up to date:
+			cursor = storage.execute(
+				'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?',
+				[contentHash]) #type: Cursor
+			existing = cursor.fetchone() #type: Optional[Tuple[int]]
+			if existing is not None:
+				return existing[0]
+
+			return StoredObject.createStoredObject(
+				storage, 'counterOffers',
+				blob = blob,
+				hash = contentHash,
+				)
 
+		storedIDs = CounterOffer.storedIDs #type: OrderedDict[bytes, int]
+		try:
+			storedIDs.move_to_end(contentHash)
+			ID = storedIDs[contentHash] #type: int
+		except KeyError:
+			existing = storage.executeRead(
+				'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?',
+				[contentHash]).fetchone()
+			ID = newID if existing is None else existing[0]
+			storedIDs[contentHash] = ID
+			while len(storedIDs) > settings.counterOfferCacheSize:
+				storedIDs.popitem(last=False)
+
+		#If the transaction that stored it was rolled back, this stores it
+		#again. Allocated IDs are never re-used, so the ID is still free.
+		storage.execute(
+			'INSERT OR IGNORE INTO `counterOffers` (`ID`, `blob`, `hash`) VALUES (?,?,?)',
+			[ID, blob, contentHash])
+		return ID
+
+
+	@staticmethod
+	def parse(blob: bytes) -> Offer:
+		parsedOffers = CounterOffer.parsedOffers #type: OrderedDict[bytes, Offer]
+		try:
+			parsedOffers.move_to_end(blob)
+			return parsedOffers[blob]
+		except KeyError:
+			pass
 
-	def __init__(self, storage: Storage, ID: int) -> None:
-		StoredObject.__init__(self, storage, 'counterOffers', ID)
 		counterOffer = offer_pb2.Offer()
-		counterOffer.ParseFromString(self.blob)
-		self.counterOffer = Offer.fromPB2(counterOffer)
+		counterOffer.ParseFromString(blob)
+		ret = Offer.fromPB2(counterOffer) #type: Offer
+		parsedOffers[blob] = ret
+		while len(parsedOffers) > settings.counterOfferCacheSize:
+			parsedOffers.popitem(last=False)
+		return ret
+
+
+	def __init__(self, storage: Storage, ID: int, values: Optional[Dict[str, Any]] = None) -> None:
+		StoredObject.__init__(self, storage, 'counterOffers', ID, values)
+		self.counterOffer = CounterOffer.parse(self.blob)
 
 
 
@@ -236,22 +337,140 @@ class BL4PError(Exception):
 
 
 
-class OrderTask:
-	task = None #type: asyncio.Future
+class Caller:
+	'''
+	Base class of order tasks and transaction tasks.
+	Sends messages to the outside world, and waits for their results.
+	A caller does one call at a time.
+	'''
 
-	def __init__(self, client: 'bl4p_plugin.BL4PClient', s: Storage, o: Order) -> None:
+	def __init__(self, client: 'bl4p_plugin.BL4PClient', s: Storage) -> None:
 		self.client = client #type: bl4p_plugin.BL4PClient
 		self.storage = s #type: Storage
+		self.callLock = asyncio.Lock() #type: asyncio.Lock
+		self.callRequest = None #type: Optional[messages.AnyMessage]
 		self.callResult = None #type: Optional[asyncio.Future]
 		self.expectedCallResultType = None #type: Optional[Type]
 
+
+	def isResultOfCall(self, result: messages.AnyMessage) -> bool:
+		'Returns whether result refers to the ongoing call.'
+
+		if self.callResult is None:
+			return False
+		if isinstance(result, messages.BL4PResult) and result.request is not None:
+			return result.request is self.callRequest
+		if isinstance(result, messages.LNPayResult):
+			return isinstance(self.callRequest, messages.LNPay) and \
+				result.paymentHash == self.callRequest.paymentHash
+		return False
+
+
+	def setResultOfCall(self, result: messages.AnyMessage) -> None:
+		if self.callResult is None or self.expectedCallResultType is None:
+			raise UnexpectedResult(
+				'Received a call result while no call was going on: ' + \
+				str(result)
+				)
+		if not isinstance(result, (self.expectedCallResultType, messages.BL4PError)):
+			raise UnexpectedResult(
+				'Received a call result of unexpected type: %s: expected type %s' % \
+				(str(result), str(self.expectedCallResultType))
+				)
+		self.callResult.set_result(result)
+
+
+	async def waitForBL4PConnection(self) -> None:
+		if not self.client.isBL4PConnected():
+			logging.info('Order task: waiting for BL4P connection')
+			await self.client.waitForBL4PConnection()
+			logging.info('Order task: BL4P connection is present; continuing')
+
+
+	async def call(self, message: messages.AnyMessage, expectedResultType: Type) -> messages.AnyMessage:
+		async with self.callLock:
+			#Our state must be stored before the outside world can act on it:
+			await self.storage.flush()
+			self.callRequest = message
+			startTime = time.perf_counter() #type: float
+			try:
+				self.client.handleOutgoingMessage(message)
+				return await self.waitForIncomingMessage(expectedResultType)
+			finally:
+				self.client.messageRouter.removeRoute(message)
+				self.callRequest = None
+				metrics.registry.histogram('call.' + message.__class__.__name__).add(
+					time.perf_counter() - startTime)
+
+
+	async def waitForIncomingMessage(self, expectedResultType: Type) -> messages.AnyMessage:
+		assert self.callResult is None
+		self.callResult = asyncio.Future()
+		self.expectedCallResultType = expectedResultType
+		if self.callRequest is not None:
+			#The result is routed directly to us;
+			#this also gives us the result if it has already arrived:
+			self.client.messageRouter.addRoute(self.callRequest, self.setResultOfCall)
+		await self.callResult
+		ret = self.callResult.result() #type: messages.AnyMessage
+
+		#Special case for BL4P exceptions
+		if isinstance(ret, messages.BL4PError):
+			self.callResult = None
+			self.expectedCallResultType = None
+			raise BL4PError()
+
+		assert isinstance(ret, expectedResultType)
+		self.callResult = None
+		self.expectedCallResultType = None
+		return ret
+
+
+
+class OrderTask(Caller):
+	'''
+	Trades a single order.
+
+	Trading of the order itself happens in steps; each step runs in its own
+	asyncio task.
+	In between steps, the order is idle, and it is parked in the order
+	scheduler, which starts the next step when the order is woken up.
+	Sell orders are woken up for their next offer search; all orders are
+	woken up when one of their transactions is finished.
+
+	Every transaction runs in its own transaction task. An order can have
+	up to settings.maxTransactionsPerOrder transactions at the same time.
+	'''
+
+	task = None #type: Optional[asyncio.Future] #None while the order is idle
+
+	def __init__(self,
+		client: 'bl4p_plugin.BL4PClient', s: Storage, o: Order,
+		unfinishedTransactions: Optional[List[StoredObject]] = None,
+		counterOffers: Optional[Dict[int, offer.Offer]] = None,
+		) -> None:
+
+		Caller.__init__(self, client, s)
+
 		self.order = o #type: Order
-		self.counterOffer = None #type: Optional[offer.Offer]
-		self.transaction = None #type: Optional[Union[BuyTransaction, SellTransaction]]
+		self.transactionTasks = [] #type: List[TransactionTask]
+
+		#Data that can be loaded in bulk for many orders at once.
+		#If unfinishedTransactions is None, they are loaded by the order task.
+		self.unfinishedTransactions = unfinishedTransactions #type: Optional[List[StoredObject]]
+		self.counterOffers = {} if counterOffers is None else counterOffers #type: Dict[int, offer.Offer] #counter offer ID -> counter offer
+		self.offerLock = asyncio.Lock() #type: asyncio.Lock
+
+		self.finished = False #type: bool
+		self.finishedEvent = asyncio.Event() #type: asyncio.Event
 
 
 	def startup(self) -> None:
-		self.task = asyncio.ensure_future(self.doTrading()) #type: ignore #mypy has weird ideas about ensure_future
+		self.startStep(self.startTrading())
+
+
+	def startStep(self, step: Awaitable[Optional[float]]) -> None:
+		self.task = asyncio.ensure_future(self.doTrading(step)) #type: ignore #mypy has weird ideas about ensure_future
 
 
 	async def shutdown(self) -> None:
@@ -267,35 +486,54 @@ class OrderTask:
 		#shutdown is typically called by a task started in bl4p_plugin.py,
 		#while the RPC result is delivered by a different task started in
 		#asynclient.py.
-		self.task.cancel()
-		await self.task
+		if self.finished:
+			await self.waitFinished()
+		elif self.task is None:
+			#The order is idle
+			self.getOrderScheduler().unpark(self.order.ID)
+			await self.endTrading()
+		else:
+			self.task.cancel()
+			await self.task
 
 
 	async def waitFinished(self) -> None:
-		await self.task
+		await self.finishedEvent.wait()
 
 
 	def cancel(self) -> None:
-		if self.transaction is None:
-			self.order.update(status=order.ORDER_STATUS_CANCELED)
-			self.task.cancel()
+		if not self.transactionTasks:
+			self.updateOrderStatus(order.ORDER_STATUS_CANCELED)
+			self.stop()
 		else:
-			#TODO: cancel ongoing transaction if possible.
-			#For now, just let an ongoing transaction complete, and then cancel
+			#TODO: cancel ongoing transactions if possible.
+			#For now, just let ongoing transactions complete, and then cancel
 			#the order.
-			self.order.update(status=order.ORDER_STATUS_CANCEL_REQUESTED)
+			self.updateOrderStatus(order.ORDER_STATUS_CANCEL_REQUESTED)
+
+
+	def updateOrderStatus(self, status: int) -> None:
+		self.order.update(status=status)
+		metrics.registry.counter('order.' + OrderStatus2str[status]).increment()
+
+
+	def stop(self) -> None:
+		'Ends trading of the order as soon as possible.'
+
+		if self.finished:
+			return
+		if self.task is None:
+			#The order is idle
+			self.getOrderScheduler().unpark(self.order.ID)
+			self.task = asyncio.ensure_future(self.endTrading()) #type: ignore #mypy has weird ideas about ensure_future
+		else:
+			self.task.cancel()
 
 
 	def getListInfo(self)-> Dict[str, Any]:
 		'Return information intended for the list RPC call'
 
-		orderStatus = \
-		{
-		order.ORDER_STATUS_ACTIVE          : 'active',
-		order.ORDER_STATUS_COMPLETED       : 'completed',
-		order.ORDER_STATUS_CANCEL_REQUESTED: 'cancel requested',
-		order.ORDER_STATUS_CANCELED        : 'canceled',
-		}[self.order.status]
+		orderStatus = OrderStatus2str[self.order.status] #type: str
 
 		ret = \
 		{
@@ -305,58 +543,135 @@ class OrderTask:
 		'amount': self.order.amount,
 		}
 
-		if self.transaction is not None:
-			ret['transaction'] = self.transaction.getListInfo()
+		transactions = [
+			t.transaction.getListInfo()
+			for t in self.transactionTasks
+			if t.transaction is not None
+			] #type: List[Dict[str, Any]]
+		if transactions:
+			ret['transactions'] = transactions
 
 		return ret
 
 
+	def getOrderScheduler(self) -> 'OrderScheduler':
+		return self.client.backend.orderScheduler
+
+
 	def setCallResult(self, result: messages.AnyMessage) -> None:
-		if self.callResult is None or self.expectedCallResultType is None:
+		'Routes result to the ongoing call it belongs to.'
+
+		if isinstance(result, messages.LNIncoming):
+			self.startIncomingTransaction(result)
+			return
+
+		callers = [self] #type: List[Caller]
+		callers += self.transactionTasks
+		callers = [c for c in callers if c.callResult is not None]
+		matching = [c for c in callers if c.isResultOfCall(result)] #type: List[Caller]
+		if not matching:
+			#The result doesn't tell which call it belongs to,
+			#so it can only be given to a call that expects its type
+			matching = [
+				c for c in callers
+				if c.expectedCallResultType is not None and
+				isinstance(result, (c.expectedCallResultType, messages.BL4PError))
+				]
+			if not matching and len(callers) == 1:
+				matching = callers #Gives an error message about the type
+		if len(matching) != 1:
 			raise UnexpectedResult(
-				'Received a call result while no call was going on: ' + \
+				'Received a call result that doesn\'t match exactly one ongoing call: ' + \
 				str(result)
 				)
-		if not isinstance(result, (self.expectedCallResultType, messages.BL4PError)):
-			raise UnexpectedResult(
-				'Received a call result of unexpected type: %s: expected type %s' % \
-				(str(result), str(self.expectedCallResultType))
-				)
-		self.callResult.set_result(result)
+		matching[0].setResultOfCall(result)
 
 
-	async def waitForBL4PConnection(self) -> None:
-		if not self.client.isBL4PConnected():
-			logging.info('Order task: waiting for BL4P connection')
-			await self.client.waitForBL4PConnection()
-			logging.info('Order task: BL4P connection is present; continuing')
+	def canStartTransaction(self) -> bool:
+		return \
+			not self.finished and \
+			self.order.status == order.ORDER_STATUS_ACTIVE and \
+			self.order.amount - self.order.reservedAmount > 0 and \
+			len(self.transactionTasks) < settings.maxTransactionsPerOrder
+
 
+	def startTransaction(self, transactionTask: 'TransactionTask', step: Awaitable[None]) -> None:
+		self.transactionTasks.append(transactionTask)
+		transactionTask.task = asyncio.ensure_future(self.runTransaction(transactionTask, step)) #type: ignore #mypy has weird ideas about ensure_future
 
-	async def doTrading(self) -> None:
+
+	async def runTransaction(self, transactionTask: 'TransactionTask', step: Awaitable[None]) -> None:
 		try:
-			if isinstance(self.order, BuyOrder):
-				await self.continueBuyTransaction()
-				await self.publishOffer()
-				tradeFunction = self.waitForIncomingTransaction
-			elif isinstance(self.order, SellOrder):
-				await self.continueSellTransaction()
-				tradeFunction = self.doOfferSearch
-			else:
-				raise Exception('Unsupported order type - cannot use it in trade')
-
-			while True:
-				await tradeFunction()
-				logging.info('Remaining in order: ' + \
-					str(self.order.amount))
-
-				if self.order.status == order.ORDER_STATUS_CANCEL_REQUESTED:
-					logging.info('Order cancelation was requested - canceling it now')
-					self.order.update(status=order.ORDER_STATUS_CANCELED)
-					break
-				elif self.order.amount <= 0:
-					logging.info('Finished with order')
-					self.order.update(status=order.ORDER_STATUS_COMPLETED)
-					break
+			await step
+		except asyncio.CancelledError:
+			logging.info('Transaction task got canceled')
+			#It will be continued after a restart
+		except:
+			logging.exception('Exception in transaction task:')
+			self.stop()
+		finally:
+			transactionTask.releaseAmount()
+			self.transactionTasks.remove(transactionTask)
+
+		#The order may be finished now, or it may start new transactions:
+		if not self.finished:
+			self.getOrderScheduler().wake(self.order.ID)
+
+
+	def handleEvent(self) -> None:
+		'Called by the order scheduler when it wakes up this order.'
+
+		if self.finished:
+			return
+		self.startStep(self.continueTrading())
+
+
+	async def startTrading(self) -> Optional[float]:
+		if isinstance(self.order, BuyOrder):
+			await self.continueBuyTransactions()
+			await self.publishOffer()
+			return None
+		elif isinstance(self.order, SellOrder):
+			await self.continueSellTransactions()
+			return await self.doOfferSearch()
+		else:
+			raise Exception('Unsupported order type - cannot use it in trade')
+
+
+	async def continueTrading(self) -> Optional[float]:
+		if isinstance(self.order, SellOrder):
+			return await self.doOfferSearch()
+		return None
+
+
+	async def doTrading(self, step: Awaitable[Optional[float]]) -> None:
+		'''
+		Performs a single trading step.
+		Afterwards, the order is either finished, or it is parked until the
+		next step. The step returns the delay after which the order wants
+		to be woken up; if it returns None, it only waits for events.
+		'''
+		try:
+			startTime = time.perf_counter() #type: float
+			delay = await step #type: Optional[float]
+			metrics.registry.histogram('ordertask.step').add(time.perf_counter() - startTime)
+
+			if self.transactionTasks:
+				pass #Wait for them to finish
+			elif self.order.status == order.ORDER_STATUS_CANCEL_REQUESTED:
+				logging.info('Order cancelation was requested - canceling it now')
+				self.updateOrderStatus(order.ORDER_STATUS_CANCELED)
+				await self.endTrading()
+				return
+			elif self.order.amount <= 0:
+				logging.info('Finished with order')
+				self.updateOrderStatus(order.ORDER_STATUS_COMPLETED)
+				await self.endTrading()
+				return
+
+			self.task = None
+			self.getOrderScheduler().park(self, delay)
+			return
 
 		except asyncio.CancelledError:
 			logging.info('Order task got canceled')
@@ -364,136 +679,302 @@ class OrderTask:
 		except:
 			logging.exception('Exception in order task:')
 
-		#These could have old values from something earlier that got
-		#interrupted.
-		#Set them back to None, so that the following un-publishing call can
-		#proceed normally.
-		self.callResult = None
-		self.expectedCallResultType = None
+		await self.endTrading()
 
-		logging.info('End of order task, so removing the order from the market:')
-		await self.unpublishOffer()
 
-		self.client.backend.handleOrderTaskFinished(self.order.ID)
+	async def endTrading(self) -> None:
+		self.finished = True
+		try:
+			#Ongoing transactions are stopped here;
+			#they will be continued after a restart.
+			transactionTasks = [t.task for t in self.transactionTasks if t.task is not None] #type: List[asyncio.Future]
+			for task in transactionTasks:
+				task.cancel()
+			await asyncio.gather(*transactionTasks, return_exceptions=True)
+
+			self.client.backend.offerSearchScheduler.unregister(self.order.ID)
+
+			#These could have old values from something earlier that got
+			#interrupted.
+			#Set them back to None, so that the following un-publishing call can
+			#proceed normally.
+			self.callResult = None
+			self.expectedCallResultType = None
+
+			logging.info('End of order task, so removing the order from the market:')
+			await self.unpublishOffer()
+
+			self.client.backend.handleOrderTaskFinished(self.order.ID)
+		finally:
+			self.finishedEvent.set()
 
 
-	async def doOfferSearch(self) -> None:
+	async def doOfferSearch(self) -> Optional[float]:
 		'''
-		Keeps searching for matching offers until it finds one.
-		Then, it performs a single transaction based on the found offer.
+		Searches once for matching offers.
+		If it finds one, it starts a transaction based on it.
+		Returns the delay until the next search, as determined by the offer
+		search scheduler, or None if no transaction can be started until an
+		ongoing transaction is finished.
 		'''
 
+		if not self.canStartTransaction():
+			return None
+
 		await self.waitForBL4PConnection()
-		while True:
-			try:
-				queryResult = cast(messages.BL4PFindOffersResult,
-					await self.call(messages.BL4PFindOffers(
-						localOrderID=self.order.ID,
-
-						query=self.order
-						),
-						messages.BL4PFindOffersResult)
-					) #type: messages.BL4PFindOffersResult
-			except messages.NoMessageHandler:
-				logging.warning('BL4P is not connected, so we can\'t search for offers right now')
-				await asyncio.sleep(1)
-				continue
+		scheduler = self.client.backend.offerSearchScheduler #type: OfferSearchScheduler
+		scheduler.register(self.order)
 
-			if queryResult.offers: #found a matching offer
-				await self.doTransactionBasedOnOffers(queryResult.offers)
-				return
+		try:
+			queryResult = cast(messages.BL4PFindOffersResult,
+				await self.call(messages.BL4PFindOffers(
+					localOrderID=self.order.ID,
 
-			if self.order.remoteOfferID is None:
-				logging.info('Found no offers - making our own')
-				await self.publishOffer()
+					query=self.order
+					),
+					messages.BL4PFindOffersResult)
+				) #type: messages.BL4PFindOffersResult
+		except messages.NoMessageHandler:
+			logging.warning('BL4P is not connected, so we can\'t search for offers right now')
+			return scheduler.getNextSearchDelay(self.order.ID)
+
+		if queryResult.offers: #found offers
+			scheduler.reportOffersFound(self.order.ID)
+			if self.startTransactionBasedOnOffers(queryResult.offers):
+				#There may be more: search again right away
+				return 0.0 if self.canStartTransaction() else None
+
+		if self.order.remoteOfferID is None:
+			logging.info('Found no offers - making our own')
+			await self.publishOffer()
 
-			await asyncio.sleep(1)
+		return scheduler.getNextSearchDelay(self.order.ID)
 
 
-	async def doTransactionBasedOnOffers(self, offers):
+	def startTransactionBasedOnOffers(self, offers: List[offer.Offer]) -> bool:
+		'''
+		Starts a single transaction based on the best of the offers that
+		actually match our order.
+		Offers that are already used by our ongoing transactions are skipped.
+		Returns whether a transaction was started.
+		'''
+
 		logging.info('Received offers from BL4P')
 		#TODO: filter on sensibility (e.g. max >= min for all conditions)
 
-		#Check if offers actually match
-		def matchesOurOrder(offer):
-			ret = offer.matches(self.order)
-			if not ret:
-				logging.debug('Received an offer from BL4P that does not match our order - ignoring it')
-			return ret
-		offers = filter(matchesOurOrder, offers)
+		inUse = set(
+			t.counterOffer.ID
+			for t in self.transactionTasks
+			if t.counterOffer is not None
+			)
+
+		orderBook = OrderBook() #type: OrderBook
+		for o in offers:
+			if o.ID not in inUse:
+				orderBook.addOffer(o)
 
 		#TODO (bug 8): filter counterOffers on acceptability
-		#TODO (bug 8): sort counterOffers (e.g. on exchange rate)
 
-		#Evaluate iterator to a list:
-		offers = list(offers)
+		#Start trade on the offer with the best exchange rate
+		bestOffer = orderBook.getBestOffer(self.order) #type: Optional[offer.Offer]
+		if bestOffer is None:
+			logging.debug('None of the offers received from BL4P match our order - ignoring them')
+			return False
 
-		#Start trade on the first in the list
 		logging.info('Starting a transaction based on one of the offers')
-		self.counterOffer = offers[0]
-		await self.doTransaction()
+		transactionTask = TransactionTask(self)
+		transactionTask.counterOffer = bestOffer
+		transactionTask.createSellTransaction()
+		self.startTransaction(transactionTask, transactionTask.startTransactionOnBL4P())
+		return True
 
 
 	async def publishOffer(self) -> None:
 		await self.waitForBL4PConnection()
 
-		if self.order.remoteOfferID is not None:
-			logging.info('The offer was already published - no need to re-publish it')
-			return
+		async with self.offerLock:
+			if self.order.remoteOfferID is not None:
+				logging.info('The offer was already published - no need to re-publish it')
+				return
 
-		result = cast(messages.BL4PAddOfferResult,
-			await self.call(messages.BL4PAddOffer(
-				localOrderID=self.order.ID,
+			result = cast(messages.BL4PAddOfferResult,
+				await self.call(messages.BL4PAddOffer(
+					localOrderID=self.order.ID,
 
-				offer=self.order
-				),
-				messages.BL4PAddOfferResult)
-			) #type: messages.BL4PAddOfferResult
+					offer=self.order
+					),
+					messages.BL4PAddOfferResult)
+				) #type: messages.BL4PAddOfferResult
 
-		remoteID = result.ID #type: int
-		self.order.remoteOfferID = remoteID
-		logging.info('Local ID %d gets remote ID %s' % (self.order.ID, remoteID))
+			remoteID = result.ID #type: int
+			self.order.remoteOfferID = remoteID
+			logging.info('Local ID %d gets remote ID %s' % (self.order.ID, remoteID))
 
 
 	async def unpublishOffer(self) -> None:
 		await self.waitForBL4PConnection()
 
+		async with self.offerLock:
+			if self.order.remoteOfferID is None:
+				logging.info('The offer was not published - no need to un-publish it')
+				return
+
+			await self.call(messages.BL4PRemoveOffer(
+				localOrderID=self.order.ID,
+
+				offerID=self.order.remoteOfferID,
+				),
+				messages.BL4PRemoveOfferResult)
+
+			self.order.remoteOfferID = None
+
+		#The market has changed:
+		self.client.backend.offerSearchScheduler.wakeMarket(getPairKey(self.order))
+
+
+	async def continueSellTransactions(self) -> None:
+		assert isinstance(self.order, SellOrder)
+
+		transactions = self.unfinishedTransactions #type: Optional[List[StoredObject]]
+		self.unfinishedTransactions = None
+		if transactions is None:
+			cursor = self.storage.execute(
+				'SELECT ID from sellTransactions WHERE sellOrder = ? AND status != ? AND status != ?',
+				[self.order.ID, TX_STATUS_FINISHED, TX_STATUS_CANCELED]
+				) #type: Cursor
+			transactions = [SellTransaction(self.storage, row[0]) for row in cursor]
+
+		for transaction in transactions:
+			assert isinstance(transaction, SellTransaction)
+			logging.info('Found an unfinished transaction with ID %d - loading it' % transaction.ID)
+			transactionTask = TransactionTask(self)
+			method = transactionTask.loadSellTransaction(transaction) #type: Callable[[], Awaitable[None]]
+			self.startTransaction(transactionTask, method())
+
+
+	async def continueBuyTransactions(self) -> None:
+		assert isinstance(self.order, BuyOrder)
+
+		transactions = self.unfinishedTransactions #type: Optional[List[StoredObject]]
+		self.unfinishedTransactions = None
+		if transactions is None:
+			cursor = self.storage.execute(
+				'SELECT ID from buyTransactions WHERE buyOrder = ? AND status != ? AND status != ?',
+				[self.order.ID, TX_STATUS_FINISHED, TX_STATUS_CANCELED]
+				) #type: Cursor
+			transactions = [BuyTransaction(self.storage, row[0]) for row in cursor]
+
+		for transaction in transactions:
+			assert isinstance(transaction, BuyTransaction)
+			logging.info('Found an unfinished transaction with ID %d - loading it' % transaction.ID)
+			transactionTask = TransactionTask(self)
+			transactionTask.transaction = transaction
+
+			if transactionTask.transaction.status == TX_STATUS_INITIAL:
+				logging.warning('For this unfinished transaction, we need to wait for lightningd to re-issue it to us')
+				self.startTransaction(transactionTask, transactionTask.waitForIncomingTransaction())
+			else:
+				#TODO: properly report database inconsistency error
+				raise Exception('Invalid transaction status value in unfinished transaction')
+
+
+	def startIncomingTransaction(self, message: messages.LNIncoming) -> None:
+		for t in self.transactionTasks:
+			if t.transaction is None or t.transaction.paymentHash != message.paymentHash:
+				continue
+			if t.expectedCallResultType is not messages.LNIncoming:
+				raise UnexpectedResult(
+					'Received an incoming transaction that is already being handled: ' + \
+					str(message)
+					)
+			#The transaction was waiting for lightningd to re-issue it to us:
+			t.setResultOfCall(message)
+			return
+
+		if not isinstance(self.order, BuyOrder) or not self.canStartTransaction():
+			raise UnexpectedResult(
+				'Can\'t start an incoming transaction right now: ' + \
+				str(message)
+				)
+
+		transactionTask = TransactionTask(self)
+		self.startTransaction(transactionTask, transactionTask.handleIncomingTransaction(message))
+
+
+	async def updateOrderAfterTransaction(self) -> None:
+		logging.info('Remaining in order: ' + \
+			str(self.order.amount))
+
+		#A fill changes the market:
+		self.client.backend.offerSearchScheduler.wakeMarket(getPairKey(self.order))
+
 		if self.order.remoteOfferID is None:
-			logging.info('The offer was not published - no need to un-publish it')
 			return
 
-		await self.call(messages.BL4PRemoveOffer(
-			localOrderID=self.order.ID,
+		#Remove offer from the market
+		logging.info('Removing old offer from the market')
+		await self.unpublishOffer()
+
+		#Re-add offer to the market
+		if self.order.amount > 0:
+			logging.info('Re-adding the offer to the market')
+			await self.publishOffer()
+
 
-			offerID=self.order.remoteOfferID,
-			),
-			messages.BL4PRemoveOfferResult)
 
-		self.order.remoteOfferID = None
+class TransactionTask(Caller):
+	'''
+	Performs a single transaction of an order.
+	'''
+
+	task = None #type: Optional[asyncio.Future]
+
+	def __init__(self, orderTask: OrderTask) -> None:
+		Caller.__init__(self, orderTask.client, orderTask.storage)
+
+		self.orderTask = orderTask #type: OrderTask
+		self.order = orderTask.order #type: Order
+		self.counterOffer = None #type: Optional[offer.Offer]
+		self.transaction = None #type: Optional[Union[BuyTransaction, SellTransaction]]
+
+		#Part of the order amount that is reserved for this transaction:
+		self.reservedAmount = 0 #type: int
+
+
+	def reserveAmount(self, amount: int) -> None:
+		self.releaseAmount()
+		self.reservedAmount = amount
+		self.order.reservedAmount += amount
+
+
+	def releaseAmount(self) -> None:
+		self.order.reservedAmount -= self.reservedAmount
+		self.reservedAmount = 0
+
+
+	def updateTransaction(self, **values: Any) -> None:
+		'Updates the stored transaction, and counts its status transition.'
+		assert self.transaction is not None
+		self.transaction.update(**values)
+		metrics.registry.counter('transaction.' + TxStatus2str[values['status']]).increment()
 
 
 	########################################################################
 	# Seller side
 	########################################################################
 
-	async def continueSellTransaction(self) -> None:
-		assert isinstance(self.order, SellOrder)
-
-		cursor = self.storage.execute(
-			'SELECT ID from sellTransactions WHERE sellOrder = ? AND status != ? AND status != ?',
-			[self.order.ID, TX_STATUS_FINISHED, TX_STATUS_CANCELED]
-			) #type: Cursor
-		IDs = [row[0] for row in cursor] #type: List[int]
-		assert len(IDs) < 2 #TODO: properly report database inconsistency error
-		if len(IDs) == 0:
-			return #no transaction needs to be continued
-		ID = IDs[0] #type: int
-
-		logging.info('Found an unfinished transaction with ID %d - loading it' % ID)
+	def loadSellTransaction(self, transaction: SellTransaction) -> Callable[[], Awaitable[None]]:
+		'''
+		Loads an unfinished transaction.
+		Returns the method that continues it.
+		'''
 
-		self.transaction = SellTransaction(self.storage, ID)
-		storedCounterOffer = CounterOffer(self.storage, self.transaction.counterOffer) #type: CounterOffer
-		self.counterOffer = storedCounterOffer.counterOffer
+		self.transaction = transaction
+		try:
+			self.counterOffer = self.orderTask.counterOffers[transaction.counterOffer]
+		except KeyError:
+			storedCounterOffer = CounterOffer(self.storage, transaction.counterOffer) #type: CounterOffer
+			self.counterOffer = storedCounterOffer.counterOffer
 
 		#TODO: properly report database inconsistency error in case of KeyError
 		method = \
@@ -503,10 +984,15 @@ class OrderTask:
 		TX_STATUS_LOCKED           : self.doTransactionOnLightning,
 		TX_STATUS_RECEIVED_PREIMAGE: self.receiveFiatFunds,
 		}[self.transaction.status] #type: Callable[[], Awaitable[None]]
-		await method()
 
+		#Until we have the preimage, the order amount is not yet updated:
+		if self.transaction.status != TX_STATUS_RECEIVED_PREIMAGE:
+			self.reserveAmount(self.transaction.buyerCryptoAmount)
 
-	async def doTransaction(self) -> None:
+		return method
+
+
+	def createSellTransaction(self) -> None:
 		assert isinstance(self.order, SellOrder) #TODO (bug 13): enable buyer-initiated trade once supported
 		assert self.counterOffer is not None
 
@@ -517,10 +1003,12 @@ class OrderTask:
 		cryptoAmountDivisor = settings.cryptoDivisor #type: int
 		fiatAmountDivisor = settings.fiatDivisor #type: int
 
-		#Choose the largest crypto amount accepted by both
+		#Choose the largest crypto amount accepted by both,
+		#that is not used by other transactions of our order
 		buyerCryptoAmount = min(
 			cryptoAmountDivisor * self.order.bid.max_amount // self.order.bid.max_amount_divisor,
-			cryptoAmountDivisor * self.counterOffer.ask.max_amount // self.counterOffer.ask.max_amount_divisor
+			cryptoAmountDivisor * self.counterOffer.ask.max_amount // self.counterOffer.ask.max_amount_divisor,
+			self.order.amount - self.order.reservedAmount
 			) #type: int
 		logging.info('buyerCryptoAmount = ' + str(buyerCryptoAmount))
 		assert buyerCryptoAmount > 0
@@ -559,23 +1047,24 @@ class OrderTask:
 			offer.Condition.CLTV_EXPIRY_DELTA
 			) #type: int
 
-		#TODO (bug 10): check if it's already in the database
-		counterOfferID = CounterOffer.create(self.storage, self.counterOffer) #type: int
+		with self.storage.transaction():
+			counterOfferID = CounterOffer.create(self.storage, self.counterOffer) #type: int
 
-		sellTransactionID = SellTransaction.create(self.storage,
-			sellOrder    = self.order.ID,
-			counterOffer = counterOfferID,
+			values = SellTransaction.insert(self.storage,
+				sellOrder    = self.order.ID,
+				counterOffer = counterOfferID,
 
-			buyerFiatAmount   = buyerFiatAmount,
-			buyerCryptoAmount  = buyerCryptoAmount,
+				buyerFiatAmount   = buyerFiatAmount,
+				buyerCryptoAmount  = buyerCryptoAmount,
 
-			senderTimeoutDelta = sender_timeout_delta_ms,
-			lockedTimeoutDelta = locked_timeout_delta_s,
-			CLTVExpiryDelta    = CLTV_expiry_delta,
-			) #type: int
-		self.transaction = SellTransaction(self.storage, sellTransactionID)
+				senderTimeoutDelta = sender_timeout_delta_ms,
+				lockedTimeoutDelta = locked_timeout_delta_s,
+				CLTVExpiryDelta    = CLTV_expiry_delta,
+				) #type: Dict[str, Any]
+		self.transaction = SellTransaction(self.storage, values['ID'], values)
 
-		await self.startTransactionOnBL4P()
+		#Other transactions of this order can't use this amount:
+		self.reserveAmount(buyerCryptoAmount)
 
 
 	async def startTransactionOnBL4P(self) -> None:
@@ -617,7 +1106,7 @@ class OrderTask:
 			await self.cancelIncomingFiatFunds()
 			return
 
-		self.transaction.update(
+		self.updateTransaction(
 			sellerFiatAmount = sellerFiatAmount,
 			paymentHash = startResult.paymentHash,
 			status = TX_STATUS_STARTED,
@@ -645,7 +1134,7 @@ class OrderTask:
 			),
 			messages.BL4PSelfReportResult)
 
-		self.transaction.update(
+		self.updateTransaction(
 			status = TX_STATUS_LOCKED,
 			)
 
@@ -688,17 +1177,19 @@ class OrderTask:
 		assert sha256(lightningResult.paymentPreimage) == self.transaction.paymentHash
 		logging.info('We got the preimage from the LN payment')
 
-		self.transaction.update(
-			sellerCryptoAmount = lightningResult.senderCryptoAmount,
-			paymentPreimage = lightningResult.paymentPreimage,
-			status = TX_STATUS_RECEIVED_PREIMAGE,
-			)
-		newAmount = self.order.amount - self.transaction.sellerCryptoAmount
-		if newAmount < 0:
-			#This is possible due to Lightning fees
-			logging.info('We\'ve exceeded the order amount by ' + str(-newAmount))
-			newAmount = 0
-		self.order.setAmount(newAmount)
+		self.releaseAmount()
+		with self.storage.transaction():
+			self.updateTransaction(
+				sellerCryptoAmount = lightningResult.senderCryptoAmount,
+				paymentPreimage = lightningResult.paymentPreimage,
+				status = TX_STATUS_RECEIVED_PREIMAGE,
+				)
+			newAmount = self.order.amount - self.transaction.sellerCryptoAmount
+			if newAmount < 0:
+				#This is possible due to Lightning fees
+				logging.info('We\'ve exceeded the order amount by ' + str(-newAmount))
+				newAmount = 0
+			self.order.setAmount(newAmount)
 
 		await self.receiveFiatFunds()
 
@@ -717,13 +1208,13 @@ class OrderTask:
 				messages.BL4PReceiveResult)
 			) #type: messages.BL4PReceiveResult
 
-		self.transaction.update(
+		self.updateTransaction(
 			status = TX_STATUS_FINISHED,
 			)
 		self.transaction = None
 
 		logging.info('Sell transaction is finished')
-		await self.updateOrderAfterTransaction()
+		await self.orderTask.updateOrderAfterTransaction()
 
 
 	async def cancelIncomingFiatFunds(self) -> None:
@@ -738,7 +1229,7 @@ class OrderTask:
 			),
 			messages.BL4PCancelStartResult)
 
-		self.transaction.update(
+		self.updateTransaction(
 			status = TX_STATUS_CANCELED,
 			)
 		self.transaction = None
@@ -751,31 +1242,6 @@ class OrderTask:
 	# Buyer side
 	########################################################################
 
-	async def continueBuyTransaction(self) -> None:
-		assert isinstance(self.order, BuyOrder)
-
-		cursor = self.storage.execute(
-			'SELECT ID from buyTransactions WHERE buyOrder = ? AND status != ? AND status != ?',
-			[self.order.ID, TX_STATUS_FINISHED, TX_STATUS_CANCELED]
-			) #type: Cursor
-		IDs = [row[0] for row in cursor] #type: List[int]
-		assert len(IDs) < 2 #TODO: properly report database inconsistency error
-		if len(IDs) == 0:
-			return #no transaction needs to be continued
-		ID = IDs[0] #type: int
-
-		logging.info('Found an unfinished transaction with ID %d - loading it' % ID)
-
-		self.transaction = BuyTransaction(self.storage, ID)
-
-		if self.transaction.status == TX_STATUS_INITIAL:
-			logging.warning('For this unfinished transaction, we need to wait for lightningd to re-issue it to us')
-			await self.waitForIncomingTransaction()
-		else:
-			#TODO: properly report database inconsistency error
-			raise Exception('Invalid transaction status value in unfinished transaction')
-
-
 	async def waitForIncomingTransaction(self) -> None:
 		assert isinstance(self.order, BuyOrder)
 
@@ -783,16 +1249,24 @@ class OrderTask:
 			await self.waitForIncomingMessage(messages.LNIncoming)
 			) #type: messages.LNIncoming
 
+		await self.handleIncomingTransaction(message)
+
+
+	async def handleIncomingTransaction(self, message: messages.LNIncoming) -> None:
+		assert isinstance(self.order, BuyOrder)
+
 		logging.info('Received incoming Lightning transaction')
 		#TODO: log transaction characteristics
 		#TODO: maybe refuse tx if we're not connected to BL4P
 
 		#Check if this is a new notification for an already ongoing tx.
-		cursor = self.storage.execute(
-			'SELECT ID from buyTransactions WHERE paymentHash = ?',
-			[message.paymentHash]
-			) #type: Cursor
-		transactions = [BuyTransaction(self.storage, row[0]) for row in cursor]
+		#Finished transactions may already be archived.
+		rows = StoredObject.loadStoredObjects(self.storage,
+			'SELECT * from buyTransactions WHERE paymentHash = ? '
+			'UNION ALL SELECT * from archivedBuyTransactions WHERE paymentHash = ?',
+			[message.paymentHash, message.paymentHash]
+			) #type: List[Dict[str, Any]]
+		transactions = [BuyTransaction(self.storage, values['ID'], values) for values in rows]
 		if transactions:
 			logging.info('A transaction with this payment hash already exists in our database')
 			self.transaction = transactions[0]
@@ -849,16 +1323,17 @@ class OrderTask:
 		#Check if remaining order size is sufficient:
 		assert message.fiatAmount <= self.order.amount
 
-		buyTransactionID = BuyTransaction.create(self.storage,
-			buyOrder = self.order.ID,
+		with self.storage.transaction():
+			values = BuyTransaction.insert(self.storage,
+				buyOrder = self.order.ID,
 
-			fiatAmount   = message.fiatAmount,
-			cryptoAmount = message.cryptoAmount,
+				fiatAmount   = message.fiatAmount,
+				cryptoAmount = message.cryptoAmount,
 
-			paymentHash = message.paymentHash,
-			) #type: int
-		self.order.setAmount(self.order.amount - message.fiatAmount)
-		self.transaction = BuyTransaction(self.storage, buyTransactionID)
+				paymentHash = message.paymentHash,
+				) #type: Dict[str, Any]
+			self.order.setAmount(self.order.amount - message.fiatAmount)
+		self.transaction = BuyTransaction(self.storage, values['ID'], values)
 
 		await self.sendFundsOnBL4P()
 
@@ -889,10 +1364,11 @@ class OrderTask:
 				) #type: messages.BL4PSendResult
 		except BL4PError:
 			logging.error('Error received from BL4P - transaction canceled')
-			self.order.setAmount(self.order.amount + self.transaction.fiatAmount)
-			self.transaction.update(
-				status = TX_STATUS_CANCELED,
-				)
+			with self.storage.transaction():
+				self.order.setAmount(self.order.amount + self.transaction.fiatAmount)
+				self.updateTransaction(
+					status = TX_STATUS_CANCELED,
+					)
 			await self.cancelTransactionOnLightning()
 			return
 
@@ -900,7 +1376,7 @@ class OrderTask:
 		assert sha256(sendResult.paymentPreimage) == self.transaction.paymentHash
 		logging.info('We got the preimage from BL4P')
 
-		self.transaction.update(
+		self.updateTransaction(
 			paymentPreimage = sendResult.paymentPreimage,
 			status = TX_STATUS_FINISHED,
 			)
@@ -913,6 +1389,7 @@ class OrderTask:
 		assert isinstance(self.transaction, BuyTransaction)
 
 		#Receive crypto funds
+		await self.storage.flush()
 		self.client.handleOutgoingMessage(messages.LNFinish(
 			paymentHash=self.transaction.paymentHash,
 			paymentPreimage=self.transaction.paymentPreimage,
@@ -920,13 +1397,14 @@ class OrderTask:
 		self.transaction = None
 
 		logging.info('Buy transaction is finished')
-		await self.updateOrderAfterTransaction()
+		await self.orderTask.updateOrderAfterTransaction()
 
 
 	async def cancelTransactionOnLightning(self) -> None:
 		assert isinstance(self.order, BuyOrder)
 		assert isinstance(self.transaction, BuyTransaction)
 
+		await self.storage.flush()
 		self.client.handleOutgoingMessage(messages.LNFail(
 			paymentHash=self.transaction.paymentHash,
 			))
@@ -935,47 +1413,5 @@ class OrderTask:
 		logging.info('Buy transaction is canceled')
 
 		#TODO: is this really needed?
-		await self.updateOrderAfterTransaction()
-
-
-	########################################################################
-	# Generic
-	########################################################################
-
-	async def updateOrderAfterTransaction(self) -> None:
-		if self.order.remoteOfferID is None:
-			return
-
-		#Remove offer from the market
-		logging.info('Removing old offer from the market')
-		await self.unpublishOffer()
-
-		#Re-add offer to the market
-		if self.order.amount > 0:
-			logging.info('Re-adding the offer to the market')
-			await self.publishOffer()
-
-
-	async def call(self, message: messages.AnyMessage, expectedResultType: Type) -> messages.AnyMessage:
-		self.client.handleOutgoingMessage(message)
-		return await self.waitForIncomingMessage(expectedResultType)
-
-
-	async def waitForIncomingMessage(self, expectedResultType: Type) -> messages.AnyMessage:
-		assert self.callResult is None
-		self.callResult = asyncio.Future()
-		self.expectedCallResultType = expectedResultType
-		await self.callResult
-		ret = self.callResult.result() #type: messages.AnyMessage
-
-		#Special case for BL4P exceptions
-		if isinstance(ret, messages.BL4PError):
-			self.callResult = None
-			self.expectedCallResultType = None
-			raise BL4PError()
-
-		assert isinstance(ret, expectedResultType)
-		self.callResult = None
-		self.expectedCallResultType = None
-		return ret
+		await self.orderTask.updateOrderAfterTransaction()
 
@@ -0,0 +1,146 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Callable, Deque, Dict, Optional
+
+import messages
+import metrics
+
+
+
+#Stages of an outgoing Lightning payment, in order:
+STAGES = ['getroute', 'getinfo', 'createonion', 'sendonion', 'waitsendpay']
+
+#Until the onion is sent, giving up on a payment is safe:
+ABORTABLE_STAGES = set(['getroute', 'getinfo', 'createonion'])
+
+#Seconds.
+#In abortable stages, the payment fails on timeout; in other stages, only
+#a warning is logged, since the payment may still succeed.
+DEFAULT_STAGE_TIMEOUTS = \
+{
+'getroute'   : 60.0,
+'getinfo'    : 30.0,
+'createonion': 30.0,
+'sendonion'  : 60.0,
+'waitsendpay': 3600.0,
+} #type: Dict[str, float]
+
+DEFAULT_MAX_IN_FLIGHT = 100 #type: int
+
+
+
+class Payment:
+	def __init__(self, message: messages.LNPay) -> None:
+		self.message = message #type: messages.LNPay
+		self.startTime = time.monotonic() #type: float
+		self.stage = None #type: Optional[str]
+		self.stageStartTime = self.startTime #type: float
+		self.timeoutHandle = None #type: Optional[asyncio.TimerHandle]
+
+
+
+class PaymentPipeline:
+	'''
+	Keeps track of outgoing Lightning payments as they go through STAGES.
+
+	At most maxInFlight payments are processed at the same time; others
+	wait in a FIFO queue.
+	The time spent in every stage is measured in the rpc.payment.<stage>
+	histograms, and the time of the entire payment in rpc.payment.total.
+	Every stage has a timeout.
+
+	The pipeline doesn't do RPC calls itself: startPayment is called when
+	a payment may start, and handleTimeout when a stage takes too long.
+	'''
+
+	def __init__(self,
+		startPayment: Callable[[messages.LNPay], None],
+		handleTimeout: Callable[[messages.LNPay, str], None],
+		maxInFlight: int = DEFAULT_MAX_IN_FLIGHT,
+		stageTimeouts: Dict[str, float] = DEFAULT_STAGE_TIMEOUTS,
+		) -> None:
+
+		self.startPayment = startPayment #type: Callable[[messages.LNPay], None]
+		self.handleTimeout = handleTimeout #type: Callable[[messages.LNPay, str], None]
+		self.maxInFlight = maxInFlight #type: int
+		self.stageTimeouts = stageTimeouts.copy() #type: Dict[str, float]
+
+		self.inFlight = {} #type: Dict[bytes, Payment] #payment hash -> Payment
+		self.queue = deque() #type: Deque[messages.LNPay]
+
+
+	def submit(self, message: messages.LNPay) -> None:
+		if message.paymentHash in self.inFlight or \
+			any(m.paymentHash == message.paymentHash for m in self.queue):
+			logging.warning('Ignoring a second payment for payment hash ' + message.paymentHash.hex())
+			return
+
+		self.queue.append(message)
+		self.startQueuedPayments()
+
+
+	def startQueuedPayments(self) -> None:
+		while self.queue and len(self.inFlight) < self.maxInFlight:
+			message = self.queue.popleft() #type: messages.LNPay
+			self.inFlight[message.paymentHash] = Payment(message)
+			self.startPayment(message)
+
+
+	def setStage(self, paymentHash: bytes, stage: str) -> None:
+		payment = self.inFlight[paymentHash] #type: Payment
+		self.endStage(payment)
+
+		payment.stage = stage
+		timeout = self.stageTimeouts.get(stage) #type: Optional[float]
+		if timeout is not None:
+			payment.timeoutHandle = asyncio.get_event_loop().call_later(
+				timeout, self.handleStageTimeout, paymentHash, stage)
+
+
+	def isAtStage(self, paymentHash: bytes, stage: str) -> bool:
+		payment = self.inFlight.get(paymentHash) #type: Optional[Payment]
+		return payment is not None and payment.stage == stage
+
+
+	def finish(self, paymentHash: bytes) -> None:
+		payment = self.inFlight.pop(paymentHash) #type: Payment
+		self.endStage(payment)
+		metrics.registry.histogram('rpc.payment.total').add(time.monotonic() - payment.startTime)
+		self.startQueuedPayments()
+
+
+	def endStage(self, payment: Payment) -> None:
+		now = time.monotonic() #type: float
+		if payment.stage is not None:
+			metrics.registry.histogram('rpc.payment.' + payment.stage).add(now - payment.stageStartTime)
+		payment.stageStartTime = now
+		if payment.timeoutHandle is not None:
+			payment.timeoutHandle.cancel()
+			payment.timeoutHandle = None
+
+
+	def handleStageTimeout(self, paymentHash: bytes, stage: str) -> None:
+		payment = self.inFlight.get(paymentHash) #type: Optional[Payment]
+		if payment is None or payment.stage != stage:
+			return
+		payment.timeoutHandle = None
+		self.handleTimeout(payment.message, stage)
@@ -30,7 +30,9 @@ if TYPE_CHECKING:
 from json_rpc import JSONRPC
 from ln_payload import Payload
 import messages
+import metrics
 import onion_utils
+import paymentpipeline
 import settings
 
 
@@ -48,6 +50,9 @@ class OngoingRequest:
 
 NO_RESPONSE = object() #Placeholder in case no response is to be sent
 
+#Allowed values of the bl4p.loglevel option:
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR'] #type: List[str]
+
 
 
 class PluginInterface(JSONRPC, messages.Handler):
@@ -76,6 +81,18 @@ class PluginInterface(JSONRPC, messages.Handler):
 		'description': 'BL4P plug-in database file',
 		'type'       : 'string',
 		},
+		{
+		'name'       : 'bl4p.loglevel',
+		'default'    : 'INFO',
+		'description': 'BL4P plug-in log level (%s)' % ', '.join(LOG_LEVELS),
+		'type'       : 'string',
+		},
+		{
+		'name'       : 'bl4p.maxpaymentsinflight',
+		'default'    : str(paymentpipeline.DEFAULT_MAX_IN_FLIGHT),
+		'description': 'Maximum number of outgoing Lightning payments that are processed at the same time',
+		'type'       : 'string',
+		},
 		] #type: List[Dict[str, str]]
 		self.methods = \
 		{
@@ -90,14 +107,19 @@ class PluginInterface(JSONRPC, messages.Handler):
 		'bl4p.cancel'           : (self.cancel            , MethodType.RPCMETHOD),
 		'bl4p.setconfig'        : (self.setConfig         , MethodType.RPCMETHOD),
 		'bl4p.getconfig'        : (self.getConfig         , MethodType.RPCMETHOD),
+		'bl4p.stats'            : (self.stats             , MethodType.RPCMETHOD),
 
 		'htlc_accepted'         : (self.handleHTLCAccepted, MethodType.HOOK),
 		} #type: Dict[str, Tuple[Callable, MethodType]]
 
-		self.subscriptions = {} #type: Dict[str, Callable]
+		self.subscriptions = \
+		{
+		'block_added': self.handleBlockAdded,
+		} #type: Dict[str, Callable]
 
 		self.currentRequestID = None #type: Optional[int]
 		self.ongoingRequests = {} #type: Dict[int, Tuple[str, OngoingRequest]] #ID -> (methodname, OngoingRequest)
+		self.ongoingRequestIndex = {} #type: Dict[Tuple[str, bytes], List[int]] #(methodname, paymentHash) -> IDs, oldest first
 
 
 	async def startup(self):
@@ -136,21 +158,26 @@ class PluginInterface(JSONRPC, messages.Handler):
 	def storeOngoingRequest(self, name: str, request: OngoingRequest) -> None:
 		assert self.currentRequestID is not None
 		self.ongoingRequests[self.currentRequestID] = name, request
+		if request.paymentHash is not None:
+			self.ongoingRequestIndex.setdefault((name, request.paymentHash), []).append(self.currentRequestID)
 
 
-	def findOngoingRequest(self, name: str, func: Callable) -> int:
-		ID = -1 #type: int
-
-		for ID, value in self.ongoingRequests.items():
-			methodName, request = value #type: Tuple[str, OngoingRequest]
-			if methodName == name and func(request):
-				return ID
-		raise IndexError()
+	def findOngoingRequest(self, name: str, paymentHash: bytes) -> int:
+		try:
+			return self.ongoingRequestIndex[(name, paymentHash)][0]
+		except KeyError:
+			raise IndexError()
 
 
 	def sendOngoingRequestResponse(self, ID: int, result: Any) -> None:
 		#TODO: have a way to send delayed error responses
-		del self.ongoingRequests[ID]
+		name, request = self.ongoingRequests.pop(ID) #type: Tuple[str, OngoingRequest]
+		if request.paymentHash is not None:
+			key = (name, request.paymentHash) #type: Tuple[str, bytes]
+			IDs = self.ongoingRequestIndex[key] #type: List[int]
+			IDs.remove(ID)
+			if not IDs:
+				del self.ongoingRequestIndex[key]
 		self.sendResponse(ID, result)
 
 
@@ -203,6 +230,27 @@ class PluginInterface(JSONRPC, messages.Handler):
 		self.RPCPath = os.path.join(lndir, filename) #type: str
 		self.logFile = options['bl4p.logfile'] #type: str
 		self.DBFile = options['bl4p.dbfile'] #type: str
+		self.logLevel = options['bl4p.loglevel'] #type: str
+		if self.logLevel not in LOG_LEVELS:
+			raise ValueError(
+				'bl4p.loglevel must be one of %s; got %s' % \
+				(', '.join(LOG_LEVELS), repr(self.logLevel)))
+
+		maxPaymentsInFlight = options['bl4p.maxpaymentsinflight'] #type: str
+		if not maxPaymentsInFlight.isdigit() or int(maxPaymentsInFlight) < 1:
+			raise ValueError(
+				'bl4p.maxpaymentsinflight must be a positive integer; got %s' % \
+				repr(maxPaymentsInFlight))
+		self.maxPaymentsInFlight = int(maxPaymentsInFlight) #type: int
+
+
+	def handleBlockAdded(self, block_added: Optional[Dict[str, Any]] = None, block: Optional[Dict[str, Any]] = None, **kwargs) -> None:
+		#Older lightningd versions call it block instead of block_added
+		data = block_added if block_added is not None else block #type: Optional[Dict[str, Any]]
+		assert data is not None
+		self.client.handleIncomingMessage(messages.LNBlockAdded(
+			height = data['height'],
+			))
 
 
 	def getFiatCurrency(self, **kwargs) -> Dict[str, Any]:
@@ -300,6 +348,11 @@ class PluginInterface(JSONRPC, messages.Handler):
 		return NO_RESPONSE
 
 
+	def stats(self, **kwargs) -> Dict[str, Any]:
+		'Get performance statistics'
+		return metrics.registry.getInfo()
+
+
 	def handleHTLCAccepted(self, onion: Dict[str, Any], htlc: Dict[str, Any], **kwargs) -> Union[object, Dict[str, str]]:
 		'''
 		Parameter format:
@@ -356,8 +409,7 @@ class PluginInterface(JSONRPC, messages.Handler):
 
 	def sendFinish(self, message: messages.LNFinish) -> None:
 		try:
-			ID = self.findOngoingRequest('htlc_accepted',
-				lambda x: x.paymentHash == message.paymentHash) #type: int
+			ID = self.findOngoingRequest('htlc_accepted', message.paymentHash) #type: int
 		except IndexError:
 			logging.error('Cannot finish the Lightning transaction right now, because lightningd didn\'t give it to us.')
 			logging.error('This may be caused by a restart during an ongoing transaction.')
@@ -372,8 +424,7 @@ class PluginInterface(JSONRPC, messages.Handler):
 
 	def sendFail(self, message: messages.LNFail) -> None:
 		try:
-			ID = self.findOngoingRequest('htlc_accepted',
-				lambda x: x.paymentHash == message.paymentHash) #type: int
+			ID = self.findOngoingRequest('htlc_accepted', message.paymentHash) #type: int
 		except IndexError:
 			logging.error('Cannot fail the Lightning transaction right now, because lightningd didn\'t give it to us.')
 			logging.error('This may be caused by a restart during an ongoing transaction.')
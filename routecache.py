@@ -0,0 +1,118 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+
+
+Route = List[Dict[str, Any]]
+CacheKey = Tuple[str, int, int] #destination, amount bucket, CLTV expiry delta
+
+
+
+def getAmountBucket(amount: int) -> int:
+	'Amounts within about 9% of each other share a bucket.'
+	if amount <= 0:
+		return 0
+	return int(math.log2(amount) * 8)
+
+
+def setHopAmount(hop: Dict[str, Any], amount: int) -> None:
+	hop['msatoshi'] = amount
+	if 'amount_msat' in hop:
+		hop['amount_msat'] = '%dmsat' % amount
+
+
+def adjustRoute(route: Route, oldAmount: int, newAmount: int) -> Route:
+	'''
+	Returns a copy of route, which was found for oldAmount, for sending
+	newAmount to the same destination.
+
+	The fee of every hop is at least base fee + proportional fee * amount.
+	For a larger amount, fees are increased proportionally, which is
+	always sufficient. For a smaller amount, fees are kept the same.
+	'''
+	newRoute = [dict(hop) for hop in route] #type: Route
+	factor = max(1.0, newAmount / oldAmount) if oldAmount > 0 else 1.0 #type: float
+
+	amount = newAmount #type: int
+	setHopAmount(newRoute[-1], amount)
+	for i in range(len(route) - 2, -1, -1):
+		fee = route[i]['msatoshi'] - route[i + 1]['msatoshi'] #type: int
+		amount += math.ceil(fee * factor)
+		setHopAmount(newRoute[i], amount)
+	return newRoute
+
+
+
+class RouteCache:
+	'''
+	Cache of getroute results.
+
+	Entries are keyed on destination, amount bucket and CLTV expiry delta.
+	They expire after TTL seconds; if there are more than maxSize entries,
+	the least recently used one is removed.
+	When a payment to a destination fails, all its entries are invalidated.
+
+	Hits and misses are counted in the routecache.hits and routecache.misses
+	metrics.
+	'''
+
+	def __init__(self, maxSize: int = 1000, TTL: float = 60.0) -> None:
+		self.maxSize = maxSize #type: int
+		self.TTL = TTL #type: float
+
+		#key -> (route, amount, creation time), least recently used first:
+		self.entries = OrderedDict() #type: OrderedDict[CacheKey, Tuple[Route, int, float]]
+
+
+	def get(self, destination: str, amount: int, CLTVExpiryDelta: int) -> Optional[Route]:
+		key = (destination, getAmountBucket(amount), CLTVExpiryDelta) #type: CacheKey
+		try:
+			route, oldAmount, created = self.entries[key]
+		except KeyError:
+			metrics.registry.counter('routecache.misses').increment()
+			return None
+
+		if time.monotonic() - created > self.TTL:
+			del self.entries[key]
+			metrics.registry.counter('routecache.misses').increment()
+			return None
+
+		self.entries.move_to_end(key)
+		metrics.registry.counter('routecache.hits').increment()
+		return adjustRoute(route, oldAmount, amount)
+
+
+	def put(self, destination: str, amount: int, CLTVExpiryDelta: int, route: Route) -> None:
+		if not route:
+			return
+		key = (destination, getAmountBucket(amount), CLTVExpiryDelta) #type: CacheKey
+		self.entries[key] = ([dict(hop) for hop in route], amount, time.monotonic())
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+
+
+	def invalidate(self, destination: str) -> None:
+		for key in [k for k in self.entries.keys() if k[0] == destination]:
+			del self.entries[key]
@@ -18,7 +18,8 @@
 
 import asyncio
 import logging
-from typing import Any, Dict, List, Tuple, TYPE_CHECKING
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
 
 if TYPE_CHECKING:
 	import bl4p_plugin #pragma: nocover
@@ -26,43 +27,81 @@ if TYPE_CHECKING:
 from json_rpc import JSONRPC
 from ln_payload import Payload
 import messages
+import metrics
 import onion_utils
+import paymentpipeline
+from routecache import RouteCache
 import settings
 
 
 
+#These calls can block for a long time, so they get their own connections:
+LONG_POLL_METHODS = set(['waitsendpay']) #type: Set[str]
+
+#Number of connections for other calls, including the main connection:
+DEFAULT_POOL_SIZE = 4 #type: int
+
+MAX_LONG_POLL_CONNECTIONS = 64 #type: int
+
+#lightningd error code of sendonion and waitsendpay:
+#the payment is (still) in progress.
+PAY_IN_PROGRESS = 200 #type: int
+
+#If the block height wasn't updated for this long, we ask lightningd:
+BLOCKHEIGHT_REFRESH_INTERVAL = 60.0 #type: float
+
+
+
 class extendedLNPayMessage(messages.LNPay):
 	senderCryptoAmount    = 0   #type: int
 	route                 = []  #type: List[Dict[str, Any]]
 
 
 
-class RPCInterface(JSONRPC, messages.Handler):
-	def __init__(self, client: 'bl4p_plugin.BL4PClient', inputStream: asyncio.StreamReader, outputStream: asyncio.StreamWriter) -> None:
+class blockHeightRefreshMessage(messages.LNBlockAdded):
+	pass
+
+
+
+class RPCConnection(JSONRPC):
+	'''
+	A connection to the lightningd RPC interface.
+	Results of stored requests are passed to the owner.
+	'''
+
+	def __init__(self, owner: 'RPCInterface', inputStream: asyncio.StreamReader, outputStream: asyncio.StreamWriter) -> None:
 		JSONRPC.__init__(self, inputStream, outputStream)
-		messages.Handler.__init__(self, {
-			messages.LNPay: self.sendPay,
-			})
-		self.client = client #type: bl4p_plugin.BL4PClient
+		self.owner = owner #type: RPCInterface
 		self.ongoingRequests = {} #type: Dict[int, Tuple[str, messages.AnyMessage]] #ID -> (methodname, message)
+		self.requestStartTimes = {} #type: Dict[int, float] #ID -> perf_counter
 
 
-	async def startupRPC(self) -> None:
-		info = await self.synCall('getinfo') #type: Dict
-		self.nodeID = info['id'] #type: str
+	async def shutdown(self) -> None:
+		await JSONRPC.shutdown(self)
+		self.outputStream.close()
 
-		JSONRPC.startup(self)
+
+	def isAlive(self) -> bool:
+		return not self.task.done()
 
 
 	def sendStoredRequest(self, message: messages.AnyMessage, name: str, params: Dict[str, Any]) -> None:
 		ID = self.sendRequest(name, params) #type: int
 		self.ongoingRequests[ID] = (name, message)
+		self.requestStartTimes[ID] = time.perf_counter()
+
+
+	def measureRoundTrip(self, ID: int, name: str) -> None:
+		startTime = self.requestStartTimes.pop(ID, None) #type: Optional[float]
+		if startTime is not None:
+			metrics.registry.histogram('rpc.' + name).add(time.perf_counter() - startTime)
 
 
 	def handleResult(self, ID: int, result: Any) -> None:
 		name, message = self.ongoingRequests[ID] #type: Tuple[str, messages.AnyMessage]
 		del self.ongoingRequests[ID]
-		self.handleStoredRequestResult(message, name, result)
+		self.measureRoundTrip(ID, name)
+		self.owner.handleStoredRequestResult(message, name, result)
 
 
 	def handleError(self, ID: int, code: int, message: str) -> None:
@@ -71,15 +110,179 @@ class RPCInterface(JSONRPC, messages.Handler):
 			(ID, name, str(storedMessage)))
 		logging.error('Error code = %d, message = %s' % (code, message))
 		del self.ongoingRequests[ID]
-		self.handleStoredRequestError(storedMessage, name, code)
+		self.measureRoundTrip(ID, name)
+		metrics.registry.counter('rpc.' + name + '.errors').increment()
+		self.owner.handleStoredRequestError(storedMessage, name, code)
+
+
+
+class RPCInterface(RPCConnection, messages.Handler):
+	'''
+	The main connection to the lightningd RPC interface.
+
+	After startupPool, calls are spread over a pool of connections, and
+	calls in LONG_POLL_METHODS each get a connection of their own, so that
+	they don't delay other calls.
+	Without a pool, all calls go over the main connection.
+	'''
+
+	def __init__(self,
+		client: 'bl4p_plugin.BL4PClient',
+		inputStream: asyncio.StreamReader, outputStream: asyncio.StreamWriter,
+		maxPaymentsInFlight: int = paymentpipeline.DEFAULT_MAX_IN_FLIGHT,
+		) -> None:
+
+		RPCConnection.__init__(self, self, inputStream, outputStream)
+		messages.Handler.__init__(self, {
+			messages.LNPay       : self.sendPay,
+			messages.LNBlockAdded: self.handleBlockAdded,
+			})
+		self.client = client #type: bl4p_plugin.BL4PClient
+
+		#Kept up-to-date with block_added notifications and periodic refreshes:
+		self.blockHeight = None #type: Optional[int]
+		self.blockHeightTime = 0.0 #type: float #time.monotonic() of the last update
+		self.blockHeightTask = None #type: Optional[asyncio.Future]
+
+		self.routeCache = RouteCache() #type: RouteCache
+
+		self.paymentPipeline = paymentpipeline.PaymentPipeline(
+			self.startPayment, self.handlePaymentTimeout,
+			maxInFlight = maxPaymentsInFlight,
+			) #type: paymentpipeline.PaymentPipeline
+
+		self.RPCPath = None #type: Optional[str]
+		self.connectionPool = [self] #type: List[RPCConnection]
+		self.nextPoolIndex = 0 #type: int
+		self.longPollConnections = [] #type: List[RPCConnection]
+		self.pendingLongPollConnections = 0 #type: int #opened by sendOnNewLongPollConnection, but not in longPollConnections yet
+
+
+	async def startupRPC(self) -> None:
+		info = await self.synCall('getinfo') #type: Dict
+		self.nodeID = info['id'] #type: str
+		if 'blockheight' in info:
+			self.setBlockHeight(info['blockheight'])
+
+		JSONRPC.startup(self)
+		self.blockHeightTask = asyncio.ensure_future(self.refreshBlockHeight()) #type: ignore #mypy has weird ideas about ensure_future
+
+
+	async def startupPool(self, RPCPath: str, poolSize: int = DEFAULT_POOL_SIZE) -> None:
+		self.RPCPath = RPCPath
+		while len(self.connectionPool) < poolSize:
+			self.connectionPool.append(await self.openConnection())
+
+
+	async def openConnection(self) -> RPCConnection:
+		assert self.RPCPath is not None
+		reader, writer = await asyncio.open_unix_connection(path=self.RPCPath) #type: ignore #mypy bug: it doesn't know open_unix_connection
+		connection = RPCConnection(self, reader, writer) #type: RPCConnection
+		connection.startup()
+		return connection
+
+
+	async def shutdown(self) -> None:
+		if self.blockHeightTask is not None:
+			self.blockHeightTask.cancel()
+			self.blockHeightTask = None
+		for connection in self.connectionPool[1:] + self.longPollConnections:
+			await connection.shutdown()
+		self.connectionPool = [self]
+		self.longPollConnections = []
+		await JSONRPC.shutdown(self)
+
+
+	def sendStoredRequest(self, message: messages.AnyMessage, name: str, params: Dict[str, Any]) -> None:
+		if name in LONG_POLL_METHODS and self.RPCPath is not None:
+			self.sendLongPollRequest(message, name, params)
+			return
+
+		#Round-robin over the pool:
+		self.connectionPool = [c for c in self.connectionPool if c is self or c.isAlive()]
+		self.nextPoolIndex = (self.nextPoolIndex + 1) % len(self.connectionPool)
+		connection = self.connectionPool[self.nextPoolIndex] #type: RPCConnection
+		RPCConnection.sendStoredRequest(connection, message, name, params)
+
+
+	def sendLongPollRequest(self, message: messages.AnyMessage, name: str, params: Dict[str, Any]) -> None:
+		self.longPollConnections = [c for c in self.longPollConnections if c.isAlive()]
+
+		for connection in self.longPollConnections:
+			if not connection.ongoingRequests:
+				connection.sendStoredRequest(message, name, params)
+				return
+
+		#Connections that are still being opened count too:
+		numConnections = len(self.longPollConnections) + self.pendingLongPollConnections #type: int
+		if numConnections >= MAX_LONG_POLL_CONNECTIONS:
+			if self.longPollConnections:
+				connection = min(self.longPollConnections, key=lambda c: len(c.ongoingRequests))
+				connection.sendStoredRequest(message, name, params)
+			else:
+				RPCConnection.sendStoredRequest(self, message, name, params)
+			return
+
+		self.pendingLongPollConnections += 1
+		asyncio.ensure_future(self.sendOnNewLongPollConnection(message, name, params))
+
+
+	async def sendOnNewLongPollConnection(self, message: messages.AnyMessage, name: str, params: Dict[str, Any]) -> None:
+		try:
+			connection = await self.openConnection() #type: RPCConnection
+		except:
+			logging.exception('Failed to open a new RPC connection; using the main connection:')
+			RPCConnection.sendStoredRequest(self, message, name, params)
+			return
+		finally:
+			self.pendingLongPollConnections -= 1
+		self.longPollConnections.append(connection)
+		connection.sendStoredRequest(message, name, params)
+
+
+	def setBlockHeight(self, blockHeight: int) -> None:
+		#Notifications and getinfo results may arrive out of order:
+		if self.blockHeight is None or blockHeight > self.blockHeight:
+			self.blockHeight = blockHeight
+		self.blockHeightTime = time.monotonic()
+
+
+	def handleBlockAdded(self, message: messages.LNBlockAdded) -> None:
+		self.setBlockHeight(message.height)
+
+
+	async def refreshBlockHeight(self) -> None:
+		'Safety measure, in case block_added notifications are missing.'
+		try:
+			while True:
+				age = time.monotonic() - self.blockHeightTime #type: float
+				if self.blockHeight is None or age >= BLOCKHEIGHT_REFRESH_INTERVAL:
+					self.sendStoredRequest(blockHeightRefreshMessage(height=0), 'getinfo', {})
+					age = 0.0
+				await asyncio.sleep(BLOCKHEIGHT_REFRESH_INTERVAL - age)
+		except asyncio.CancelledError:
+			pass #We're cancelled, so just quit the function
 
 
 	def sendPay(self, message: messages.LNPay) -> None:
 		#TODO (bug 4): check if we're already sending out funds on this
 		#payment hash.
 		#This can be the case, for instance, after a restart.
+		#The pipeline only catches duplicates within this process.
+		self.paymentPipeline.submit(message)
 
-		self.sendStoredRequest(message, 'getroute',
+
+	def startPayment(self, message: messages.LNPay) -> None:
+		route = self.routeCache.get(
+			message.destinationNodeID,
+			message.recipientCryptoAmount,
+			message.minCLTVExpiryDelta,
+			) #type: Optional[List[Dict[str, Any]]]
+		if route is not None and route[0]['msatoshi'] <= message.maxSenderCryptoAmount:
+			self.sendPayOnRoute(message, route)
+			return
+
+		self.sendPaymentRequest(message, 'getroute',
 			{
 			    "id": message.destinationNodeID,
 			    "msatoshi": message.recipientCryptoAmount,
@@ -92,64 +295,78 @@ class RPCInterface(JSONRPC, messages.Handler):
 		#Make sure the LNPay message stays stored!
 
 
+	def sendPaymentRequest(self, message: messages.LNPay, name: str, params: Dict[str, Any]) -> None:
+		self.paymentPipeline.setStage(message.paymentHash, name)
+		self.sendStoredRequest(message, name, params)
+
+
+	def finishPayment(self, message: messages.LNPay, paymentPreimage: Optional[bytes]) -> None:
+		self.paymentPipeline.finish(message.paymentHash)
+		metrics.registry.counter(
+			'rpc.payments.failed' if paymentPreimage is None else 'rpc.payments.succeeded'
+			).increment()
+		self.client.handleIncomingMessage(messages.LNPayResult(
+			localOrderID = message.localOrderID,
+
+			senderCryptoAmount = \
+				message.senderCryptoAmount if isinstance(message, extendedLNPayMessage) else 0,
+			paymentHash = message.paymentHash,
+			paymentPreimage = paymentPreimage, #None indicates error
+			))
+
+
+	def handlePaymentTimeout(self, message: messages.LNPay, stage: str) -> None:
+		if stage in paymentpipeline.ABORTABLE_STAGES:
+			logging.error('Payment timed out in stage %s; canceling it' % stage)
+			self.finishPayment(message, None)
+		else:
+			#The payment may still succeed, so we have to keep waiting.
+			#Ask lightningd (again) about its status; this also re-arms the
+			#timeout.
+			logging.warning('Payment is taking a long time in stage %s' % stage)
+			self.sendWaitSendPay(message)
+
+
 	def handleStoredRequestResult(self, message: messages.AnyMessage, name: str, result: Dict[str, Any]):
 		#We depend on C-Lightning to pass the expected types in result
 
 		messageClass = message.__class__ #type: type
 
+		if isinstance(message, messages.LNPay) and \
+			not self.paymentPipeline.isAtStage(message.paymentHash, name):
+			logging.warning('Ignoring %s result of a payment that was canceled' % name)
+			return
+
 		if (name, messageClass) == ('getroute', messages.LNPay):
 			assert isinstance(message, messages.LNPay) #mypy is stupid
 
 			#TODO: handle getroute failures
 
 			route = result['route'] #type: List[Dict[str, Any]]
-
-			newMessage = extendedLNPayMessage(
-				localOrderID          = message.localOrderID,
-				destinationNodeID     = message.destinationNodeID,
-
-				paymentHash           = message.paymentHash,
-				recipientCryptoAmount = message.recipientCryptoAmount,
-				maxSenderCryptoAmount = message.maxSenderCryptoAmount,
-				minCLTVExpiryDelta    = message.minCLTVExpiryDelta,
-				fiatAmount            = message.fiatAmount,
-				offerID               = message.offerID,
-
-				senderCryptoAmount    = route[0]['msatoshi'],
-				route                 = route,
-				) #type: extendedLNPayMessage
-
-			if newMessage.senderCryptoAmount > message.maxSenderCryptoAmount:
-				#TODO: proper handling of this
-				raise Exception('maxSenderCryptoAmount exceeded')
-			#TODO: check for message.minCLTVExpiryDelta
-
-			self.sendStoredRequest(newMessage, 'getinfo', {})
+			self.routeCache.put(
+				message.destinationNodeID,
+				message.recipientCryptoAmount,
+				message.minCLTVExpiryDelta,
+				route)
+			self.sendPayOnRoute(message, route)
 
 		elif (name, messageClass) == ('getinfo', extendedLNPayMessage):
 			assert isinstance(message, extendedLNPayMessage) #mypy is stupid
 
 			#TODO: check if getinfo was OK
 
-			blockHeight = result['blockheight']
-
-			payload = Payload(message.fiatAmount, message.offerID) #type: Payload
-
-			onionHopsData = onion_utils.makeCreateOnionHopsData(
-				message.route, payload.encode(), blockHeight) #type: List[Dict[str, Any]]
+			self.setBlockHeight(result['blockheight'])
+			self.sendCreateOnion(message, result['blockheight'])
 
-			self.sendStoredRequest(message, 'createonion',
-				{
-				'hops': onionHopsData,
-				'assocdata': message.paymentHash.hex(),
-				})
+		elif (name, messageClass) == ('getinfo', blockHeightRefreshMessage):
+			self.setBlockHeight(result['blockheight'])
 
 		elif (name, messageClass) == ('createonion', extendedLNPayMessage):
 			assert isinstance(message, extendedLNPayMessage) #mypy is stupid
 
 			#TODO: check if createonion was OK
 
-			self.sendStoredRequest(message, 'sendonion',
+			self.sendPaymentRequest(message, 'sendonion',
 				{
 				'onion':          result['onion'],
 				'first_hop':      message.route[0],
@@ -164,10 +381,7 @@ class RPCInterface(JSONRPC, messages.Handler):
 
 			#TODO: check if sendonion was OK
 
-			self.sendStoredRequest(message, 'waitsendpay',
-				{
-				'payment_hash': message.paymentHash.hex(),
-				})
+			self.sendWaitSendPay(message)
 
 		elif (name, messageClass) == ('waitsendpay', extendedLNPayMessage):
 			assert isinstance(message, extendedLNPayMessage) #mypy is stupid
@@ -176,31 +390,79 @@ class RPCInterface(JSONRPC, messages.Handler):
 
 			assert result['status'] == 'complete' #TODO: what else?
 			paymentPreimage = bytes.fromhex(result['payment_preimage']) #type: bytes
-			self.client.handleIncomingMessage(messages.LNPayResult(
-				localOrderID = message.localOrderID,
-
-				senderCryptoAmount = message.senderCryptoAmount,
-				paymentHash = message.paymentHash,
-				paymentPreimage = paymentPreimage,
-				))
+			self.finishPayment(message, paymentPreimage)
 		else:
 			raise Exception('RPCInterface made an error in storing requests')
 
 
-	def handleStoredRequestError(self, message: messages.AnyMessage, name: str, error: int) -> None:
-		messageClass = message.__class__ #type: type
+	def sendPayOnRoute(self, message: messages.LNPay, route: List[Dict[str, Any]]) -> None:
+		newMessage = extendedLNPayMessage(
+			localOrderID          = message.localOrderID,
+			destinationNodeID     = message.destinationNodeID,
 
-		if (name, messageClass, error) == ('waitsendpay', extendedLNPayMessage, 203):
-			assert isinstance(message, extendedLNPayMessage) #mypy is stupid
+			paymentHash           = message.paymentHash,
+			recipientCryptoAmount = message.recipientCryptoAmount,
+			maxSenderCryptoAmount = message.maxSenderCryptoAmount,
+			minCLTVExpiryDelta    = message.minCLTVExpiryDelta,
+			fiatAmount            = message.fiatAmount,
+			offerID               = message.offerID,
 
-			#Recipient refused the transaction
-			self.client.handleIncomingMessage(messages.LNPayResult(
-				localOrderID = message.localOrderID,
+			senderCryptoAmount    = route[0]['msatoshi'],
+			route                 = route,
+			) #type: extendedLNPayMessage
 
-				senderCryptoAmount = message.senderCryptoAmount,
-				paymentHash = message.paymentHash,
-				paymentPreimage = None, #indicates error
-				))
+		if newMessage.senderCryptoAmount > message.maxSenderCryptoAmount:
+			logging.error('Payment canceled: maxSenderCryptoAmount exceeded')
+			self.finishPayment(message, None)
+			return
+		#TODO: check for message.minCLTVExpiryDelta
+
+		if self.blockHeight is None:
+			#Not known yet: ask lightningd
+			self.sendPaymentRequest(newMessage, 'getinfo', {})
 		else:
+			self.sendCreateOnion(newMessage, self.blockHeight)
+
+
+	def sendWaitSendPay(self, message: messages.LNPay) -> None:
+		self.sendPaymentRequest(message, 'waitsendpay',
+			{
+			'payment_hash': message.paymentHash.hex(),
+			})
+
+
+	def sendCreateOnion(self, message: extendedLNPayMessage, blockHeight: int) -> None:
+		payload = Payload(message.fiatAmount, message.offerID) #type: Payload
+
+		onionHopsData = onion_utils.makeCreateOnionHopsData(
+			message.route, payload.encode(), blockHeight) #type: List[Dict[str, Any]]
+
+		self.sendPaymentRequest(message, 'createonion',
+			{
+			'hops': onionHopsData,
+			'assocdata': message.paymentHash.hex(),
+			})
+
+
+	def handleStoredRequestError(self, message: messages.AnyMessage, name: str, error: int) -> None:
+		if not isinstance(message, messages.LNPay):
 			logging.error('Received an unhandled error from a Lightning RPC call!!!')
+			return
+
+		if not self.paymentPipeline.isAtStage(message.paymentHash, name):
+			logging.warning('Ignoring %s error of a payment that was canceled' % name)
+			return
+
+		if name in ('sendonion', 'waitsendpay') and error == PAY_IN_PROGRESS:
+			#The payment was sent, and may still succeed
+			self.sendWaitSendPay(message)
+			return
+
+		#The route may be the cause of the failure; don't use it again
+		self.routeCache.invalidate(message.destinationNodeID)
 
+		#Either nothing was sent yet, or lightningd reports that the payment
+		#has failed (e.g. 203: recipient refused the transaction).
+		#Either way, we give up.
+		logging.error('Payment failed in stage %s with error %s; canceling it' % (name, error))
+		self.finishPayment(message, None)
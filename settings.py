@@ -45,3 +45,9 @@ sellOrderLockedTimeoutRange   = (3600*24, offer.CONDITION_NO_MAX) #seconds
 #by this much.
 maxLightningFee = 0.01
 
+
+#Maximum number of transactions an order can do at the same time.
+maxTransactionsPerOrder = 4 #type: int
+
+#Maximum number of parsed counter offers kept in memory.
+counterOfferCacheSize = 1000 #type: int
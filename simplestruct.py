@@ -15,40 +15,110 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
-from functools import reduce
+from typing import Any, Dict, List, Tuple, TYPE_CHECKING
 
 
 
-class Struct:
-	def __init__(self, **kwargs):
-		self.__elementNames = [e for e in dir(self) if not e.startswith('__')]
-		if set(self.__elementNames) != set(kwargs.keys()):
-	                raise KeyError(
-				'Constructor arguments do not equal structure elements: %s; %s' % \
-				(str(kwargs.keys()), str(self.__elementNames))
-				)
-		for k in kwargs:
-			self.__dict__[k] = kwargs[k]
+class _Missing:
+	def __repr__(self) -> str:
+		return '<missing>'
 
+MISSING = _Missing() #marks a constructor argument that was not given
+
+
+def makeMethod(name: str, source: str) -> Any:
+	namespace = {'MISSING': MISSING} #type: Dict[str, Any]
+	exec(source, namespace)
+	return namespace[name]
+
+
+def makeInit(elementNames: Tuple[str, ...]) -> Any:
+	parameters = ['self'] #type: List[str]
+	if elementNames:
+		parameters += ['*'] + ['%s=MISSING' % k for k in elementNames]
+	parameters.append('**_extra')
+
+	lines = ['def __init__(%s):' % ', '.join(parameters)] #type: List[str]
+	lines.append('\tif _extra%s:' % ''.join(' or %s is MISSING' % k for k in elementNames))
+	lines.append('\t\tself._raiseArgumentError(dict(_extra%s))' % ''.join(', %s=%s' % (k, k) for k in elementNames))
+	lines += ['\tself.%s = %s' % (k, k) for k in elementNames]
+	return makeMethod('__init__', '\n'.join(lines) + '\n')
 
-	def __str__(self):
-		return self.__repr__()
 
-	def __repr__(self):
-		return '%s(%s)' % (
-			self.__class__.__name__,
-			', '.join([
-				'%s=%s' % (k, repr(getattr(self, k)))
-				for k in self.__elementNames
-				])
+def makeEq(elementNames: Tuple[str, ...]) -> Any:
+	return makeMethod('__eq__',
+		'def __eq__(self, obj):\n'
+		'\treturn obj.__class__ is self.__class__%s\n' % \
+		''.join(' and self.%s == obj.%s' % (k, k) for k in elementNames)
+		)
+
+
+def makeRepr(name: str, elementNames: Tuple[str, ...]) -> Any:
+	return makeMethod('__repr__',
+		'def __repr__(self):\n'
+		'\treturn "%s(%s)" %% (%s)\n' % (
+			name,
+			', '.join('%s=%%r' % k for k in elementNames),
+			''.join('self.%s, ' % k for k in elementNames),
 			)
+		)
+
+
+
+class StructMeta(type):
+	'''
+	Turns the class attributes of a Struct class into its elements.
+
+	The list of elements is determined once per class, and the methods
+	that use it are generated for it. Elements are stored in slots, so
+	Struct objects don't have a __dict__.
+	The class attribute values only serve as type declarations: the
+	constructor requires all elements to be given.
+	'''
 
+	def __new__(mcs, name: str, bases: Tuple[type, ...], namespace: Dict[str, Any]) -> 'StructMeta':
+		elementNames = [] #type: List[str]
+		for base in bases:
+			for k in getattr(base, '_elementNames', ()):
+				if k not in elementNames:
+					elementNames.append(k)
 
-	def __eq__(self, obj):
-		return obj.__class__ == self.__class__ and \
-			reduce(lambda x,y: x and y,
-			[
-			getattr(self, k) == getattr(obj, k)
-			for k in self.__elementNames
-			])
+		newElementNames = [
+			k for k, v in namespace.items()
+			if not k.startswith('_') and not callable(v) and not isinstance(v, (staticmethod, classmethod, property))
+			]
+		slots = [] #type: List[str] #inherited elements already have a slot
+		for k in newElementNames:
+			del namespace[k]
+			if k not in elementNames:
+				elementNames.append(k)
+				slots.append(k)
 
+		namespace['__slots__'] = tuple(slots)
+		namespace['_elementNames'] = tuple(elementNames)
+		namespace['__init__'] = makeInit(tuple(elementNames))
+		namespace['__eq__'] = makeEq(tuple(elementNames))
+		namespace['__repr__'] = makeRepr(name, tuple(elementNames))
+
+		return type.__new__(mcs, name, bases, namespace)
+
+
+
+class Struct(metaclass=StructMeta):
+	_elementNames = () #type: Tuple[str, ...]
+
+	if TYPE_CHECKING:
+		#The actual method is generated by StructMeta:
+		def __init__(self, **kwargs: Any) -> None: #pragma: nocover
+			pass
+
+
+	def _raiseArgumentError(self, kwargs: Dict[str, Any]) -> None:
+		raise KeyError(
+			'Constructor arguments do not equal structure elements: %s; %s' % \
+			(str([k for k, v in kwargs.items() if v is not MISSING]), str(list(self._elementNames)))
+			)
+
+
+	def __str__(self) -> str:
+		return self.__repr__()
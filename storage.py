@@ -15,13 +15,72 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import concurrent.futures
+from contextlib import contextmanager
+import hashlib
 import logging
+import queue
 import sqlite3
-from typing import Any, Iterable, List
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 
 
-Cursor = sqlite3.Cursor
+class PendingCursor:
+	'''
+	Cursor-like result of a statement that is executed in the writer thread
+	of an AsyncStorage object.
+
+	The statement results are fetched when the cursor is first used, so
+	accessing them blocks until the writer thread has executed the
+	statement. Callers that don't use the cursor don't wait at all.
+	'''
+
+	def __init__(self, future: concurrent.futures.Future) -> None:
+		self.future = future #type: concurrent.futures.Future
+
+
+	def getResult(self) -> Tuple[List[Any], Any, Any, int]:
+		return self.future.result()
+
+
+	@property
+	def lastrowid(self) -> int:
+		return self.getResult()[2]
+
+
+	@property
+	def description(self) -> Any:
+		return self.getResult()[1]
+
+
+	@property
+	def rowcount(self) -> int:
+		return self.getResult()[3]
+
+
+	def fetchone(self) -> Any:
+		rows = self.getResult()[0] #type: List[Any]
+		return rows.pop(0) if rows else None
+
+
+	def __iter__(self) -> Iterator[Any]:
+		rows = self.getResult()[0] #type: List[Any]
+		while rows:
+			yield rows.pop(0)
+
+
+
+Cursor = Union[sqlite3.Cursor, PendingCursor]
+
+
+
+def getCurrentTask() -> Optional[asyncio.Task]:
+	try:
+		return asyncio.current_task()
+	except RuntimeError: #No running event loop
+		return None
 
 
 
@@ -32,6 +91,20 @@ class StoredObject:
 
 	@staticmethod
 	def createStoredObject(storage: 'Storage', tableName: str, **kwargs) -> int:
+		return StoredObject.insertStoredObject(storage, tableName, **kwargs)['ID']
+
+
+	@staticmethod
+	def insertStoredObject(storage: 'Storage', tableName: str, **kwargs) -> Dict[str, Any]:
+		'''
+		Inserts a new row, and returns its values, including its ID.
+		These can be passed to the constructor, so it doesn't have to load
+		the row again.
+		'''
+		ID = storage.allocateID(tableName) #type: Optional[int]
+		if ID is not None:
+			kwargs['ID'] = ID
+
 		names = list(kwargs.keys()) #type: List[str]
 		values = [kwargs[k] for k in names] #type: List[Any]
 		questionMarks = ','.join(['?'] * len(kwargs)) #type: str
@@ -40,21 +113,37 @@ class StoredObject:
 		query = 'INSERT INTO %s (%s) VALUES (%s)' % (tableName, ','.join(names), questionMarks) #type: str
 
 		cursor = storage.execute(query, values) #type: Cursor
-		ID = cursor.lastrowid #type: int
+		if ID is None:
+			kwargs['ID'] = cursor.lastrowid
+
+		return kwargs
 
-		return ID
 
+	@staticmethod
+	def loadStoredObjects(storage: 'Storage', query: str, values: Iterable[Any] = []) -> List[Dict[str, Any]]:
+		'''
+		Executes a SELECT query, and returns its rows as dictionaries, which
+		can be passed to the constructor.
+		This way, many objects can be loaded with a single query.
+		'''
+		cursor = storage.execute(query, values) #type: Cursor
+		rows = list(cursor) #type: List[Iterable[Any]]
+		names = [x[0] for x in cursor.description] #type: List[Any]
+		return [dict(zip(names, row)) for row in rows]
 
-	def __init__(self, storage: 'Storage', tableName: str, ID: int) -> None:
+
+	def __init__(self, storage: 'Storage', tableName: str, ID: int, values: Optional[Dict[str, Any]] = None) -> None:
 		self._storage = storage #type: Storage
 		self._tableName = tableName #type: str
-		query = 'SELECT * from %s WHERE `ID` = ?' % tableName #type: str
 
-		cursor = self._storage.execute(query, (ID,)) #type: Cursor
-		values = cursor.fetchone() #type: Iterable[Any]
-		names = [x[0] for x in cursor.description] #type: List[Any]
+		if values is None:
+			query = 'SELECT * from %s WHERE `ID` = ?' % tableName #type: str
+			cursor = self._storage.execute(query, (ID,)) #type: Cursor
+			row = cursor.fetchone() #type: Iterable[Any]
+			names = [x[0] for x in cursor.description] #type: List[Any]
+			values = dict(zip(names, row))
 
-		for name, value in zip(names, values):
+		for name, value in values.items():
 			setattr(self, name, value)
 
 
@@ -80,11 +169,137 @@ class StoredObject:
 
 
 
+class DataMigration:
+	'''
+	Migration step that converts existing rows in small batches.
+
+	Each batch is committed separately, so the database is never locked
+	for a long time, even if it contains a lot of history. Since converted
+	rows are committed, an interrupted migration continues where it stopped.
+
+	convertBatch(storage, batchSize) must convert at most batchSize rows
+	that were not converted yet, and return the number of converted rows.
+	'''
+
+	def __init__(self, convertBatch: Callable[['Storage', int], int], batchSize: int = 1000) -> None:
+		self.convertBatch = convertBatch #type: Callable[[Storage, int], int]
+		self.batchSize = batchSize #type: int
+
+
+	@staticmethod
+	def fromQuery(query: str, batchSize: int = 1000) -> 'DataMigration':
+		'''
+		Returns a migration that repeatedly executes query, until it no longer
+		changes anything. The batch size is passed as the single value of
+		the query, e.g. for use in:
+		UPDATE ... WHERE `ID` IN (SELECT `ID` FROM ... WHERE <not converted> LIMIT ?)
+		'''
+		def convertBatch(storage: 'Storage', batchSize: int) -> int:
+			return storage.execute(query, [batchSize]).rowcount
+		return DataMigration(convertBatch, batchSize)
+
+
+	def run(self, storage: 'Storage') -> None:
+		total = 0 #type: int
+		while True:
+			with storage.transaction():
+				count = self.convertBatch(storage, self.batchSize) #type: int
+			if count == 0:
+				break
+			total += count
+			logging.info('Converted %d rows' % total)
+
+
+
+def getContentHash(blob: bytes) -> bytes:
+	return hashlib.sha256(blob).digest()
+
+
+def hashCounterOffers(storage: 'Storage', batchSize: int) -> int:
+	'''
+	Sets the hash of counter offers that don't have one yet.
+	Duplicates are removed; their transactions then refer to the copy that
+	is kept.
+	'''
+	cursor = storage.execute(
+		'SELECT `ID`, `blob` FROM `counterOffers` WHERE `hash` IS NULL LIMIT ?',
+		[batchSize]) #type: Cursor
+	rows = list(cursor) #type: List[Tuple[int, bytes]]
+	for ID, blob in rows:
+		contentHash = getContentHash(blob) #type: bytes
+		existing = storage.execute(
+			'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?',
+			[contentHash]).fetchone() #type: Optional[Tuple[int]]
+		if existing is None:
+			storage.execute(
+				'UPDATE `counterOffers` SET `hash` = ? WHERE `ID` = ?',
+				[contentHash, ID])
+		else:
+			storage.execute(
+				'UPDATE `sellTransactions` SET `counterOffer` = ? WHERE `counterOffer` = ?',
+				[existing[0], ID])
+			storage.execute('DELETE FROM `counterOffers` WHERE `ID` = ?', [ID])
+	return len(rows)
+
+
+
+MigrationStep = Union[str, DataMigration]
+
+#Schema changes on top of the tables created by makeTables.
+#Element i brings the schema from version i to version i+1; the version of
+#a database file is stored in its user_version field.
+#A step is either an SQL statement or a DataMigration.
+#Only ever append to this list: existing databases have already
+#executed the existing elements.
+schemaMigrations = \
+[
+	#Version 1: indexes for the lookups in ordertask.
+	#The transaction ID is part of every index, so these queries don't
+	#need to access the tables themselves.
+	[
+	'CREATE INDEX IF NOT EXISTS `buyTransactions_buyOrder_status` ON `buyTransactions` (`buyOrder`, `status`)',
+	'CREATE INDEX IF NOT EXISTS `buyTransactions_paymentHash` ON `buyTransactions` (`paymentHash`)',
+	'CREATE INDEX IF NOT EXISTS `sellTransactions_sellOrder_status` ON `sellTransactions` (`sellOrder`, `status`)',
+	],
+
+	#Version 2: content-addressed counter offers.
+	[
+	'ALTER TABLE `counterOffers` ADD COLUMN `hash` BLOB',
+	'CREATE UNIQUE INDEX IF NOT EXISTS `counterOffers_hash` ON `counterOffers` (`hash`)',
+	'CREATE INDEX IF NOT EXISTS `sellTransactions_counterOffer` ON `sellTransactions` (`counterOffer`)',
+	DataMigration(hashCounterOffers),
+	],
+
+	#Version 3: archive tables.
+	#Archive tables have the same columns as the tables they archive.
+	[
+	'CREATE TABLE IF NOT EXISTS `archivedBuyOrders` AS SELECT * FROM `buyOrders` WHERE 0',
+	'CREATE TABLE IF NOT EXISTS `archivedSellOrders` AS SELECT * FROM `sellOrders` WHERE 0',
+	'CREATE TABLE IF NOT EXISTS `archivedBuyTransactions` AS SELECT * FROM `buyTransactions` WHERE 0',
+	'CREATE TABLE IF NOT EXISTS `archivedSellTransactions` AS SELECT * FROM `sellTransactions` WHERE 0',
+	'CREATE INDEX IF NOT EXISTS `archivedBuyTransactions_buyOrder` ON `archivedBuyTransactions` (`buyOrder`)',
+	'CREATE INDEX IF NOT EXISTS `archivedBuyTransactions_paymentHash` ON `archivedBuyTransactions` (`paymentHash`)',
+	'CREATE INDEX IF NOT EXISTS `archivedSellTransactions_sellOrder` ON `archivedSellTransactions` (`sellOrder`)',
+	],
+] #type: List[List[MigrationStep]]
+
+
+
 class Storage:
-	def __init__(self, filename: str) -> None:
+	def __init__(self, filename: str, WAL: bool = False) -> None:
 		self.connection = sqlite3.connect(filename) #type: sqlite3.Connection
+		self.transactionDepth = 0 #type: int
+		#Only takes effect on new database files; the archiver converts
+		#existing ones.
+		self.execute('PRAGMA auto_vacuum = INCREMENTAL')
+		if WAL:
+			#With a write-ahead log, readers don't block the writer, and a
+			#commit only appends to the log instead of syncing the DB file.
+			self.execute('PRAGMA journal_mode = WAL')
+			self.execute('PRAGMA synchronous = NORMAL')
 		self.execute('PRAGMA foreign_keys = ON')
 		self.makeTables()
+		self.migrate()
 
 
 	def shutdown(self) -> None:
@@ -92,7 +307,7 @@ class Storage:
 
 
 	def makeTables(self) -> None:
-		cursor = self.connection.cursor() #type: Cursor
+		cursor = self.connection.cursor() #type: sqlite3.Cursor
 		cursor.execute(
 			'CREATE TABLE IF NOT EXISTS `configuration` ('
 			'	`name`  TEXT,'
@@ -160,14 +375,293 @@ class Storage:
 		self.connection.commit()
 
 
+	def getSchemaVersion(self) -> int:
+		cursor = self.connection.execute('PRAGMA user_version') #type: sqlite3.Cursor
+		return cursor.fetchone()[0]
+
+
+	def migrate(self) -> None:
+		'''
+		Brings the schema up to date, by executing the migrations that were
+		not yet executed on this database.
+		The new version number is only stored after all steps of a
+		migration are executed, so an interrupted migration is re-done on the
+		next startup. Therefore, the steps must be idempotent.
+		'''
+		version = self.getSchemaVersion() #type: int
+		if version > len(schemaMigrations):
+			raise Exception(
+				'The database has schema version %d; this software only supports up to version %d' % \
+				(version, len(schemaMigrations)))
+
+		for newVersion in range(version+1, len(schemaMigrations)+1):
+			logging.info('Migrating the database to schema version %d' % newVersion)
+			for step in schemaMigrations[newVersion-1]:
+				if isinstance(step, DataMigration):
+					step.run(self)
+				else:
+					try:
+						self.execute(step)
+					except sqlite3.OperationalError as e:
+						#ALTER TABLE ... ADD COLUMN has no IF NOT EXISTS,
+						#so this is how it is made idempotent:
+						if not str(e).startswith('duplicate column name'):
+							raise
+			#PRAGMA doesn't support parameters:
+			self.execute('PRAGMA user_version = %d' % newVersion)
+
+
+	@contextmanager
+	def transaction(self) -> Iterator[None]:
+		'''
+		Groups all statements executed inside the with-block into a single
+		commit. If an exception leaves the outermost block, all of its
+		statements are rolled back. Blocks may be nested; only the
+		outermost one commits.
+
+		The block must not contain any await: other tasks would otherwise
+		get their statements mixed into this transaction.
+		'''
+		self.transactionDepth += 1
+		try:
+			yield
+		except:
+			self.transactionDepth -= 1
+			if self.transactionDepth == 0:
+				self.rollback()
+			raise
+		self.transactionDepth -= 1
+		if self.transactionDepth == 0:
+			self.commit()
+
+
+	def commit(self) -> None:
+		self.connection.commit()
+
+
+	def rollback(self) -> None:
+		self.connection.rollback()
+
+
 	def execute(self, query: str, values: Iterable[Any] = []) -> Cursor:
+		cursor = self._executeNoCommit(query, values) #type: sqlite3.Cursor
+		if self.transactionDepth == 0:
+			self.commit()
+		return cursor
+
+
+	def _executeNoCommit(self, query: str, values: Iterable[Any] = []) -> sqlite3.Cursor:
 		logging.debug('SQL query %s; values %s' % (query, values))
-		cursor = self.connection.cursor() #type: Cursor
+		cursor = self.connection.cursor() #type: sqlite3.Cursor
 		cursor.execute(query, values)
-		self.connection.commit()
 		return cursor
 
 
+	def executeRead(self, query: str, values: Iterable[Any] = []) -> Cursor:
+		'''
+		Executes a SELECT query on the committed data, without waiting for
+		statements that are not committed yet.
+		'''
+		return self.execute(query, values)
+
+
+	def allocateID(self, tableName: str) -> Optional[int]:
+		'''
+		Returns the ID for a new row in tableName, or None if the ID is to
+		be assigned by the database when the row is inserted.
+		'''
+		return None #The ID of an insert is available immediately
+
+
+	async def flush(self) -> None:
+		'Wait until all previously executed statements are stored on disk.'
+		pass #All statements are executed synchronously; nothing to wait for
+
+
+
+class AsyncStorage(Storage):
+	'''
+	Storage front-end that executes all writes in a dedicated writer thread,
+	so that commits (and their disk flushes) don't block the asyncio event
+	loop.
+
+	Writes are put in a request queue and return immediately with a
+	PendingCursor. Reads are served from a separate read connection,
+	unless there are writes that have not been committed yet: in that case
+	they are queued behind those writes, so that they see their results.
+
+	Coroutines can await flush() to make sure that their writes are stored
+	before they perform any externally visible action. If a transaction
+	failed, flush() raises its exception in the task that did the
+	transaction.
+
+	IDs of new rows are allocated here instead of by the database, so they
+	are known without waiting for the insert. Therefore, all inserts into
+	tables with stored objects must use allocateID.
+	'''
+
+	writerThread = None #type: Optional[threading.Thread]
+
+	def __init__(self, filename: str) -> None:
+		#The read connection.
+		#As long as there is no writer thread, it also executes writes, so
+		#this creates the tables synchronously.
+		Storage.__init__(self, filename, WAL=True)
+
+		self.writeQueue = queue.Queue() #type: queue.Queue
+		self.lastWrite = concurrent.futures.Future() #type: concurrent.futures.Future
+		self.lastWrite.set_result(None)
+		self.writerTransactionError = None #type: Optional[Exception] #only used in the writer thread
+		#Commits that were not yet reported by flush(), with the task that did them:
+		self.unreportedCommits = [] #type: List[Tuple[Optional[asyncio.Task], concurrent.futures.Future]]
+		self.nextIDs = {} #type: Dict[str, int]
+
+		self.writerThread = threading.Thread(
+			target=self.writerMain, args=(filename,),
+			name='storage writer',
+			) #type: threading.Thread
+		self.writerThread.start()
+
+
+	def shutdown(self) -> None:
+		assert self.writerThread is not None
+		self.writeQueue.put(None)
+		self.writerThread.join()
+		Storage.shutdown(self)
+
+
+	def writerMain(self, filename: str) -> None:
+		connection = sqlite3.connect(filename) #type: sqlite3.Connection
+		connection.execute('PRAGMA synchronous = NORMAL')
+		connection.execute('PRAGMA foreign_keys = ON')
+
+		while True:
+			item = self.writeQueue.get() #type: Optional[Tuple[Callable[[sqlite3.Connection], Any], concurrent.futures.Future]]
+			if item is None:
+				break
+			function, future = item
+			try:
+				future.set_result(function(connection))
+			except Exception as e:
+				logging.exception('Exception in the storage writer thread:')
+				future.set_exception(e)
+
+		connection.close()
+
+
+	def submit(self, function: Callable[[sqlite3.Connection], Any]) -> concurrent.futures.Future:
+		future = concurrent.futures.Future() #type: concurrent.futures.Future
+		self.lastWrite = future
+		self.writeQueue.put((function, future))
+		return future
+
+
+	def commit(self) -> None:
+		if self.writerThread is None:
+			return Storage.commit(self)
+
+		def function(connection: sqlite3.Connection) -> None:
+			#Nobody is waiting for the results of statements inside a
+			#transaction, so this is where their failure is handled:
+			error = self.writerTransactionError #type: Optional[Exception]
+			if error is not None:
+				self.writerTransactionError = None
+				connection.rollback()
+				raise Exception(
+					'A statement in the transaction failed; the transaction was rolled back: %s' % error
+					) from error
+			connection.commit()
+
+		self.unreportedCommits.append((getCurrentTask(), self.submit(function)))
+
+
+	def rollback(self) -> None:
+		if self.writerThread is None:
+			return Storage.rollback(self)
+
+		def function(connection: sqlite3.Connection) -> None:
+			self.writerTransactionError = None
+			connection.rollback()
+
+		self.submit(function)
+
+
+	def execute(self, query: str, values: Iterable[Any] = []) -> Cursor:
+		if self.writerThread is None:
+			return Storage.execute(self, query, values)
+
+		#Reads on the read connection don't need a commit; committing here
+		#would queue a commit in the writer thread.
+		isRead = query.lstrip().upper().startswith('SELECT') #type: bool
+		if isRead and self.transactionDepth == 0 and self.lastWrite.done():
+			return self._executeNoCommit(query, values)
+
+		logging.debug('SQL query (queued) %s; values %s' % (query, values))
+		inTransaction = self.transactionDepth > 0 #type: bool
+		valueList = list(values) #type: List[Any]
+
+		def function(connection: sqlite3.Connection) -> Tuple[List[Any], Any, Any, int]:
+			cursor = connection.cursor() #type: sqlite3.Cursor
+			try:
+				cursor.execute(query, valueList)
+			except Exception as e:
+				if inTransaction:
+					self.writerTransactionError = e
+				else:
+					connection.rollback()
+				raise
+			if not inTransaction:
+				connection.commit()
+			return cursor.fetchall(), cursor.description, cursor.lastrowid, cursor.rowcount
+
+		return PendingCursor(self.submit(function))
+
+
+	def executeRead(self, query: str, values: Iterable[Any] = []) -> Cursor:
+		return self._executeNoCommit(query, values)
+
+
+	def allocateID(self, tableName: str) -> Optional[int]:
+		try:
+			ID = self.nextIDs[tableName] #type: int
+		except KeyError:
+			#Only done once per table, so waiting for queued writes is OK:
+			cursor = self.execute('SELECT MAX(`ID`) FROM `%s`' % tableName) #type: Cursor
+			maxID = cursor.fetchone()[0] #type: Optional[int]
+			ID = 1 if maxID is None else maxID + 1
+		self.nextIDs[tableName] = ID + 1
+		return ID
+
+
+	async def flush(self) -> None:
+		'''
+		Wait until all previously queued statements are committed.
+		Raises the exception of a failed transaction of the current task.
+		'''
+		try:
+			await asyncio.wrap_future(self.lastWrite)
+		except Exception:
+			pass #Already logged by the writer thread; failed commits are handled below
+
+		task = getCurrentTask() #type: Optional[asyncio.Task]
+		error = None #type: Optional[BaseException]
+		remaining = [] #type: List[Tuple[Optional[asyncio.Task], concurrent.futures.Future]]
+		for opener, future in self.unreportedCommits:
+			if not future.done():
+				remaining.append((opener, future))
+			elif future.exception() is None:
+				pass #Committed
+			elif opener is task or opener is None or opener.done():
+				#Failures outside tasks, or of finished tasks, are reported
+				#to the first task that flushes.
+				error = error or future.exception()
+			else:
+				remaining.append((opener, future))
+		self.unreportedCommits = remaining
+		if error is not None:
+			raise error
+
+
 
 def main(): #pragma: nocover
 	s = Storage('node0.bl4p.db') #type: Storage
@@ -0,0 +1,149 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import sys
+import unittest
+from unittest.mock import patch, Mock
+
+from utils import asynciotest
+
+sys.path.append('..')
+
+import archiver
+import storage
+
+
+
+class TestArchiver(unittest.TestCase):
+	def setUp(self):
+		self.filename = '_test_archiver.db'
+		try:
+			os.remove(self.filename)
+		except FileNotFoundError:
+			pass
+		self.storage = storage.Storage(self.filename)
+		self.archiver = archiver.Archiver(self.storage, interval=0.01, batchSize=2)
+
+
+	def tearDown(self):
+		self.storage.shutdown()
+		os.remove(self.filename)
+
+
+	def getIDs(self, table):
+		return [row[0] for row in self.storage.execute('SELECT `ID` FROM `%s` ORDER BY `ID`' % table)]
+
+
+	@asynciotest
+	async def test_archiveAll(self):
+		#order ID, status:
+		for ID, status in [(1, 1), (2, 0), (3, 1), (4, 3), (5, 2), (6, 3)]:
+			self.storage.execute('INSERT INTO `buyOrders` (`ID`, `status`) VALUES (?, ?)', [ID, status])
+			self.storage.execute('INSERT INTO `sellOrders` (`ID`, `status`) VALUES (?, ?)', [ID, status])
+		#transaction ID, order ID, status:
+		for ID, orderID, status in [(11, 1, 4), (12, 1, 5), (13, 2, 4), (14, 3, 4), (15, 3, 2), (16, 2, 1), (17, 5, 4), (18, 2, 5), (19, 6, 5)]:
+			self.storage.execute('INSERT INTO `buyTransactions` (`ID`, `buyOrder`, `status`, `paymentHash`) VALUES (?, ?, ?, ?)', [ID, orderID, status, b'%d' % ID])
+			self.storage.execute('INSERT INTO `sellTransactions` (`ID`, `sellOrder`, `status`) VALUES (?, ?, ?)', [ID, orderID, status])
+
+		with patch.object(self.archiver, 'archiveBatch', Mock(wraps=self.archiver.archiveBatch)) as archiveBatch:
+			with patch.object(self.storage, 'execute', Mock(wraps=self.storage.execute)) as execute:
+				self.assertEqual(await self.archiver.archiveAll(), 2*(6+2))
+
+		#Each table ends with a batch that archives nothing:
+		self.assertEqual(archiveBatch.call_count, 4 + 2*3 + 2*1)
+		execute.assert_called_with('PRAGMA incremental_vacuum(1000)')
+
+		#Unfinished transactions and the one with the highest ID remain:
+		for table in ['buyTransactions', 'sellTransactions']:
+			self.assertEqual(self.getIDs(table), [15, 16, 19])
+			self.assertEqual(self.getIDs('archived' + table[0].upper() + table[1:]), [11, 12, 13, 14, 17, 18])
+
+		#Unfinished orders, orders with remaining transactions and the one
+		#with the highest ID remain:
+		for table in ['buyOrders', 'sellOrders']:
+			self.assertEqual(self.getIDs(table), [2, 3, 5, 6])
+			self.assertEqual(self.getIDs('archived' + table[0].upper() + table[1:]), [1, 4])
+
+		#Archived rows are complete:
+		self.assertEqual(list(self.storage.execute('SELECT `ID`, `buyOrder`, `status`, `paymentHash` FROM `archivedBuyTransactions` WHERE `ID` = 14')),
+			[(14, 3, 4, b'14')])
+
+		#Nothing left to archive:
+		with patch.object(self.storage, 'execute', Mock(wraps=self.storage.execute)) as execute:
+			self.assertEqual(await self.archiver.archiveAll(), 0)
+		self.assertNotIn('PRAGMA incremental_vacuum(1000)', [c[0][0] for c in execute.call_args_list])
+
+		#New rows don't get the IDs of archived rows:
+		cursor = self.storage.execute('INSERT INTO `buyTransactions` (`buyOrder`, `status`) VALUES (2, 0)')
+		self.assertEqual(cursor.lastrowid, 20)
+
+
+	def test_incrementalVacuum(self):
+		self.assertEqual(list(self.storage.execute('PRAGMA auto_vacuum')), [(2,)])
+
+
+	@asynciotest
+	async def test_enableIncrementalVacuum(self):
+		#An old database, without incremental vacuum:
+		self.storage.execute('PRAGMA auto_vacuum = NONE')
+		self.storage.execute('VACUUM')
+		self.assertEqual(list(self.storage.execute('PRAGMA auto_vacuum')), [(0,)])
+
+		for ID in [1, 2]:
+			self.storage.execute('INSERT INTO `buyOrders` (`ID`, `status`) VALUES (?, 3)', [ID])
+		with self.assertLogs(level='WARNING'):
+			self.assertEqual(await self.archiver.archiveAll(), 1)
+		self.assertEqual(list(self.storage.execute('PRAGMA auto_vacuum')), [(2,)])
+
+		#Converted only once:
+		self.storage.execute('INSERT INTO `buyOrders` (`ID`, `status`) VALUES (3, 3)')
+		with patch.object(self.storage, 'execute', Mock(wraps=self.storage.execute)) as execute:
+			self.assertEqual(await self.archiver.archiveAll(), 1)
+		self.assertNotIn('VACUUM', [c[0][0] for c in execute.call_args_list])
+
+
+	@asynciotest
+	async def test_run(self):
+		calls = []
+		async def archiveAll():
+			calls.append(1)
+			if len(calls) == 1:
+				raise Exception('Test exception')
+			return 0
+
+		with patch.object(self.archiver, 'archiveAll', archiveAll):
+			self.archiver.startup()
+			await asyncio.sleep(0.05)
+
+			#Exceptions don't stop archiving:
+			self.assertGreater(len(calls), 2)
+
+			await self.archiver.shutdown()
+			self.assertEqual(self.archiver.task, None)
+			count = len(calls)
+			await asyncio.sleep(0.03)
+			self.assertEqual(len(calls), count)
+
+		#Shutdown without startup:
+		await self.archiver.shutdown()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -34,10 +34,12 @@ import ordertask
 
 
 class MockOrderTask:
-	def __init__(self, client, storage, order):
+	def __init__(self, client, storage, order, unfinishedTransactions=None, counterOffers={}):
 		self.client = client
 		self.storage = storage
 		self.order = order
+		self.unfinishedTransactions = unfinishedTransactions
+		self.counterOffers = counterOffers
 		self.started = False
 
 
@@ -94,6 +96,9 @@ class TestBackend(unittest.TestCase):
 		self.backend.setBL4PAddress('BL4PAddress')
 		self.assertEqual(self.backend.BL4PAddress, 'BL4PAddress')
 
+		counterOffer = order.BuyOrder(MockStorage(test=self), 0, 'buyerAddress',
+			{'ID': 0, 'amount': 1000, 'limitRate': 10000})
+
 		def initStorage(s):
 			s.sellOrders = \
 			{
@@ -102,12 +107,21 @@ class TestBackend(unittest.TestCase):
 				'ID': 41,
 				'amount': 123,
 				'limitRate': 20000,
+				'status': 0,
 				},
 			42:
 				{
 				'ID': 42,
 				'amount': 456,
 				'limitRate': 21000,
+				'status': 2,
+				},
+			43:
+				{
+				'ID': 43,
+				'amount': 456,
+				'limitRate': 21000,
+				'status': 1,
 				},
 			}
 			s.buyOrders = \
@@ -117,13 +131,34 @@ class TestBackend(unittest.TestCase):
 				'ID': 51,
 				'amount': 789,
 				'limitRate': 10000,
+				'status': 0,
 				},
 			}
+			s.sellTransactions = \
+			{
+			61: {'ID': 61, 'sellOrder': 41, 'counterOffer': 81, 'status': 1},
+			62: {'ID': 62, 'sellOrder': 41, 'counterOffer': 82, 'status': 4},
+			63: {'ID': 63, 'sellOrder': 43, 'counterOffer': 82, 'status': 1},
+			}
+			s.buyTransactions = \
+			{
+			71: {'ID': 71, 'buyOrder': 51, 'status': 2},
+			72: {'ID': 72, 'buyOrder': 51, 'status': 5},
+			}
+			s.counterOffers = \
+			{
+			81: {'ID': 81, 'blob': counterOffer.toPB2().SerializeToString()},
+			82: {'ID': 82, 'blob': b'invalid'},
+			}
 
 		MS = functools.partial(MockStorage, test=self, init=initStorage)
-		with patch.object(backend.storage, 'Storage', MS):
+		with patch.object(backend.storage, 'AsyncStorage', MS):
 			with patch.object(backend.ordertask, 'OrderTask', MockOrderTask):
-				self.backend.startup('foo.file')
+				with patch.object(backend.archiver, 'Archiver', Mock()) as Archiver:
+					self.backend.startup('foo.file')
+
+		Archiver.assert_called_once_with(self.backend.storage)
+		self.backend.archiver.startup.assert_called_once_with()
 
 		self.assertTrue(isinstance(self.backend.storage, MockStorage))
 		self.assertEqual(self.backend.storage.DBFile, 'foo.file')
@@ -146,6 +181,19 @@ class TestBackend(unittest.TestCase):
 			self.assertEqual(self.backend.storage.buyOrders[ID]['amount'], self.backend.orderTasks[ID].order.amount)
 			self.assertEqual(self.backend.storage.buyOrders[ID]['limitRate'], self.backend.orderTasks[ID].order.limitRate)
 
+		#Unfinished transactions and their counter offers are pre-loaded:
+		def getTransactionIDs(ID):
+			return [tx.ID for tx in self.backend.orderTasks[ID].unfinishedTransactions]
+		self.assertEqual(getTransactionIDs(41), [61])
+		self.assertEqual(getTransactionIDs(42), [])
+		self.assertEqual(getTransactionIDs(51), [71])
+		self.assertTrue(isinstance(self.backend.orderTasks[41].unfinishedTransactions[0], ordertask.SellTransaction))
+		self.assertTrue(isinstance(self.backend.orderTasks[51].unfinishedTransactions[0], ordertask.BuyTransaction))
+		counterOffers = self.backend.orderTasks[41].counterOffers
+		self.assertEqual(set(counterOffers.keys()), set([81]))
+		self.assertEqual(counterOffers[81].bid.max_amount, counterOffer.bid.max_amount)
+		self.assertEqual(counterOffers[81].ask.max_amount, counterOffer.ask.max_amount)
+
 
 	@asynciotest
 	async def test_shutdown(self):
@@ -159,9 +207,14 @@ class TestBackend(unittest.TestCase):
 
 		self.backend.storage = Mock()
 
+		self.backend.archiver = Mock()
+		async def archiverShutdown():
+			count.append(2)
+		self.backend.archiver.shutdown = archiverShutdown
+
 		await self.backend.shutdown()
 
-		self.assertEqual(len(count), 2)
+		self.assertEqual(count, [1, 1, 2])
 		self.backend.storage.shutdown.assert_called_with()
 
 
@@ -426,6 +479,17 @@ class TestBackend(unittest.TestCase):
 
 		self.backend.orderTasks[41].setCallResult.assert_called_with(result)
 
+		#Unexpected results are ignored:
+		self.backend.orderTasks[41].setCallResult = Mock(side_effect=ordertask.UnexpectedResult())
+		with patch.object(logging, 'exception', Mock()) as logException:
+			self.backend.handleBL4PResult(result)
+			logException.assert_called()
+
+		result.request.localOrderID = 40
+		with patch.object(logging, 'warning', Mock()) as logWarning:
+			self.backend.handleBL4PResult(result)
+			logWarning.assert_called()
+
 
 	def test_handleLNIncoming(self):
 		msg = Mock()
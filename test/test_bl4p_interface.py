@@ -30,6 +30,7 @@ from bl4p_api.offer import Offer, Asset
 from bl4p_api.serialization import serialize
 
 import messages
+import metrics
 import bl4p_interface
 Bl4pApi = bl4p_interface.bl4p.Bl4pApi
 
@@ -78,19 +79,50 @@ class TestBL4PInterface(unittest.TestCase):
 			synCallArgs.append(args)
 			return synCallResult.pop(0)
 
-		o1 = Mock()
-		o1.offerID = 42
-		o2 = Mock()
-		o2.offerID = 43
-		listOffersResult = Mock()
-		listOffersResult.offers = [o1, o2]
+		def makeOffer(ID, bidAmount):
+			return Offer(
+				bid = Asset(bidAmount, 100, 'eur', 'bl3p.eu'),
+				ask = Asset(4321, 100000, 'btc', 'ln'),
+				address = 'bar',
+				ID = ID,
+				)
+
+		def makeSellOffer(ID):
+			return Offer(
+				bid = Asset(4321, 100000, 'btc', 'ln'),
+				ask = Asset(1234, 100, 'eur', 'bl3p.eu'),
+				address = 'bar',
+				ID = ID,
+				)
+
+		#Order 1 would publish the same offer: keep it
+		#Order 2 would publish a different offer: remove it
+		#Order 3 doesn't exist: remove it
+		#Order 4 doesn't have an offer on BL4P
+		#Sell order 1 has the same ID as buy order 1: keep it too
+		localOrders = [makeOffer(1, 1234), makeOffer(2, 1234), makeOffer(4, 1234), makeSellOffer(1)]
+		for o in localOrders:
+			o.remoteOfferID = None
+		self.client.backend.orderTasks = {}
+		for i, o in enumerate(localOrders):
+			task = Mock()
+			task.order = o
+			self.client.backend.orderTasks[i] = task
+
+		listOffersResult = bl4p_pb2.BL4P_ListOffersResult()
+		for offerID, o in [(41, makeOffer(1, 1234)), (42, makeOffer(2, 2345)), (43, makeOffer(3, 1234)), (44, makeSellOffer(1))]:
+			item = listOffersResult.offers.add()
+			item.offerID = offerID
+			item.offer.CopyFrom(o.toPB2())
 		synCallResult.append(listOffersResult) #ListOffers return value
 		synCallResult.append(None) #RemoveOffer return value
 		synCallResult.append(None) #RemoveOffer return value
 
+		registry = metrics.Registry()
 		with patch.object(Bl4pApi, 'startup', startup):
 			with patch.object(self.interface, 'synCall', synCall):
-				await self.interface.startupInterface('foo', 'bar', 'baz', 'baa')
+				with patch.object(metrics, 'registry', registry):
+					await self.interface.startupInterface('foo', 'bar', 'baz', 'baa')
 
 		self.assertEqual(self.interface.key, 'baa')
 		self.assertEqual(startupArgs, [(self.interface, 'foo', 'bar', 'baz')])
@@ -104,6 +136,56 @@ class TestBL4PInterface(unittest.TestCase):
 		self.assertEqual(synCallArgs[1][0].offerID, 42)
 		self.assertEqual(synCallArgs[2][0].offerID, 43)
 
+		self.assertEqual([o.remoteOfferID for o in localOrders], [41, None, None, 44])
+		self.assertTrue(self.interface.coldStartTime >= 0)
+		self.assertEqual(registry.gauge('bl4p.coldStartTime').value, self.interface.coldStartTime)
+
+
+	@asynciotest
+	async def test_synCall(self):
+		requestIDs = iter([6, 7])
+		self.interface.sendRequest = Mock(side_effect=lambda msg: next(requestIDs))
+
+		incoming = asyncio.Queue()
+		self.interface.websocket = Mock()
+		self.interface.websocket.recv = incoming.get
+		regularResults = []
+		self.interface.handleResult = regularResults.append
+
+		receiveTask = asyncio.ensure_future(self.interface.handleIncomingData())
+
+		#Concurrent calls:
+		call1 = asyncio.ensure_future(self.interface.synCall(bl4p_pb2.BL4P_ListOffers()))
+		call2 = asyncio.ensure_future(self.interface.synCall(bl4p_pb2.BL4P_RemoveOffer()))
+		await asyncio.sleep(0)
+		self.assertEqual(set(self.interface.ongoingCalls.keys()), {6, 7})
+
+		#Results may arrive in any order:
+		result2 = bl4p_pb2.BL4P_RemoveOfferResult()
+		result2.request = 7
+		result1 = bl4p_pb2.BL4P_ListOffersResult()
+		result1.request = 6
+		other = bl4p_pb2.BL4P_StartResult()
+		other.request = 5
+		with patch.object(bl4p_interface.bl4p, 'deserialize', lambda x: x):
+			await incoming.put(result2)
+			await incoming.put(other)
+			await incoming.put(result1)
+			self.assertEqual(await call1, result1)
+			self.assertEqual(await call2, result2)
+
+		self.assertEqual(regularResults, [other])
+		self.assertEqual(self.interface.ongoingCalls, {})
+
+		#Closing the connection fails ongoing calls:
+		call3 = asyncio.ensure_future(self.interface.synCall(bl4p_pb2.BL4P_ListOffers()))
+		await asyncio.sleep(0)
+		await incoming.put(None)
+		await receiveTask
+		with self.assertRaises(Exception):
+			await call3
+		self.assertEqual(self.interface.ongoingCalls, {})
+
 
 	def doSingleSendTest(self, msgIn, expectedMsgOut):
 		self.interface.sendRequest = Mock(return_value=6)
@@ -204,7 +286,8 @@ class TestBL4PInterface(unittest.TestCase):
 		self.doSingleSendTest(msgIn, expectedMsgOut)
 
 
-	def test_sendFindOffers(self):
+	@asynciotest
+	async def test_sendFindOffers(self):
 		query = Offer(
 			bid = Asset(1234, 100, 'eur', 'bl3p.eu'),
 			ask = Asset(4321, 100000, 'btc', 'ln'),
@@ -217,7 +300,181 @@ class TestBL4PInterface(unittest.TestCase):
 			)
 		expectedMsgOut = bl4p_pb2.BL4P_FindOffers()
 		expectedMsgOut.query.CopyFrom(query.toPB2())
-		self.doSingleSendTest(msgIn, expectedMsgOut)
+
+		self.interface.sendRequest = Mock(return_value=6)
+		self.interface.handleMessage(msgIn)
+
+		#Only sent in the next event loop iteration:
+		self.interface.sendRequest.assert_not_called()
+		await asyncio.sleep(0)
+
+		self.interface.sendRequest.assert_called_once_with(expectedMsgOut)
+		self.assertEqual(self.interface.activeFindOffers[6].messages, [msgIn])
+		self.assertEqual(self.interface.activeFindOffersIDs,
+			{bl4p_interface.getQueryShape(query): 6})
+		self.assertEqual(self.interface.activeRequests, {})
+
+
+	@asynciotest
+	async def test_sendFindOffers_failure(self):
+		query = Offer(
+			bid = Asset(1234, 100, 'eur', 'bl3p.eu'),
+			ask = Asset(4321, 100000, 'btc', 'ln'),
+			address = 'bar',
+			ID = 42,
+			)
+		msgIn1 = messages.BL4PFindOffers(localOrderID = 0, query = query)
+		msgIn2 = messages.BL4PFindOffers(localOrderID = 1, query = query)
+
+		self.interface.sendRequest = Mock(side_effect=Exception('Connection lost'))
+		self.interface.handleMessage(msgIn1)
+		self.interface.handleMessage(msgIn2)
+		await asyncio.sleep(0)
+
+		#Every sender gets an error:
+		self.assertEqual(self.client.handleIncomingMessage.call_count, 2)
+		for call, msgIn in zip(self.client.handleIncomingMessage.call_args_list, [msgIn1, msgIn2]):
+			msgOut = call[0][0]
+			self.assertTrue(isinstance(msgOut, messages.BL4PError))
+			self.assertIs(msgOut.request, msgIn)
+		self.assertEqual(self.interface.activeFindOffers, {})
+		self.assertEqual(self.interface.activeFindOffersIDs, {})
+
+
+	@asynciotest
+	async def test_sendFindOffers_coalesced(self):
+		def makeQuery(bidAmount, sender_timeout=None):
+			return Offer(
+				bid = Asset(bidAmount, 100, 'eur', 'bl3p.eu'),
+				ask = Asset(4321, 100000, 'btc', 'ln'),
+				address = 'bar',
+				ID = 42,
+				sender_timeout = sender_timeout,
+				)
+		def makeMessage(query):
+			return messages.BL4PFindOffers(
+				localOrderID = 0,
+				query = query,
+				)
+
+		narrow = makeMessage(makeQuery(1000))
+		wide = makeMessage(makeQuery(2000))
+		other = makeMessage(makeQuery(1000, sender_timeout=(1000, 2000)))
+
+		requestIDs = iter([6, 7, 8])
+		sent = []
+		def sendRequest(request):
+			sent.append(request)
+			return next(requestIDs)
+		self.interface.sendRequest = sendRequest
+
+		#Same shape in the same iteration: one request, with the widest query
+		self.interface.handleMessage(narrow)
+		self.interface.handleMessage(wide)
+		self.interface.handleMessage(other)
+		await asyncio.sleep(0)
+
+		self.assertEqual(len(sent), 2)
+		self.assertEqual(sent[0].query, wide.query.toPB2())
+		self.assertEqual(sent[1].query, other.query.toPB2())
+		self.assertEqual(self.interface.activeFindOffers[6].messages, [narrow, wide])
+		self.assertEqual(self.interface.activeFindOffers[7].messages, [other])
+
+		#Joins the ongoing request, if that is at least as wide:
+		narrow2 = makeMessage(makeQuery(1500))
+		self.interface.handleMessage(narrow2)
+		await asyncio.sleep(0)
+		self.assertEqual(len(sent), 2)
+		self.assertEqual(self.interface.activeFindOffers[6].messages, [narrow, wide, narrow2])
+
+		#Otherwise, a new request is sent:
+		wider = makeMessage(makeQuery(3000))
+		self.interface.handleMessage(wider)
+		await asyncio.sleep(0)
+		self.assertEqual(len(sent), 3)
+		self.assertEqual(sent[2].query, wider.query.toPB2())
+		self.assertEqual(self.interface.activeFindOffers[8].messages, [wider])
+		self.assertEqual(self.interface.activeFindOffersIDs[
+			bl4p_interface.getQueryShape(wider.query)], 8)
+
+
+	def test_handleFindOffersResult(self):
+		def makeQuery(bidAmount):
+			return Offer(
+				bid = Asset(bidAmount, 100, 'eur', 'bl3p.eu'),
+				ask = Asset(100, 100000, 'btc', 'ln'),
+				address = 'bar',
+				ID = 42,
+				)
+		narrow = messages.BL4PFindOffers(localOrderID = 1, query = makeQuery(1000))
+		wide = messages.BL4PFindOffers(localOrderID = 2, query = makeQuery(2000))
+
+		def makeRequest():
+			request = bl4p_interface.FindOffersRequest(
+				bl4p_interface.getQueryShape(wide.query))
+			request.messages = [narrow, wide]
+			self.interface.activeFindOffers = {6: request}
+			self.interface.activeFindOffersIDs = {request.shape: 6}
+
+		result = []
+		def handleIncomingMessage(message):
+			result.append(message)
+
+		#Each query only receives matching offers:
+		msg = bl4p_pb2.BL4P_FindOffersResult()
+		msg.request = 6
+		o1 = Offer(
+			bid = Asset(100, 100000, 'btc', 'ln'),
+			ask = Asset(1000, 100, 'eur', 'bl3p.eu'),
+			address = 'foo',
+			ID = 43,
+			)
+		msg.offers.add().CopyFrom(o1.toPB2())
+		o2 = Offer(
+			bid = Asset(100, 100000, 'btc', 'ln'),
+			ask = Asset(1500, 100, 'eur', 'bl3p.eu'),
+			address = 'baz',
+			ID = 44,
+			)
+		msg.offers.add().CopyFrom(o2.toPB2())
+
+		makeRequest()
+		with patch.object(self.interface.client, 'handleIncomingMessage', handleIncomingMessage):
+			self.interface.handleResult(msg)
+
+		self.assertEqual(self.interface.activeFindOffers, {})
+		self.assertEqual(self.interface.activeFindOffersIDs, {})
+		self.assertEqual(len(result), 2)
+		self.assertTrue(isinstance(result[0], messages.BL4PFindOffersResult))
+		self.assertEqual(result[0].request, narrow)
+		self.assertEqual(result[0].offers, [o1])
+		self.assertTrue(isinstance(result[1], messages.BL4PFindOffersResult))
+		self.assertEqual(result[1].request, wide)
+		self.assertEqual(result[1].offers, [o1, o2])
+
+		#Errors go to all queries:
+		result = []
+		msg = bl4p_pb2.Error()
+		msg.request = 6
+		makeRequest()
+		with patch.object(self.interface.client, 'handleIncomingMessage', handleIncomingMessage):
+			self.interface.handleResult(msg)
+
+		self.assertEqual(self.interface.activeFindOffers, {})
+		self.assertEqual(len(result), 2)
+		self.assertTrue(isinstance(result[0], messages.BL4PError))
+		self.assertEqual(result[0].request, narrow)
+		self.assertTrue(isinstance(result[1], messages.BL4PError))
+		self.assertEqual(result[1].request, wide)
+
+		#Unrecognized result types are ignored:
+		result = []
+		msg = bl4p_pb2.BL4P_CancelStart()
+		msg.request = 6
+		makeRequest()
+		with patch.object(self.interface.client, 'handleIncomingMessage', handleIncomingMessage):
+			self.interface.handleResult(msg)
+		self.assertEqual(result, [])
 
 
 	def test_handleResult_regularMessages(self):
@@ -275,32 +532,63 @@ class TestBL4PInterface(unittest.TestCase):
 		msg = testSingleMessage(msg)
 		self.assertTrue(isinstance(msg, messages.BL4PRemoveOfferResult))
 
-		msg = bl4p_pb2.BL4P_FindOffersResult()
-		o1 = Offer(
-			bid = Asset(1234, 100, 'eur', 'bl3p.eu'),
-			ask = Asset(4321, 100000, 'btc', 'ln'),
-			address = 'bar',
-			ID = 42,
-			)
-		msg.offers.add().CopyFrom(o1.toPB2())
-		o2 = Offer(
-			ask = Asset(1234, 100, 'eur', 'bl3p.eu'),
-			bid = Asset(4321, 100000, 'btc', 'ln'),
-			address = 'baz',
-			ID = 43,
-			)
-		msg.offers.add().CopyFrom(o2.toPB2())
-		msg = testSingleMessage(msg)
-		self.assertTrue(isinstance(msg, messages.BL4PFindOffersResult))
-		self.assertEqual(len(msg.offers), 2)
-		self.assertEqual(msg.offers[0], o1)
-		self.assertEqual(msg.offers[1], o2)
-
 		msg = bl4p_pb2.Error()
 		msg = testSingleMessage(msg)
 		self.assertTrue(isinstance(msg, messages.BL4PError))
 
 
+	@asynciotest
+	async def test_roundTripMetrics(self):
+		registry = metrics.Registry()
+		requestIDs = iter([6, 7, 8, 9])
+		async def synCall(interface, request):
+			interface.sendRequest(request)
+			if request.request == 9:
+				raise Exception('Connection closed during BL4P call')
+			result = bl4p_pb2.BL4P_RemoveOfferResult()
+			result.request = request.request
+			return result
+
+		with patch.object(metrics, 'registry', registry):
+			with patch.object(Bl4pApi, 'sendRequest', Mock(side_effect=lambda interface, msg: next(requestIDs))):
+				self.interface.handleMessage(messages.BL4PReceive(
+					localOrderID = 0,
+					paymentPreimage = b'foobar',
+					))
+				self.interface.handleMessage(messages.BL4PCancelStart(
+					localOrderID = 0,
+					paymentHash = b'foobar',
+					))
+				self.assertEqual(registry.gauge('bl4p.ongoingRequests').value, 2)
+				self.assertEqual(set(self.interface.requestStartTimes.keys()), {6, 7})
+				self.assertEqual(self.interface.requestStartTimes[6][0], 'Receive')
+				self.assertEqual(self.interface.requestStartTimes[7][0], 'CancelStart')
+
+				result = bl4p_pb2.BL4P_ReceiveResult()
+				result.request = 6
+				self.interface.handleResult(result)
+				result = bl4p_pb2.Error()
+				result.request = 7
+				self.interface.handleResult(result)
+
+				with patch.object(Bl4pApi, 'synCall', synCall):
+					request = bl4p_pb2.BL4P_RemoveOffer()
+					request.request = 8
+					await self.interface.synCall(request)
+
+					request = bl4p_pb2.BL4P_RemoveOffer()
+					request.request = 9
+					with self.assertRaises(Exception):
+						await self.interface.synCall(request)
+
+		self.assertEqual(self.interface.requestStartTimes, {})
+		self.assertEqual(registry.gauge('bl4p.ongoingRequests').value, 0)
+		self.assertEqual(registry.counter('bl4p.errors').value, 1)
+		self.assertEqual(
+			{name: h.count for name, h in registry.histograms.items()},
+			{'bl4p.Receive': 1, 'bl4p.CancelStart': 1, 'bl4p.RemoveOffer': 1})
+
+
 	def test_handleResult_unrecognized(self):
 		#Just testing coverage without exceptions
 		self.interface.activeRequests = {6: 'baz'}
@@ -22,7 +22,7 @@ import signal
 import subprocess
 import sys
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 
 import secp256k1
 
@@ -32,6 +32,7 @@ sys.path.append('..')
 
 import bl4p_interface
 import bl4p_plugin
+import rpc_interface
 
 
 
@@ -74,7 +75,7 @@ class TestPlugin(unittest.TestCase):
 			return stdin, stdout
 
 		stdin.buffer =  b'{"id": 0, "method": "getmanifest", "params": {}}\n\n'
-		stdin.buffer += b'{"id": 1, "method": "init", "params": {"options": {"bl4p.logfile": "foo", "bl4p.dbfile": "bar"}, "configuration": {"lightning-dir": "foobar", "rpc-file": "baz"}}}\n\n'
+		stdin.buffer += b'{"id": 1, "method": "init", "params": {"options": {"bl4p.logfile": "foo", "bl4p.dbfile": "bar", "bl4p.loglevel": "WARNING", "bl4p.maxpaymentsinflight": "100"}, "configuration": {"lightning-dir": "foobar", "rpc-file": "baz"}}}\n\n'
 
 		RPCReader = DummyReader()
 		RPCWriter = DummyWriter()
@@ -122,12 +123,14 @@ class TestPlugin(unittest.TestCase):
 
 		basicConfig.assert_called_once_with(
 			filename='foo',
-			format='%(asctime)s %(levelname)s: %(message)s', level=20,
+			format='%(asctime)s %(levelname)s: %(message)s', level='WARNING',
 			)
 
 		call, length = json.JSONDecoder().raw_decode(RPCWriter.buffer.decode('UTF-8'))
 		self.assertEqual(length, len(RPCWriter.buffer) - 2)
 		self.assertEqual(call, {"id": 0, "params": {}, "method": "getinfo", "jsonrpc": "2.0"})
+		self.assertEqual(openedPaths, ['foobar/baz'] * rpc_interface.DEFAULT_POOL_SIZE)
+		self.assertEqual(len(client.rpcInterface.connectionPool), rpc_interface.DEFAULT_POOL_SIZE)
 
 		self.assertTrue(isinstance(client.bl4pInterface, BL4PInterface))
 		self.assertEqual(client.bl4pInterface.client, client)
@@ -196,6 +199,14 @@ class TestPlugin(unittest.TestCase):
 			client.handleOutgoingMessage('foo')
 			handleMessage.assert_called_once_with('foo')
 
+		#Messages are only formatted if they are logged:
+		message = MagicMock()
+		with patch.object(client.messageRouter, 'handleMessage', Mock()):
+			with patch.object(logging.getLogger(), 'level', logging.WARNING):
+				client.handleIncomingMessage(message)
+				client.handleOutgoingMessage(message)
+		message.__str__.assert_not_called()
+
 
 	def test_main(self):
 		signalHandlers = {}
@@ -25,32 +25,68 @@ import decodedbuffer
 
 
 class TestDecodedBuffer(unittest.TestCase):
-	def test_append(self):
+	def test_decode(self):
 		b = decodedbuffer.DecodedBuffer('UTF-8')
 		b.append(b'Corn\xc3')
-		self.assertEqual(b.get(), 'Corn')
-		self.assertEqual(b.get(), 'Corn')
+		self.assertEqual(len(b), 5)
+		self.assertEqual(b.decode(5), 'Corn')
+		self.assertEqual(len(b), 0)
 
 		b.append(b'\xa9 Plooy')
-		self.assertEqual(b.get(), 'Corné Plooy')
+		self.assertEqual(b.decode(2), '\u00e9 ')
+		self.assertEqual(b.decode(len(b)), 'Plooy')
 
 		b = decodedbuffer.DecodedBuffer('UTF-8')
 		b.append(b'\xe2\x82')
-		self.assertEqual(b.get(), '')
+		self.assertEqual(b.decode(2), '')
 		b.append(b'\xac')
-		self.assertEqual(b.get(), '€')
+		self.assertEqual(b.decode(1), '\u20ac')
 
 
-	def test_set(self):
+	def test_find(self):
 		b = decodedbuffer.DecodedBuffer('UTF-8')
-		b.append(b'Hello Corn\xc3')
-		self.assertEqual(b.get(), 'Hello Corn')
+		b.append(b'foo\n\nbar\n\n')
+		self.assertEqual(b.find(b'\n\n'), 3)
+		self.assertEqual(b.find(b'\n\n', 4), 8)
+		self.assertEqual(b.find(b'baz'), -1)
 
-		b.set(b.get()[6:])
+		#Positions are relative to the unconsumed data:
+		b.consume(5)
+		self.assertEqual(b.find(b'\n\n'), 3)
+		self.assertEqual(b.find(b'foo'), -1)
+		self.assertEqual(b.decode(3), 'bar')
 
-		self.assertEqual(b.get(), 'Corn')
-		b.append(b'\xa9')
-		self.assertEqual(b.get(), 'Corné')
+
+	def test_consume(self):
+		b = decodedbuffer.DecodedBuffer('UTF-8')
+		b.append(b'x' * 100)
+		b.consume(60)
+		self.assertEqual(len(b), 40)
+		self.assertEqual(len(b.buffer), 100) #no compaction of small amounts
+
+		b.consume(100)
+		self.assertEqual(len(b), 0)
+
+		#Compaction:
+		size = decodedbuffer.MIN_COMPACTION_SIZE
+		b = decodedbuffer.DecodedBuffer('UTF-8')
+		b.append(b'x' * (2 * size + 3))
+		b.consume(size)
+		self.assertEqual(len(b.buffer), 2 * size + 3) #less than half
+		b.consume(size)
+		self.assertEqual(len(b.buffer), 3)
+		self.assertEqual(b.start, 0)
+		self.assertEqual(b.decode(3), 'xxx')
+
+
+	def test_clear(self):
+		b = decodedbuffer.DecodedBuffer('UTF-8')
+		b.append(b'foo\xc3')
+		self.assertEqual(b.decode(4), 'foo')
+		b.clear()
+		self.assertEqual(len(b), 0)
+		b.append(b'bar')
+		self.assertEqual(b.decode(3), 'bar')
 
 
 
@@ -134,6 +134,47 @@ class TestJSONRPC(unittest.TestCase):
 			m.assert_called_once()
 
 
+	@asynciotest
+	async def test_framing(self):
+		#Delivered in small pieces:
+		chunks = \
+		[
+		b'{"id": 1, "result": "a\\n\\nb"}',
+		b'\n',
+		b'\n{"id": 2, "re',
+		b'sult": {"x": [1, 2]}}\n\n{"id": 3, ',
+		b'"result": "\xc3',
+		b'\xa9"}\n\n',
+		]
+		reads = []
+		async def read(n):
+			reads.append(n)
+			return chunks.pop(0) if chunks else b''
+		self.input.read = read
+
+		self.assertEqual(await self.rpc.getNextJSON(), {'id': 1, 'result': 'a\n\nb'})
+		self.assertEqual(await self.rpc.getNextJSON(), {'id': 2, 'result': {'x': [1, 2]}})
+		self.assertEqual(await self.rpc.getNextJSON(), {'id': 3, 'result': '\u00e9'})
+		self.assertEqual(await self.rpc.getNextJSON(), None)
+		self.assertEqual(set(reads), {json_rpc.READ_SIZE})
+
+		#A delimiter inside a (pretty-printed) message:
+		self.rpc.inputStream = DummyReader()
+		self.rpc.inputStream.buffer = b'{"id": 4,\n\n"result": 5}\n\n{"id": 6, "result": 7}\n\n'
+		self.assertEqual(await self.rpc.getNextJSON(), {'id': 4, 'result': 5})
+		self.assertEqual(await self.rpc.getNextJSON(), {'id': 6, 'result': 7})
+
+		#Incomplete frames are only decoded once they are complete:
+		self.rpc.inputBuffer.append(b'{"id": 8, ')
+		self.rpc.inputStream.buffer = b'"result": 9}\n\n'
+		with patch.object(self.rpc, 'decodeFrame', Mock(wraps=self.rpc.decodeFrame)) as decodeFrame:
+			self.assertEqual(await self.rpc.getNextJSON(), {'id': 8, 'result': 9})
+			decodeFrame.assert_called_once_with('{"id": 8, "result": 9}')
+		self.assertEqual(len(self.rpc.inputBuffer), 0)
+		self.assertEqual(self.rpc.scanPosition, 0)
+		self.assertEqual(self.rpc.incompleteFrame, None)
+
+
 	@asynciotest
 	async def test_defaultHandlerMethods(self):
 		#No assertions, just do code coverage and check there are no exceptions
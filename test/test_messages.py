@@ -17,11 +17,12 @@
 
 import sys
 import unittest
-from unittest.mock import Mock
+from unittest.mock import patch, Mock
 
 sys.path.append('..')
 
 import messages
+import metrics
 
 
 
@@ -74,6 +75,120 @@ class TestMessages(unittest.TestCase):
 		m.assert_called_once_with(obj)
 
 
+	def test_Router_routes(self):
+		outgoing = Mock()
+		unrouted = Mock()
+		h = messages.Handler({
+			messages.BL4PStart      : outgoing,
+			messages.BL4PStartResult: unrouted,
+			messages.LNPay          : outgoing,
+			messages.LNPayResult    : unrouted,
+			})
+		r = messages.Router()
+		r.addHandler(h)
+		r.startMessaging()
+
+		def makeResult(request):
+			return messages.BL4PStartResult(
+				request=request, senderAmount=0, receiverAmount=0, paymentHash=b'')
+		requests = [messages.BL4PStart(
+			localOrderID=42, amount=i, sender_timeout_delta_ms=0, locked_timeout_delta_s=0, receiver_pays_fee=True)
+			for i in range(4)]
+
+		#Result arrives before the route is added:
+		r.handleMessage(requests[0])
+		outgoing.assert_called_once_with(requests[0])
+		r.handleMessage(makeResult(requests[0]))
+		handler = Mock()
+		r.addRoute(requests[0], handler)
+		handler.assert_called_once_with(makeResult(requests[0]))
+
+		#Result arrives after the route is added:
+		r.handleMessage(requests[1])
+		handler = Mock()
+		r.addRoute(requests[1], handler)
+		handler.assert_not_called()
+		r.handleMessage(makeResult(requests[1]))
+		handler.assert_called_once_with(makeResult(requests[1]))
+
+		#LN payments are routed by payment hash:
+		pay = messages.LNPay(
+			localOrderID=42, destinationNodeID='foo', paymentHash=b'bar',
+			recipientCryptoAmount=0, maxSenderCryptoAmount=0, minCLTVExpiryDelta=0, fiatAmount=0, offerID=0)
+		payResult = messages.LNPayResult(
+			localOrderID=42, senderCryptoAmount=0, paymentHash=b'bar', paymentPreimage=None)
+		r.handleMessage(pay)
+		handler = Mock()
+		r.addRoute(pay, handler)
+		r.handleMessage(payResult)
+		handler.assert_called_once_with(payResult)
+
+		unrouted.assert_not_called()
+
+		#Results of removed routes, and of unknown requests,
+		#go to the handler of their class:
+		r.handleMessage(requests[2])
+		r.handleMessage(makeResult(requests[2]))
+		r.removeRoute(requests[2])
+		r.handleMessage(makeResult(requests[2]))
+		unrouted.assert_called_once_with(makeResult(requests[2]))
+
+		unrouted.reset_mock()
+		r.handleMessage(makeResult(requests[3]))
+		unrouted.assert_called_once_with(makeResult(requests[3]))
+
+		self.assertEqual(r.routes, {})
+		self.assertEqual(r.earlyResults, {})
+
+
+	def test_Router_dispatchTable(self):
+		m = Mock()
+		r = messages.Router()
+		r.addHandler(messages.Handler({Dummy: m}))
+		r.startMessaging()
+
+		obj = Dummy()
+		r.handleMessage(obj)
+		m.assert_called_once_with(obj)
+		self.assertEqual(r.dispatchTable, {Dummy: (messages.DISPATCH_OTHER, m, metrics.registry.histogram('message.Dummy'))})
+
+		#Adding handlers resets the table:
+		m2 = Mock()
+		r.addHandler(messages.Handler({messages.LNPay: m2, messages.LNPayResult: m2}))
+		self.assertEqual(r.dispatchTable, {})
+
+		self.assertEqual(r.getDispatchEntry(messages.LNPay)[:2], (messages.DISPATCH_REQUEST, m2))
+		self.assertEqual(r.getDispatchEntry(messages.BL4PStart)[:2], (messages.DISPATCH_REQUEST, None))
+		self.assertEqual(r.getDispatchEntry(messages.LNPayResult)[:2], (messages.DISPATCH_RESULT, m2))
+		self.assertEqual(r.getDispatchEntry(messages.BL4PError)[:2], (messages.DISPATCH_RESULT, None))
+		self.assertEqual(r.getDispatchEntry(Dummy)[:2], (messages.DISPATCH_OTHER, m))
+
+		with self.assertRaises(messages.NoMessageHandler):
+			r.handleMessage('foobar')
+
+
+	@patch.object(metrics, 'registry', metrics.Registry())
+	def test_Router_stats(self):
+		r = messages.Router()
+		r.addHandler(messages.Handler({Dummy: Mock()}))
+		r.startMessaging()
+
+		times = [1.0, 1.0000005, 2.0, 2.05, 3.0, 5.0]
+		with patch.object(messages.time, 'perf_counter', Mock(side_effect=times)):
+			for i in range(3):
+				r.handleMessage(Dummy())
+		with self.assertRaises(messages.NoMessageHandler):
+			r.handleMessage('foobar')
+
+		histograms = metrics.registry.histograms
+		self.assertEqual(set(histograms.keys()), set(['message.Dummy', 'message.str']))
+		self.assertEqual(histograms['message.Dummy'].count, 3)
+		self.assertAlmostEqual(histograms['message.Dummy'].total, 0.0500005 + 2.0)
+		self.assertAlmostEqual(histograms['message.Dummy'].min, 0.0000005)
+		self.assertAlmostEqual(histograms['message.Dummy'].max, 2.0)
+		self.assertEqual(histograms['message.str'].count, 1)
+
+
 
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
@@ -0,0 +1,122 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+
+sys.path.append('..')
+
+import metrics
+
+
+
+class TestMetrics(unittest.TestCase):
+	def test_buckets(self):
+		self.assertEqual(metrics.getBucketIndex(0.0), metrics.ZERO_BUCKET)
+		self.assertEqual(metrics.getBucketIndex(-1.0), metrics.ZERO_BUCKET)
+		self.assertEqual(metrics.getBucketLimit(metrics.ZERO_BUCKET), 0.0)
+
+		for value in [1e-7, 0.001, 0.3, 1.0, 1.5, 7.0, 1e6]:
+			index = metrics.getBucketIndex(value)
+			limit = metrics.getBucketLimit(index)
+			self.assertGreater(limit, value)
+			self.assertLessEqual(limit, value * (1 + 1 / metrics.SUB_BUCKETS))
+			self.assertLessEqual(metrics.getBucketLimit(index - 1), value)
+
+		#Buckets are ordered like their values:
+		indices = [metrics.getBucketIndex(0.001 * 1.01**i) for i in range(1000)]
+		self.assertEqual(indices, sorted(indices))
+
+
+	def test_Counter(self):
+		c = metrics.Counter()
+		self.assertEqual(c.getInfo(), 0)
+		c.increment()
+		c.increment(3)
+		self.assertEqual(c.getInfo(), 4)
+
+
+	def test_Gauge(self):
+		g = metrics.Gauge()
+		self.assertEqual(g.getInfo(), 0)
+		g.set(5)
+		g.increment()
+		g.decrement(2)
+		self.assertEqual(g.getInfo(), 4)
+
+
+	def test_Histogram(self):
+		h = metrics.Histogram()
+		self.assertEqual(h.getInfo(),
+			{
+			'count': 0, 'total': 0.0, 'min': 0.0, 'max': 0.0, 'mean': 0.0,
+			'p50': 0.0, 'p90': 0.0, 'p99': 0.0,
+			})
+
+		for i in range(1, 101):
+			h.add(i / 1000)
+		info = h.getInfo()
+		self.assertEqual(info['count'], 100)
+		self.assertAlmostEqual(info['total'], 5.05)
+		self.assertAlmostEqual(info['mean'], 0.0505)
+		self.assertEqual(info['min'], 0.001)
+		self.assertEqual(info['max'], 0.1)
+		for p, exact in [(50, 0.05), (90, 0.09), (99, 0.099)]:
+			self.assertGreaterEqual(info['p%d' % p], exact)
+			self.assertLessEqual(info['p%d' % p], exact * (1 + 1 / metrics.SUB_BUCKETS))
+		self.assertEqual(h.getPercentile(100), 0.1)
+		self.assertLessEqual(h.getPercentile(0), 0.001 * (1 + 1 / metrics.SUB_BUCKETS))
+
+		#Memory is only used for occupied buckets:
+		h = metrics.Histogram()
+		for i in range(1000):
+			h.add(0.5)
+		h.add(0.0)
+		self.assertEqual(len(h.buckets), 2)
+		self.assertEqual(h.getInfo()['min'], 0.0)
+		self.assertEqual(h.getPercentile(0.05), 0.0)
+		self.assertEqual(h.getPercentile(50), 0.5)
+
+
+	def test_Registry(self):
+		r = metrics.Registry()
+		self.assertEqual(r.getInfo(), {'counters': {}, 'gauges': {}, 'histograms': {}})
+
+		c = r.counter('foo')
+		self.assertTrue(isinstance(c, metrics.Counter))
+		self.assertIs(r.counter('foo'), c)
+		c.increment()
+
+		g = r.gauge('bar')
+		self.assertTrue(isinstance(g, metrics.Gauge))
+		self.assertIs(r.gauge('bar'), g)
+		g.set(3)
+
+		h = r.histogram('baz')
+		self.assertTrue(isinstance(h, metrics.Histogram))
+		self.assertIs(r.histogram('baz'), h)
+		h.add(1.0)
+
+		info = r.getInfo()
+		self.assertEqual(info['counters'], {'foo': 1})
+		self.assertEqual(info['gauges'], {'bar': 3})
+		self.assertEqual(info['histograms'], {'baz': h.getInfo()})
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -0,0 +1,90 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import unittest
+from unittest.mock import Mock
+
+from utils import asynciotest, makeOffer
+
+sys.path.append('..')
+
+import offersearch
+
+
+
+class TestOfferSearchScheduler(unittest.TestCase):
+	def setUp(self):
+		self.orderScheduler = Mock()
+		self.scheduler = offersearch.OfferSearchScheduler(self.orderScheduler,
+			minInterval=0.1, maxInterval=0.3, backoffFactor=2.0, jitter=0)
+		self.sellOrder = makeOffer(1, 1, 41, bidCurrency='btc', askCurrency='eur')
+		self.otherOrder = makeOffer(1, 1, 42, bidCurrency='btc', askCurrency='usd')
+		self.scheduler.register(self.sellOrder)
+		self.scheduler.register(self.otherOrder)
+
+
+	def test_getPairKey(self):
+		self.assertEqual(
+			offersearch.getPairKey(self.sellOrder),
+			offersearch.getPairKey(makeOffer(1, 1, 43))
+			)
+		self.assertNotEqual(
+			offersearch.getPairKey(self.sellOrder),
+			offersearch.getPairKey(self.otherOrder)
+			)
+
+
+	def test_backoff(self):
+		delays = [self.scheduler.getNextSearchDelay(41) for i in range(4)]
+		self.assertEqual(delays, [0.1, 0.2, 0.3, 0.3])
+
+		self.scheduler.reportOffersFound(41)
+		self.assertEqual(self.scheduler.searches[41].interval, 0.1)
+
+
+	@asynciotest
+	async def test_jitter(self):
+		self.scheduler.jitter = 0.5
+		for i in range(10):
+			delay = self.scheduler.getDelay(self.scheduler.searches[41])
+			self.assertTrue(0.05 <= delay <= 0.15)
+
+
+	def test_wakeMarket(self):
+		self.scheduler.searches[41].interval = 0.3
+		self.scheduler.searches[42].interval = 0.3
+
+		self.scheduler.wakeMarket(offersearch.getPairKey(makeOffer(1, 1, 1)))
+		self.orderScheduler.wake.assert_called_once_with(41)
+
+		self.assertEqual(self.scheduler.searches[41].interval, 0.1)
+		self.assertEqual(self.scheduler.searches[42].interval, 0.3)
+
+
+	def test_registration(self):
+		self.scheduler.searches[41].interval = 0.3
+		self.scheduler.register(self.sellOrder) #doesn't reset the state
+		self.assertEqual(self.scheduler.searches[41].interval, 0.3)
+		self.scheduler.unregister(41)
+		self.scheduler.unregister(41)
+		self.assertEqual(set(self.scheduler.searches.keys()), set([42]))
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
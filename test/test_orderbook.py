@@ -0,0 +1,77 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+from fractions import Fraction
+import sys
+import unittest
+
+from utils import makeOffer
+
+sys.path.append('..')
+
+import orderbook
+
+
+
+class TestOrderBook(unittest.TestCase):
+	def setUp(self):
+		#Bids 100 btc, asks 200 eur:
+		self.order = makeOffer(10000, 2000, 42,
+			bidCurrency='btc', askCurrency='eur',
+			locked_timeout=(10, 20),
+			)
+
+
+	def test_getRate(self):
+		self.assertEqual(orderbook.getRate(makeOffer(300, 20, 0)), Fraction(3, 2))
+		self.assertEqual(orderbook.getRate(self.order), Fraction(1, 2))
+
+
+	def test_bestOffer(self):
+		book = orderbook.OrderBook()
+		self.assertEqual(book.getBestOffer(self.order), None)
+
+		offers = \
+		[
+		makeOffer(2000, 100, 0), #rate 2.0
+		makeOffer(2500, 100, 1), #rate 2.5
+		makeOffer(1999, 100, 2), #rate too low
+		makeOffer(3000, 100, 3, bidCurrency='usd'), #other market
+		makeOffer(3000, 100, 4, locked_timeout=(30, 40)), #non-overlapping condition
+		makeOffer(2000, 100, 5), #rate 2.0, added later
+		makeOffer(2000, 0, 6), #nonsensical
+		]
+		for o in offers:
+			book.addOffer(o)
+
+		matching = list(book.getMatchingOffers(self.order))
+		self.assertEqual(matching, [offers[1], offers[0], offers[5]])
+		for o in offers:
+			self.assertEqual(o in matching, o.matches(self.order) and o.ask.max_amount > 0)
+
+		self.assertEqual(book.getBestOffer(self.order), offers[1])
+
+		#Offers with the same rate keep the order in which they were added:
+		book = orderbook.OrderBook()
+		book.addOffer(offers[5])
+		book.addOffer(offers[0])
+		self.assertEqual(list(book.getMatchingOffers(self.order)), [offers[5], offers[0]])
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
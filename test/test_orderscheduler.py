@@ -0,0 +1,130 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import sys
+import unittest
+from unittest.mock import Mock
+
+from utils import asynciotest
+
+sys.path.append('..')
+
+import orderscheduler
+
+
+
+class TestOrderScheduler(unittest.TestCase):
+	def setUp(self):
+		self.scheduler = orderscheduler.OrderScheduler()
+
+		self.task = Mock()
+		self.task.order.ID = 41
+		self.otherTask = Mock()
+		self.otherTask.order.ID = 42
+		self.tasks = [Mock() for i in range(3)]
+		for ID, task in enumerate(self.tasks):
+			task.order.ID = ID
+
+
+	@asynciotest
+	async def test_wake(self):
+		task = self.task
+		self.assertFalse(self.scheduler.wake(41))
+
+		self.scheduler.park(task)
+		self.assertTrue(self.scheduler.isParked(41))
+		self.assertTrue(self.scheduler.wake(41))
+		self.assertFalse(self.scheduler.isParked(41))
+		self.assertFalse(self.scheduler.wake(41))
+
+		#Woken up tasks are handled from a queue:
+		task.handleEvent.assert_not_called()
+		await asyncio.sleep(0)
+		task.handleEvent.assert_called_once_with()
+
+
+	@asynciotest
+	async def test_unpark(self):
+		task = self.task
+		self.scheduler.park(task, 0.05)
+		self.assertEqual(self.scheduler.unpark(41), task)
+		self.assertEqual(self.scheduler.unpark(41), None)
+		await asyncio.sleep(0.1)
+		task.handleEvent.assert_not_called()
+
+
+	@asynciotest
+	async def test_unparkAfterWake(self):
+		task = self.task
+		self.scheduler.park(task)
+		self.assertTrue(self.scheduler.wake(41))
+
+		#Stopping the order before its event is handled drops the event:
+		self.assertEqual(self.scheduler.unpark(41), task)
+		await asyncio.sleep(0)
+		task.handleEvent.assert_not_called()
+
+		#Same after a shutdown:
+		self.scheduler.park(task)
+		self.assertTrue(self.scheduler.wake(41))
+		self.scheduler.shutdown()
+		await asyncio.sleep(0)
+		task.handleEvent.assert_not_called()
+
+
+	@asynciotest
+	async def test_timers(self):
+		tasks = self.tasks
+		self.scheduler.park(tasks[0], 0.2)
+		self.scheduler.park(tasks[1], 0.1)
+		self.scheduler.park(tasks[2])
+
+		await asyncio.sleep(0.15)
+		tasks[0].handleEvent.assert_not_called()
+		tasks[1].handleEvent.assert_called_once_with()
+
+		#A task that was woken up earlier doesn't get woken up by its timer:
+		self.scheduler.wake(0)
+		await asyncio.sleep(0)
+		self.scheduler.park(tasks[0], 1.0)
+		await asyncio.sleep(0.1)
+		tasks[0].handleEvent.assert_called_once_with()
+
+		#A single timer handle for all tasks:
+		self.assertEqual(self.scheduler.timerHandleDeadline, self.scheduler.deadlines[0])
+		self.scheduler.shutdown()
+		self.assertEqual(self.scheduler.timerHandle, None)
+		tasks[2].handleEvent.assert_not_called()
+
+
+	@asynciotest
+	async def test_processEvents_exceptions(self):
+		task1 = self.task
+		task1.handleEvent = Mock(side_effect=Exception())
+		task2 = self.otherTask
+		self.scheduler.park(task1)
+		self.scheduler.park(task2)
+		self.scheduler.wake(41)
+		self.scheduler.wake(42)
+		await asyncio.sleep(0)
+		task2.handleEvent.assert_called_once_with()
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
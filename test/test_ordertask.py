@@ -19,7 +19,6 @@ import asyncio
 import hashlib
 import logging
 import sys
-import time
 import unittest
 from unittest.mock import patch, Mock
 
@@ -29,7 +28,10 @@ sys.path.append('..')
 
 from bl4p_api import offer
 import messages
-from order import Order, ORDER_STATUS_CANCEL_REQUESTED, ORDER_STATUS_CANCELED
+import metrics
+import offersearch
+from order import Order, ORDER_STATUS_ACTIVE, ORDER_STATUS_CANCEL_REQUESTED, ORDER_STATUS_CANCELED
+import orderscheduler
 import ordertask
 
 
@@ -48,6 +50,14 @@ class TestOrderTask(unittest.TestCase):
 			self.outgoingMessages.put_nowait(msg)
 		self.client = Mock()
 		self.client.handleOutgoingMessage = handleOutgoingMessage
+		self.client.backend.orderScheduler = orderscheduler.OrderScheduler()
+		self.client.backend.offerSearchScheduler = offersearch.OfferSearchScheduler(
+			self.client.backend.orderScheduler, jitter=0)
+
+		#Most tests do one transaction at a time:
+		patcher = patch.object(ordertask.settings, 'maxTransactionsPerOrder', 1)
+		patcher.start()
+		self.addCleanup(patcher.stop)
 
 
 	async def shutdownOrderTask(self, task):
@@ -92,10 +102,10 @@ class TestOrderTask(unittest.TestCase):
 
 
 	def test_BuyTransaction(self):
-		with patch.object(ordertask.StoredObject, 'createStoredObject', Mock(return_value=43)):
+		with patch.object(ordertask.StoredObject, 'insertStoredObject', Mock(return_value={'ID': 43})):
 			self.assertEqual(ordertask.BuyTransaction.create('foo', 'baa', 'bab', 'bac', 'bad'), 43)
 
-			ordertask.StoredObject.createStoredObject.assert_called_once_with(
+			ordertask.StoredObject.insertStoredObject.assert_called_once_with(
 				'foo', 'buyTransactions',
 				buyOrder='baa', fiatAmount='bab', cryptoAmount='bac', paymentHash='bad',
 				status=0, paymentPreimage=None,
@@ -116,10 +126,10 @@ class TestOrderTask(unittest.TestCase):
 
 
 	def test_SellTransaction(self):
-		with patch.object(ordertask.StoredObject, 'createStoredObject', Mock(return_value=43)):
+		with patch.object(ordertask.StoredObject, 'insertStoredObject', Mock(return_value={'ID': 43})):
 			self.assertEqual(ordertask.SellTransaction.create('foo', 'baa', 'bab', 'bac', 'bae', 'baf', 'bag', 'bah'), 43)
 
-			ordertask.StoredObject.createStoredObject.assert_called_once_with(
+			ordertask.StoredObject.insertStoredObject.assert_called_once_with(
 				'foo', 'sellTransactions',
 				sellOrder='baa', counterOffer='bab', buyerFiatAmount='bac', buyerCryptoAmount='bae', senderTimeoutDelta='baf', lockedTimeoutDelta='bag', CLTVExpiryDelta='bah',
 				status=0, sellerFiatAmount=None, sellerCryptoAmount=None, paymentHash=None, paymentPreimage=None,
@@ -140,16 +150,53 @@ class TestOrderTask(unittest.TestCase):
 
 
 	def test_CounterOffer(self):
+		ordertask.CounterOffer.parsedOffers.clear()
+
 		with patch.object(ordertask.StoredObject, 'createStoredObject', Mock(return_value=43)):
 			PB2 = Mock()
 			PB2.SerializeToString = Mock(return_value=b'bar')
 			counterOffer = Mock()
 			counterOffer.toPB2 = Mock(return_value=PB2)
 
-			self.assertEqual(ordertask.CounterOffer.create('foo', counterOffer), 43)
+			storage = Mock()
+			storage.allocateID = Mock(return_value=None)
+			storage.execute = Mock(return_value=MockCursor([]))
+
+			self.assertEqual(ordertask.CounterOffer.create(storage, counterOffer), 43)
 
+			storage.execute.assert_called_once_with(
+				'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?',
+				[ordertask.getContentHash(b'bar')])
 			ordertask.StoredObject.createStoredObject.assert_called_once_with(
-				'foo', 'counterOffers', blob=b'bar')
+				storage, 'counterOffers', blob=b'bar', hash=ordertask.getContentHash(b'bar'))
+
+			#An identical counter offer is not stored again:
+			ordertask.StoredObject.createStoredObject.reset_mock()
+			storage.execute = Mock(return_value=MockCursor([[41]]))
+			self.assertEqual(ordertask.CounterOffer.create(storage, counterOffer), 41)
+			ordertask.StoredObject.createStoredObject.assert_not_called()
+
+			#With allocated IDs, counter offers are found without waiting for the writer:
+			ordertask.CounterOffer.storedIDs.clear()
+			storage = Mock()
+			storage.allocateID = Mock(side_effect=[50, 51, 52])
+			storage.executeRead = Mock(return_value=MockCursor([]))
+			self.assertEqual(ordertask.CounterOffer.create(storage, counterOffer), 50)
+			storage.executeRead.assert_called_once_with(
+				'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?',
+				[ordertask.getContentHash(b'bar')])
+			storage.execute.assert_called_once_with(
+				'INSERT OR IGNORE INTO `counterOffers` (`ID`, `blob`, `hash`) VALUES (?,?,?)',
+				[50, b'bar', ordertask.getContentHash(b'bar')])
+
+			storage.executeRead.reset_mock()
+			self.assertEqual(ordertask.CounterOffer.create(storage, counterOffer), 50)
+			storage.executeRead.assert_not_called()
+
+			ordertask.CounterOffer.storedIDs.clear()
+			storage.executeRead = Mock(return_value=MockCursor([[41]]))
+			self.assertEqual(ordertask.CounterOffer.create(storage, counterOffer), 41)
+			ordertask.CounterOffer.storedIDs.clear()
 
 			storage = Mock()
 			cursor = Mock()
@@ -173,6 +220,39 @@ class TestOrderTask(unittest.TestCase):
 			self.assertEqual(co.blob, b'cafecafe')
 			self.assertEqual(co.counterOffer, 'bar')
 
+			#Parsed counter offers are cached:
+			ParseFromString.reset_mock()
+			cursor.fetchone = Mock(return_value = [44, b'cafecafe'])
+			with patch.object(ordertask.offer_pb2.Offer, 'ParseFromString', ParseFromString):
+				with patch.object(ordertask.Offer, 'fromPB2', fromPB2):
+					co = ordertask.CounterOffer(storage, 44)
+			ParseFromString.assert_not_called()
+			self.assertEqual(co.counterOffer, 'bar')
+
+
+	def test_CounterOffer_parse(self):
+		ordertask.CounterOffer.parsedOffers.clear()
+
+		def makeBlob(amount):
+			o = offer.Offer(
+				bid=offer.Asset(amount, 1, 'eur', 'bl3p.eu'),
+				ask=offer.Asset(1, 1, 'btc', 'ln'),
+				address='foo', ID=6)
+			return o.toPB2().SerializeToString()
+
+		with patch.object(ordertask.settings, 'counterOfferCacheSize', 2):
+			o1 = ordertask.CounterOffer.parse(makeBlob(1))
+			o2 = ordertask.CounterOffer.parse(makeBlob(2))
+			self.assertEqual(o1.bid.max_amount, 1)
+			self.assertEqual(o2.bid.max_amount, 2)
+			self.assertIs(ordertask.CounterOffer.parse(makeBlob(1)), o1)
+
+			#Least recently used is removed:
+			o3 = ordertask.CounterOffer.parse(makeBlob(3))
+			self.assertEqual(list(ordertask.CounterOffer.parsedOffers.values()), [o1, o3])
+			self.assertIs(ordertask.CounterOffer.parse(makeBlob(1)), o1)
+			self.assertIsNot(ordertask.CounterOffer.parse(makeBlob(2)), o2)
+
 
 	def test_constructor(self):
 		client = object()
@@ -183,43 +263,77 @@ class TestOrderTask(unittest.TestCase):
 		self.assertEqual(task.client, client)
 		self.assertEqual(task.storage, storage)
 		self.assertEqual(task.order, order)
-		self.assertEqual(task.counterOffer, None)
-		self.assertEqual(task.transaction, None)
+		self.assertEqual(task.transactionTasks, [])
 
 
 	@asynciotest
 	async def test_task(self):
-		task = ordertask.OrderTask(None, None, None)
+		order = Mock()
+		order.ID = 42
+		order.amount = 1
+		order.remoteOfferID = None
+		orderScheduler = self.client.backend.orderScheduler
 
+		#Steps are started by the order scheduler:
+		task = ordertask.OrderTask(self.client, None, order)
 		result = []
-
-		async def count():
-			try:
-				i = 1
-				while True:
-					await asyncio.sleep(0.1)
-					result.append(i)
-					i += 1
-			except asyncio.CancelledError:
-				pass
-
-		task.doTrading = count
+		async def step():
+			result.append(len(result) + 1)
+			return 0.1
+		task.startTrading = step
+		task.continueTrading = step
 		task.startup()
 		await asyncio.sleep(0.35)
-		await task.shutdown()
-		self.assertEqual(result, [1, 2, 3])
+		self.assertEqual(result, [1, 2, 3, 4])
 
-		result = []
+		#In between steps, the order is idle:
+		self.assertTrue(orderScheduler.isParked(42))
+		self.assertEqual(task.task, None)
 
-		async def countTo3():
-			for i in range(1, 4):
-				await asyncio.sleep(0.1)
-				result.append(i)
+		await task.shutdown()
+		await task.waitFinished()
+		self.assertFalse(orderScheduler.isParked(42))
+		self.assertTrue(task.finished)
+		self.client.backend.handleOrderTaskFinished.assert_called_once_with(42)
+		await asyncio.sleep(0.2)
+		self.assertEqual(result, [1, 2, 3, 4])
 
-		task.doTrading = countTo3
+		#Stop after being woken up, but before the next step is started:
+		task = ordertask.OrderTask(self.client, None, order)
+		result = []
+		task.startTrading = step
+		task.continueTrading = step
 		task.startup()
+		await asyncio.sleep(0)
+		self.assertTrue(orderScheduler.isParked(42))
+		orderScheduler.wake(42)
+		task.stop()
 		await task.waitFinished()
-		self.assertEqual(result, [1, 2, 3])
+		await asyncio.sleep(0.2)
+		self.assertEqual(result, [1])
+
+		#Shutdown during a step:
+		task = ordertask.OrderTask(self.client, None, order)
+		async def longStep():
+			await asyncio.sleep(10)
+		task.startTrading = longStep
+		task.startup()
+		await asyncio.sleep(0.1)
+		await task.shutdown()
+		self.assertTrue(task.finished)
+		self.assertFalse(orderScheduler.isParked(42))
+
+		#Finished orders don't start new steps or transactions:
+		task.handleEvent()
+		self.assertEqual(task.task.done(), True)
+		with self.assertRaises(ordertask.UnexpectedResult):
+			task.setCallResult(messages.LNIncoming(
+				offerID=42,
+				CLTVExpiryDelta=0,
+				fiatAmount=1,
+				cryptoAmount=1,
+				paymentHash=b'foo',
+				))
 
 
 	def test_cancel(self):
@@ -230,13 +344,49 @@ class TestOrderTask(unittest.TestCase):
 		order = ordertask.BuyOrder(self.storage, orderID, 'lnAddress')
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		task.task = Mock()
-		task.cancel()
-		self.assertEqual(order.status, ORDER_STATUS_CANCELED)
-		task.task.cancel.assert_called_with()
+		registry = metrics.Registry()
+		with patch.object(metrics, 'registry', registry):
+			task.cancel()
+			self.assertEqual(order.status, ORDER_STATUS_CANCELED)
+			task.task.cancel.assert_called_with()
+
+			task.transactionTasks = [Mock()]
+			task.cancel()
+			self.assertEqual(order.status, ORDER_STATUS_CANCEL_REQUESTED)
+		self.assertEqual(registry.getInfo()['counters'],
+			{
+			'order.canceled': 1,
+			'order.cancel requested': 1,
+			})
 
-		task.transaction = Mock()
-		task.cancel()
-		self.assertEqual(order.status, ORDER_STATUS_CANCEL_REQUESTED)
+
+	def test_updateTransaction(self):
+		orderID = ordertask.BuyOrder.create(self.storage,
+			190000,   #mCent / BTC = 1.9 EUR/BTC
+			123400000 #mCent    = 1234 EUR
+			)
+		order = ordertask.BuyOrder(self.storage, orderID, 'lnAddress')
+		task = ordertask.OrderTask(self.client, self.storage, order)
+		txID = ordertask.BuyTransaction.create(
+			self.storage,
+			buyOrder = orderID,
+			fiatAmount = 12,
+			cryptoAmount = 34,
+			paymentHash = b'foobar'
+			)
+		buyTask = ordertask.TransactionTask(task)
+		buyTask.transaction = ordertask.BuyTransaction(self.storage, txID)
+
+		registry = metrics.Registry()
+		with patch.object(metrics, 'registry', registry):
+			buyTask.updateTransaction(
+				paymentPreimage = b'foo',
+				status = ordertask.TX_STATUS_FINISHED,
+				)
+		self.assertEqual(buyTask.transaction.paymentPreimage, b'foo')
+		self.assertEqual(buyTask.transaction.status, ordertask.TX_STATUS_FINISHED)
+		self.assertEqual(self.storage.buyTransactions[txID]['status'], ordertask.TX_STATUS_FINISHED)
+		self.assertEqual(registry.getInfo()['counters'], {'transaction.finished': 1})
 
 
 	def test_getListInfo(self):
@@ -255,29 +405,33 @@ class TestOrderTask(unittest.TestCase):
 			'amount': 123400000,
 			})
 
-		txID = task.transaction = ordertask.BuyTransaction.create(
+		txID = ordertask.BuyTransaction.create(
 			self.storage,
 			buyOrder = orderID,
 			fiatAmount = 12,
 			cryptoAmount = 34,
 			paymentHash = b'foobar'
 			)
-		task.transaction = ordertask.BuyTransaction(self.storage, txID)
+		buyTask = ordertask.TransactionTask(task)
+		buyTask.transaction = ordertask.BuyTransaction(self.storage, txID)
+		task.transactionTasks = [buyTask]
 		self.assertEqual(task.getListInfo(),
 			{
 			'ID': orderID,
 			'status': 'active',
 			'limitRate': 190000,
 			'amount': 123400000,
-			'transaction':
+			'transactions':
+				[
 				{
 				'status': 'initial',
 				'fiatAmount': 12,
 				'cryptoAmount': 34,
 				}
+				]
 			})		
 
-		txID = task.transaction = ordertask.SellTransaction.create(
+		txID = ordertask.SellTransaction.create(
 			self.storage,
 			sellOrder = orderID,
 			counterOffer = 0,
@@ -287,16 +441,24 @@ class TestOrderTask(unittest.TestCase):
 			lockedTimeoutDelta = 0,
 			CLTVExpiryDelta = 0,
 			)
-		task.transaction = ordertask.SellTransaction(self.storage, txID)
-		task.transaction.sellerFiatAmount = 34
-		task.transaction.sellerCryptoAmount = 78
+		sellTask = ordertask.TransactionTask(task)
+		sellTask.transaction = ordertask.SellTransaction(self.storage, txID)
+		sellTask.transaction.sellerFiatAmount = 34
+		sellTask.transaction.sellerCryptoAmount = 78
+		task.transactionTasks = [buyTask, sellTask]
 		self.assertEqual(task.getListInfo(),
 			{
 			'ID': orderID,
 			'status': 'active',
 			'limitRate': 190000,
 			'amount': 123400000,
-			'transaction':
+			'transactions':
+				[
+				{
+				'status': 'initial',
+				'fiatAmount': 12,
+				'cryptoAmount': 34,
+				},
 				{
 				'status': 'initial',
 				'buyerFiatAmount': 12,
@@ -304,6 +466,7 @@ class TestOrderTask(unittest.TestCase):
 				'buyerCryptoAmount': 56,
 				'sellerCryptoAmount': 78,
 				}
+				]
 			})		
 
 
@@ -396,7 +559,7 @@ class TestOrderTask(unittest.TestCase):
 				'paymentHash': paymentHash,
 				'paymentPreimage': paymentPreimage,
 				}})
-			self.assertEqual(task.transaction, None)
+			self.assertEqual([t.transaction for t in task.transactionTasks], [None])
 
 			#LN transaction gets finished
 			self.assertEqual(msg, messages.LNFinish(
@@ -492,6 +655,18 @@ class TestOrderTask(unittest.TestCase):
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		task.startup()
 
+		#The offer is published while waiting for the transaction:
+		msg = await self.outgoingMessages.get()
+		self.assertEqual(msg, messages.BL4PAddOffer(
+			localOrderID=42,
+
+			offer=order,
+			))
+		task.setCallResult(messages.BL4PAddOfferResult(
+			request=None,
+			ID=6,
+			))
+
 		await asyncio.sleep(0.1)
 
 		task.setCallResult(messages.LNIncoming(
@@ -518,7 +693,7 @@ class TestOrderTask(unittest.TestCase):
 				},
 			))
 
-		await task.shutdown()
+		await self.shutdownOrderTask(task)
 
 		#Database inconsistency exception:
 		self.storage.buyTransactions = \
@@ -533,7 +708,7 @@ class TestOrderTask(unittest.TestCase):
 
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		with self.assertRaises(Exception):
-			await task.continueBuyTransaction()
+			await task.continueBuyTransactions()
 
 
 	@asynciotest
@@ -606,7 +781,7 @@ class TestOrderTask(unittest.TestCase):
 			'cryptoAmount': 200000000,
 			'paymentHash': b'foo',
 			}})
-		self.assertEqual(task.transaction, None)
+		self.assertEqual([t.transaction for t in task.transactionTasks], [None])
 
 		#Old offer gets removed
 		msg = await self.outgoingMessages.get()
@@ -662,6 +837,9 @@ class TestOrderTask(unittest.TestCase):
 			}
 		}
 
+		#Transaction 42 takes one of the transaction slots:
+		ordertask.settings.maxTransactionsPerOrder = 2
+
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		task.startup()
 
@@ -684,6 +862,53 @@ class TestOrderTask(unittest.TestCase):
 		await self.shutdownOrderTask(task)
 
 
+	@asynciotest
+	async def test_buyer_repeatArchivedTransaction(self):
+		orderID = ordertask.BuyOrder.create(self.storage,
+			190000,   #mCent / BTC = 1.9 EUR/BTC
+			123400000 #mCent    = 1234 EUR
+			)
+		order = ordertask.BuyOrder(self.storage, orderID, 'buyerAddress')
+		order.remoteOfferID = 6
+		order.setAmount = Mock()
+
+		self.storage.archivedBuyTransactions = \
+		{
+		41:
+			{
+			'ID': 41,
+			'buyOrder': orderID,
+			'status': 4, #finished
+			'fiatAmount': 100000000,
+			'cryptoAmount': 200000000,
+			'paymentHash': b'foo',
+			'paymentPreimage': b'bar',
+			},
+		}
+
+		task = ordertask.OrderTask(self.client, self.storage, order)
+		task.startup()
+
+		await asyncio.sleep(0.1)
+
+		task.setCallResult(messages.LNIncoming(
+			offerID=42,
+			CLTVExpiryDelta=0,
+			fiatAmount=100000000,
+			cryptoAmount=200000000,
+			paymentHash=b'foo',
+			))
+
+		msg = await self.outgoingMessages.get()
+		self.assertEqual(msg, messages.LNFinish(
+			paymentHash     = b'foo',
+			paymentPreimage = b'bar'
+			))
+		self.assertEqual(self.storage.buyTransactions, {})
+
+		await self.shutdownOrderTask(task)
+
+
 	@asynciotest
 	async def test_buyer_repeatCanceledTransaction(self):
 		orderID = ordertask.BuyOrder.create(self.storage,
@@ -716,6 +941,9 @@ class TestOrderTask(unittest.TestCase):
 			}
 		}
 
+		#Transaction 42 takes one of the transaction slots:
+		ordertask.settings.maxTransactionsPerOrder = 2
+
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		task.startup()
 
@@ -756,11 +984,25 @@ class TestOrderTask(unittest.TestCase):
 		o1.toPB2 = Mock(return_value=toPB2_return)
 		o1.ask.max_amount = 1000 #BTC
 		o1.ask.max_amount_divisor = 1
+		o1.ask.currency = 'btc'
+		o1.ask.exchange = 'ln'
 		o1.bid.max_amount = 2000 #EUR
 		o1.bid.max_amount_divisor = 1
+		o1.bid.currency = 'eur'
+		o1.bid.exchange = 'bl3p.eu'
+		o1.conditions = {}
 		o1.ID = 6
 		o1.address = 'buyerAddress'
 
+		#Offer with a rate that is too low for our order:
+		o2 = Mock()
+		o2.ask = o1.ask
+		o2.bid.max_amount = 1800 #EUR
+		o2.bid.max_amount_divisor = 1
+		o2.bid.currency = 'eur'
+		o2.bid.exchange = 'bl3p.eu'
+		o2.conditions = {}
+
 		#We're going to match the sell order (order) twice with the
 		#counter-offer (o1).
 
@@ -816,18 +1058,18 @@ class TestOrderTask(unittest.TestCase):
 				))
 			task.setCallResult(messages.BL4PFindOffersResult(
 				request=None,
-				offers=[o1, Mock()],
+				offers=[o2, o1],
 				))
 
 			msg = await self.outgoingMessages.get()
 
-			#For now, behavior is to always select the first:
-			self.assertEqual(task.counterOffer, o1)
+			self.assertEqual(task.transactionTasks[0].counterOffer, o1)
 
 			self.assertEqual(self.storage.counterOffers, {43:
 				{
 				'ID': 43,
 				'blob': b'bar',
+				'hash': hashlib.sha256(b'bar').digest(),
 				}})
 			self.assertEqual(self.storage.sellTransactions, {44:
 				{
@@ -990,13 +1232,156 @@ class TestOrderTask(unittest.TestCase):
 				'paymentHash': paymentHash,
 				'paymentPreimage': paymentPreimage,
 				}})
-			self.assertEqual(task.transaction, None)
+			self.assertEqual(task.transactionTasks, [])
 
 		await task.waitFinished()
 
 		self.assertEqual(self.storage.sellOrders[orderID]['status'], 1) #completed
 
 
+	@asynciotest
+	async def test_seller_concurrentTransactions(self):
+		ordertask.settings.maxTransactionsPerOrder = 2
+
+		orderID = ordertask.SellOrder.create(self.storage,
+			190000,         #mCent / BTC = 1.9 EUR/BTC
+			123400000000000 #mSatoshi    = 1234 BTC
+			)
+		order = ordertask.SellOrder(self.storage, orderID, 'sellerAddress')
+
+		def makeOffer(ID):
+			return offer.Offer(
+				bid=offer.Asset(max_amount=2000, max_amount_divisor=1, currency='eur', exchange='bl3p.eu'),
+				ask=offer.Asset(max_amount=1000, max_amount_divisor=1, currency='btc', exchange='ln'),
+				address='buyerAddress', ID=ID,
+				)
+		offers = [makeOffer(6), makeOffer(7)]
+
+		task = ordertask.OrderTask(self.client, self.storage, order)
+		task.startup()
+
+		#First search: a transaction starts on the first offer
+		msg = await self.outgoingMessages.get()
+		self.assertTrue(isinstance(msg, messages.BL4PFindOffers))
+		task.setCallResult(messages.BL4PFindOffersResult(
+			request=msg,
+			offers=offers,
+			))
+
+		#Second search, while the first transaction is ongoing:
+		#a transaction starts on the other offer, for the remaining amount
+		received = [await self.outgoingMessages.get() for i in range(2)]
+		search = [m for m in received if isinstance(m, messages.BL4PFindOffers)][0]
+		task.setCallResult(messages.BL4PFindOffersResult(
+			request=search,
+			offers=offers,
+			))
+		received.append(await self.outgoingMessages.get())
+		starts = [m for m in received if isinstance(m, messages.BL4PStart)]
+
+		self.assertEqual(len(task.transactionTasks), 2)
+		self.assertEqual(
+			[t.counterOffer for t in task.transactionTasks],
+			offers)
+		self.assertEqual(
+			[t.reservedAmount for t in task.transactionTasks],
+			[100000000000000, 23400000000000]) #1000 BTC, 234 BTC
+		self.assertEqual(order.reservedAmount, order.amount)
+		self.assertEqual([m.amount for m in starts], [200000000, 46800000])
+
+		#No more transactions can be started:
+		self.assertFalse(task.canStartTransaction())
+		self.assertTrue(self.outgoingMessages.empty())
+
+		#Results are routed to the transaction that made the call:
+		for i in [1, 0]:
+			task.setCallResult(messages.BL4PStartResult(
+				request=starts[i],
+				senderAmount=starts[i].amount,
+				receiverAmount=starts[i].amount,
+				paymentHash=sha256(b'preimage%d' % i),
+				))
+			msg = await self.outgoingMessages.get()
+			self.assertEqual(msg.selfReport['paymentHash'], sha256(b'preimage%d' % i).hex())
+			self.assertEqual(msg.selfReport['offerID'], str(offers[i].ID))
+
+		await task.shutdown()
+		self.assertEqual(task.transactionTasks, [])
+		self.assertEqual(order.reservedAmount, 0)
+
+
+	@asynciotest
+	async def test_buyer_concurrentTransactions(self):
+		ordertask.settings.maxTransactionsPerOrder = 2
+
+		orderID = ordertask.BuyOrder.create(self.storage,
+			190000,   #mCent / BTC = 1.9 EUR/BTC
+			123400000 #mCent    = 1234 EUR
+			)
+		order = ordertask.BuyOrder(self.storage, orderID, 'buyerAddress')
+		order.remoteOfferID = 6
+		order.setAmount = Mock()
+
+		task = ordertask.OrderTask(self.client, self.storage, order)
+		task.startup()
+		await asyncio.sleep(0.1)
+
+		def makeIncoming(i):
+			return messages.LNIncoming(
+				offerID=42,
+				CLTVExpiryDelta=0,
+				fiatAmount=100000000,
+				cryptoAmount=100000000000000,
+				paymentHash=sha256(b'preimage%d' % i),
+				)
+
+		sends = []
+		for i in range(2):
+			task.setCallResult(makeIncoming(i))
+			msg = await self.outgoingMessages.get()
+			self.assertEqual(msg.paymentHash, sha256(b'preimage%d' % i))
+			sends.append(msg)
+
+		#The maximum number of transactions is reached:
+		with self.assertRaises(ordertask.UnexpectedResult):
+			task.setCallResult(makeIncoming(2))
+
+		#A repeated incoming transaction is refused while it is ongoing:
+		with self.assertRaises(ordertask.UnexpectedResult):
+			task.setCallResult(makeIncoming(0))
+
+		#Results are routed to the transaction that made the call:
+		for i in [1, 0]:
+			task.setCallResult(messages.BL4PSendResult(
+				request=sends[i],
+				paymentPreimage=b'preimage%d' % i,
+				))
+
+			msg = await self.outgoingMessages.get()
+			self.assertEqual(msg, messages.LNFinish(
+				paymentHash=sha256(b'preimage%d' % i),
+				paymentPreimage=b'preimage%d' % i,
+				))
+
+			#Offer gets re-published
+			msg = await self.outgoingMessages.get()
+			self.assertTrue(isinstance(msg, messages.BL4PRemoveOffer))
+			task.setCallResult(messages.BL4PRemoveOfferResult(
+				request=msg,
+				))
+			msg = await self.outgoingMessages.get()
+			self.assertTrue(isinstance(msg, messages.BL4PAddOffer))
+			task.setCallResult(messages.BL4PAddOfferResult(
+				request=msg,
+				ID=6,
+				))
+
+		await asyncio.sleep(0.1)
+		self.assertEqual(task.transactionTasks, [])
+
+		await self.shutdownOrderTask(task)
+
+
 	@asynciotest
 	async def test_continueSellTransaction(self):
 		orderID = ordertask.SellOrder.create(self.storage,
@@ -1106,7 +1491,7 @@ class TestOrderTask(unittest.TestCase):
 
 		task = ordertask.OrderTask(self.client, self.storage, order)
 		with self.assertRaises(Exception):
-			await task.continueSellTransaction()
+			await task.continueSellTransactions()
 
 
 	@asynciotest
@@ -1206,7 +1591,7 @@ class TestOrderTask(unittest.TestCase):
 			'buyerFiatAmount': 1200,
 			'paymentHash': b'foo',
 			}})
-		self.assertEqual(task.transaction, None)
+		self.assertEqual(task.transactionTasks, [])
 
 		await task.shutdown()
 
@@ -1229,6 +1614,37 @@ class TestOrderTask(unittest.TestCase):
 		self.assertEqual(value, 6)
 
 
+	@asynciotest
+	async def test_call_routing(self):
+		router = messages.Router()
+		router.startMessaging()
+		self.client.messageRouter = router
+		self.client.handleOutgoingMessage = router.handleMessage
+		task = ordertask.OrderTask(self.client, self.storage, None)
+
+		#A result that arrives before we wait for it:
+		def handleFindOffers(msg):
+			router.handleMessage(messages.BL4PFindOffersResult(
+				request=msg,
+				offers=[],
+				))
+		router.addHandler(messages.Handler({messages.BL4PFindOffers: handleFindOffers}))
+		request = messages.BL4PFindOffers(localOrderID=42, query=None)
+		result = await task.call(request, messages.BL4PFindOffersResult)
+		self.assertEqual(result, messages.BL4PFindOffersResult(request=request, offers=[]))
+		self.assertEqual(router.routes, {})
+
+		#A result for an interrupted call is not routed to the task:
+		router.addHandler(messages.Handler({messages.BL4PAddOffer: Mock()}))
+		request = messages.BL4PAddOffer(localOrderID=42, offer=None)
+		callTask = asyncio.ensure_future(task.call(request, messages.BL4PAddOfferResult))
+		await asyncio.sleep(0.1)
+		self.assertEqual(list(router.routes.values()), [task.setResultOfCall])
+		callTask.cancel()
+		await asyncio.sleep(0.1)
+		self.assertEqual(router.routes, {})
+
+
 	@asynciotest
 	async def test_doTrading_canceledOrder(self):
 		orderID = ordertask.BuyOrder.create(self.storage, 2, 1234)
@@ -1238,13 +1654,11 @@ class TestOrderTask(unittest.TestCase):
 
 		async def dummy():
 			pass
-		task.continueBuyTransaction = dummy
-		task.publishOffer = dummy
-		task.waitForIncomingTransaction = dummy
 		task.unpublishOffer = dummy
-		await task.doTrading()
+		await task.doTrading(dummy())
 
 		self.assertEqual(order.status, ORDER_STATUS_CANCELED)
+		self.assertTrue(task.finished)
 
 
 	@asynciotest
@@ -1253,7 +1667,7 @@ class TestOrderTask(unittest.TestCase):
 		task = ordertask.OrderTask(None, None, None)
 		with patch.object(logging, 'exception', Mock()) as logException:
 			with self.assertRaises(Exception):
-				await task.doTrading()
+				await task.doTrading(task.startTrading())
 			logException.assert_called_once()
 
 		#Canceled exception:
@@ -1261,28 +1675,40 @@ class TestOrderTask(unittest.TestCase):
 		order = ordertask.BuyOrder(self.storage, orderID, 'lnAddress')
 		task = ordertask.OrderTask(Mock(), None, order)
 
-		async def continueBuyTransaction():
+		async def continueBuyTransactions():
 			raise asyncio.CancelledError()
 
-		with patch.object(task, 'continueBuyTransaction', continueBuyTransaction):
+		with patch.object(task, 'continueBuyTransactions', continueBuyTransactions):
 			#No exception:
-			await task.doTrading()
+			await task.doTrading(task.startTrading())
 
 
 	@asynciotest
-	async def test_doOfferSearch_loop(self):
-		order = Mock()
-		order.ID = 42
+	async def test_doOfferSearch(self):
+		order = offer.Offer(
+			bid=offer.Asset(max_amount=1000, max_amount_divisor=100, currency='btc', exchange='ln'),
+			ask=offer.Asset(max_amount=2000, max_amount_divisor=100, currency='eur', exchange='bl3p.eu'),
+			address='foo', ID=42,
+			)
 		order.remoteOfferID = None
-		task = ordertask.OrderTask(self.client, None, order)
+		order.status = ORDER_STATUS_ACTIVE
+		order.amount = 1000
+		order.reservedAmount = 0
+		task = ordertask.OrderTask(self.client, self.storage, order)
 
 		done = []
-		async def doTransaction():
-			self.assertEqual(done, [])
-			done.append(True)
-		task.doTransaction = doTransaction
-
-		searchTask = asyncio.ensure_future(task.doOfferSearch())
+		transactionFinished = asyncio.Future()
+		def createSellTransaction(transactionTask):
+			pass
+		async def startTransactionOnBL4P(transactionTask):
+			await transactionFinished
+			done.append(transactionTask.counterOffer)
+		patcher = patch.multiple(ordertask.TransactionTask,
+			createSellTransaction=createSellTransaction,
+			startTransactionOnBL4P=startTransactionOnBL4P,
+			)
+		patcher.start()
+		self.addCleanup(patcher.stop)
 
 		#No BL4P connection:
 		received = []
@@ -1290,7 +1716,8 @@ class TestOrderTask(unittest.TestCase):
 			received.append(msg)
 			raise messages.NoMessageHandler()
 		with patch.object(self.client, 'handleOutgoingMessage', raiseNoMessageHandler):
-			await asyncio.sleep(1)
+			delay = await task.doOfferSearch()
+		self.assertEqual(delay, 1.0)
 		self.assertEqual(received, [messages.BL4PFindOffers(
 			localOrderID=42,
 
@@ -1298,6 +1725,7 @@ class TestOrderTask(unittest.TestCase):
 			)])
 
 		#No results:
+		searchTask = asyncio.ensure_future(task.doOfferSearch())
 		msg = await self.outgoingMessages.get()
 		self.assertEqual(msg, messages.BL4PFindOffers(
 			localOrderID=42,
@@ -1321,11 +1749,12 @@ class TestOrderTask(unittest.TestCase):
 			ID = 6,
 			))
 
+		#The search interval has backed off after the failed searches.
+		self.assertEqual(await searchTask, 2.0)
+
 		#No results again:
-		t0 = time.time()
+		searchTask = asyncio.ensure_future(task.doOfferSearch())
 		msg = await self.outgoingMessages.get()
-		t1 = time.time()
-		self.assertAlmostEqual(t1-t0, 1.0, places=2)
 		self.assertEqual(msg, messages.BL4PFindOffers(
 			localOrderID=42,
 
@@ -1335,16 +1764,22 @@ class TestOrderTask(unittest.TestCase):
 			request = None,
 			offers = [],
 			))
+		self.assertEqual(await searchTask, 4.0)
 		self.assertEqual(order.remoteOfferID, 6)
 
 		#Multiple results:
 		#Non-matching offers returned by BL4P must not be selected.
-		offer0 = Mock()
-		offer1 = Mock()
-		offer2 = Mock()
-		offer0.matches = Mock(return_value = False)
-		offer1.matches = Mock(return_value = True)
-		offer2.matches = Mock(return_value = True)
+		#Of the matching offers, the one with the best rate is selected.
+		def makeOffer(bid, ask, ID):
+			return offer.Offer(
+				bid=offer.Asset(max_amount=bid, max_amount_divisor=100, currency='eur', exchange='bl3p.eu'),
+				ask=offer.Asset(max_amount=ask, max_amount_divisor=100, currency='btc', exchange='ln'),
+				address='bar', ID=ID,
+				)
+		offer0 = makeOffer(1000, 1000, 0) #rate too low
+		offer1 = makeOffer(2500, 1000, 1)
+		offer2 = makeOffer(2000, 1000, 2)
+		searchTask = asyncio.ensure_future(task.doOfferSearch())
 		msg = await self.outgoingMessages.get()
 		self.assertEqual(msg, messages.BL4PFindOffers(
 			localOrderID=42,
@@ -1353,17 +1788,23 @@ class TestOrderTask(unittest.TestCase):
 			))
 		task.setCallResult(messages.BL4PFindOffersResult(
 			request = None,
-			offers = [offer0, offer1, offer2],
+			offers = [offer0, offer2, offer1],
 			))
 
-		await searchTask
+		#The transaction has to finish before the next search:
+		self.assertEqual(await searchTask, None)
+		self.assertEqual(self.client.backend.offerSearchScheduler.searches[42].interval, 1.0)
+		self.assertEqual(len(task.transactionTasks), 1)
+		self.assertEqual(await task.doOfferSearch(), None)
+
+		transactionFinished.set_result(None)
+		await asyncio.sleep(0.1)
+		self.assertEqual(done, [offer1])
+		self.assertEqual(task.transactionTasks, [])
+		for o in [offer0, offer1, offer2]:
+			self.assertEqual(o.matches(order), o is not offer0)
 
-		self.assertEqual(done, [True])
-		self.assertEqual(task.counterOffer, offer1)
 
-		offer0.matches.assert_called_with(order)
-		offer1.matches.assert_called_with(order)
-		offer2.matches.assert_called_with(order)
 
 
 
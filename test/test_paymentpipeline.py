@@ -0,0 +1,120 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+from utils import asynciotest
+
+sys.path.append('..')
+
+import messages
+import metrics
+import paymentpipeline
+
+
+
+class TestPaymentPipeline(unittest.TestCase):
+	def setUp(self):
+		self.startPayment = Mock()
+		self.handleTimeout = Mock()
+		self.pipeline = paymentpipeline.PaymentPipeline(
+			self.startPayment, self.handleTimeout, maxInFlight=2)
+
+		self.messages = \
+		[
+		messages.LNPay(
+			localOrderID = 6,
+			destinationNodeID = 'Destination',
+			maxSenderCryptoAmount = 1248,
+			recipientCryptoAmount = 1234,
+			minCLTVExpiryDelta = 42,
+			fiatAmount = 0xdeadbeef,
+			offerID = 0x8008,
+			paymentHash = b'hash%d' % i,
+			)
+		for i in range(3)
+		]
+
+
+	@asynciotest
+	async def test_maxInFlight(self):
+		msgs = self.messages
+		for m in msgs:
+			self.pipeline.submit(m)
+		self.assertEqual([c[0][0] for c in self.startPayment.call_args_list], msgs[:2])
+		self.assertEqual(list(self.pipeline.queue), msgs[2:])
+
+		#Duplicates are ignored:
+		self.pipeline.submit(self.messages[0])
+		self.pipeline.submit(self.messages[2])
+		self.assertEqual(len(self.pipeline.queue), 1)
+
+		#Finishing a payment starts the next one:
+		self.pipeline.setStage(b'hash0', 'getroute')
+		self.pipeline.finish(b'hash0')
+		self.assertEqual(self.startPayment.call_args[0][0], msgs[2])
+		self.assertEqual(set(self.pipeline.inFlight.keys()), set([b'hash1', b'hash2']))
+		self.assertEqual(len(self.pipeline.queue), 0)
+
+
+	@asynciotest
+	@patch.object(metrics, 'registry', metrics.Registry())
+	async def test_stages(self):
+		def getCount(name):
+			return metrics.registry.histogram('rpc.payment.' + name).count
+
+		self.pipeline.submit(self.messages[0])
+		self.assertFalse(self.pipeline.isAtStage(b'hash0', 'getroute'))
+
+		self.pipeline.setStage(b'hash0', 'getroute')
+		self.assertTrue(self.pipeline.isAtStage(b'hash0', 'getroute'))
+		self.pipeline.setStage(b'hash0', 'createonion')
+		self.assertFalse(self.pipeline.isAtStage(b'hash0', 'getroute'))
+		self.assertTrue(self.pipeline.isAtStage(b'hash0', 'createonion'))
+		self.assertEqual(getCount('getroute'), 1)
+		self.assertEqual(getCount('createonion'), 0)
+
+		self.pipeline.finish(b'hash0')
+		self.assertFalse(self.pipeline.isAtStage(b'hash0', 'createonion'))
+		self.assertEqual(getCount('createonion'), 1)
+		self.assertEqual(getCount('total'), 1)
+
+
+	@asynciotest
+	async def test_stageTimeout(self):
+		self.pipeline.stageTimeouts['getroute'] = 0.01
+		self.pipeline.stageTimeouts['createonion'] = 0.01
+		msg = self.messages[0]
+		self.pipeline.submit(msg)
+
+		#Leaving the stage in time cancels the timeout:
+		self.pipeline.setStage(b'hash0', 'getroute')
+		self.pipeline.setStage(b'hash0', 'getinfo')
+		await asyncio.sleep(0.05)
+		self.handleTimeout.assert_not_called()
+
+		self.pipeline.setStage(b'hash0', 'createonion')
+		await asyncio.sleep(0.05)
+		self.handleTimeout.assert_called_once_with(msg, 'createonion')
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
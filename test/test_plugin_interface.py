@@ -27,6 +27,7 @@ from utils import asynciotest, DummyReader, DummyWriter
 sys.path.append('..')
 
 import messages
+import metrics
 import plugin_interface
 
 
@@ -73,7 +74,7 @@ class TestPluginInterface(unittest.TestCase):
 
 		self.interface.handleIncomingData = setCalled
 		self.input.buffer =  b'{"id": 0, "method": "getmanifest", "params": {}}\n\n'
-		self.input.buffer += b'{"id": 1, "method": "init", "params": {"options": {"bl4p.logfile": "foo", "bl4p.dbfile": "bar"}, "configuration": {"lightning-dir": "foobar", "rpc-file": "baz"}}}\n\n'
+		self.input.buffer += b'{"id": 1, "method": "init", "params": {"options": {"bl4p.logfile": "foo", "bl4p.dbfile": "bar", "bl4p.loglevel": "WARNING", "bl4p.maxpaymentsinflight": "10"}, "configuration": {"lightning-dir": "foobar", "rpc-file": "baz"}}}\n\n'
 		await self.interface.startup()
 		await asyncio.sleep(0.1)
 		await self.interface.shutdown()
@@ -85,15 +86,19 @@ class TestPluginInterface(unittest.TestCase):
 		obj, length = json.JSONDecoder().raw_decode(output[0].decode('UTF-8'))
 		self.assertEqual(obj['id'], 0)
 		obj = obj['result']
-		self.assertEqual(obj['subscriptions'], [])
+		self.assertEqual(obj['subscriptions'], ['block_added'])
 		self.assertEqual(obj['options'][0]['name'], 'bl4p.logfile')
 		self.assertEqual(obj['options'][0]['default'], 'bl4p.log')
 		self.assertEqual(obj['options'][1]['name'], 'bl4p.dbfile')
 		self.assertEqual(obj['options'][1]['default'], 'bl4p.db')
+		self.assertEqual(obj['options'][2]['name'], 'bl4p.loglevel')
+		self.assertEqual(obj['options'][2]['default'], 'INFO')
+		self.assertEqual(obj['options'][3]['name'], 'bl4p.maxpaymentsinflight')
+		self.assertEqual(obj['options'][3]['default'], '100')
 		self.assertEqual(obj['hooks'], ['htlc_accepted'])
 		names = [m['name'] for m in obj['rpcmethods']]
 		self.assertEqual(set(names),
-			set(['bl4p.getfiatcurrency', 'bl4p.getcryptocurrency', 'bl4p.buy', 'bl4p.sell', 'bl4p.list', 'bl4p.cancel', 'bl4p.setconfig', 'bl4p.getconfig']))
+			set(['bl4p.getfiatcurrency', 'bl4p.getcryptocurrency', 'bl4p.buy', 'bl4p.sell', 'bl4p.list', 'bl4p.cancel', 'bl4p.setconfig', 'bl4p.getconfig', 'bl4p.stats']))
 
 		#init output
 		self.checkJSON(output[1],
@@ -107,6 +112,26 @@ class TestPluginInterface(unittest.TestCase):
 		self.assertEqual(self.interface.RPCPath, 'foobar/baz')
 		self.assertEqual(self.interface.logFile, 'foo')
 		self.assertEqual(self.interface.DBFile, 'bar')
+		self.assertEqual(self.interface.logLevel, 'WARNING')
+		self.assertEqual(self.interface.maxPaymentsInFlight, 10)
+
+
+	def test_init_badLogLevel(self):
+		for value in ['info', 'VERBOSE', '10', '']:
+			with self.assertRaises(ValueError):
+				self.interface.init(
+					options = {'bl4p.logfile': 'foo', 'bl4p.dbfile': 'bar', 'bl4p.loglevel': value, 'bl4p.maxpaymentsinflight': '100'},
+					configuration = {'lightning-dir': 'foobar', 'rpc-file': 'baz'},
+					)
+
+
+	def test_init_badMaxPaymentsInFlight(self):
+		for value in ['0', '-1', 'foo', '']:
+			with self.assertRaises(ValueError):
+				self.interface.init(
+					options = {'bl4p.logfile': 'foo', 'bl4p.dbfile': 'bar', 'bl4p.loglevel': 'INFO', 'bl4p.maxpaymentsinflight': value},
+					configuration = {'lightning-dir': 'foobar', 'rpc-file': 'baz'},
+					)
 
 
 	@asynciotest
@@ -117,24 +142,32 @@ class TestPluginInterface(unittest.TestCase):
 
 
 	def test_ongoingRequests(self):
+		def makeRequest(paymentHash):
+			req = plugin_interface.OngoingRequest()
+			req.paymentHash = paymentHash
+			return req
+
 		self.interface.currentRequestID = 6
-		self.interface.storeOngoingRequest('foo', 'bar')
+		self.interface.storeOngoingRequest('foo', makeRequest(b'bar'))
 		self.interface.currentRequestID = 7
-		self.interface.storeOngoingRequest('foo', 'baz')
-
-		self.assertEqual(
-			self.interface.findOngoingRequest('foo', lambda s: s=='bar'),
-			6)
-		self.assertEqual(
-			self.interface.findOngoingRequest('foo', lambda s: s=='baz'),
-			7)
+		self.interface.storeOngoingRequest('foo', makeRequest(b'baz'))
+		self.interface.currentRequestID = 8
+		self.interface.storeOngoingRequest('foo', makeRequest(b'bar'))
+
+		self.assertEqual(self.interface.findOngoingRequest('foo', b'bar'), 6)
+		self.assertEqual(self.interface.findOngoingRequest('foo', b'baz'), 7)
+		with self.assertRaises(IndexError):
+			self.interface.findOngoingRequest('foo', b'baa')
 		with self.assertRaises(IndexError):
-			self.interface.findOngoingRequest('foo', lambda s: s=='baa')
+			self.interface.findOngoingRequest('fuu', b'bar')
 
 		self.interface.sendOngoingRequestResponse(6, 'response')
+		self.assertEqual(self.interface.findOngoingRequest('foo', b'bar'), 8)
 
+		self.interface.sendOngoingRequestResponse(8, 'response')
 		with self.assertRaises(IndexError):
-			self.interface.findOngoingRequest('foo', lambda s: s=='bar')
+			self.interface.findOngoingRequest('foo', b'bar')
+		self.assertEqual(list(self.interface.ongoingRequestIndex.keys()), [('foo', b'baz')])
 
 
 	def test_GetFiatCurrency(self):
@@ -294,6 +327,26 @@ class TestPluginInterface(unittest.TestCase):
 			})
 
 
+	def test_stats(self):
+		registry = metrics.Registry()
+		registry.counter('foo').increment()
+		registry.gauge('bar').set(2)
+		registry.histogram('baz').add(0.5)
+		with patch.object(metrics, 'registry', registry):
+			self.interface.handleRequest(6, 'bl4p.stats', {})
+		self.checkJSONOutput(
+			{
+			'jsonrpc': '2.0',
+			'id': 6,
+			'result':
+				{
+				'counters': {'foo': 1},
+				'gauges': {'bar': 2},
+				'histograms': {'baz': registry.histogram('baz').getInfo()},
+				},
+			})
+
+
 	def test_handleHTLCAccepted_goodFlow(self):
 		self.interface.handleRequest(
 			6,
@@ -451,6 +504,20 @@ class TestPluginInterface(unittest.TestCase):
 		self.assertEqual(self.output.buffer, b'')
 
 
+	def test_handleBlockAdded(self):
+		self.interface.handleNotification('block_added',
+			{'block_added': {'hash': '00ff', 'height': 123456}})
+		self.client.handleIncomingMessage.assert_called_once_with(
+			messages.LNBlockAdded(height = 123456))
+
+		#Older lightningd versions:
+		self.client.handleIncomingMessage.reset_mock()
+		self.interface.handleNotification('block_added',
+			{'block': {'hash': '00ff', 'height': 123457}})
+		self.client.handleIncomingMessage.assert_called_once_with(
+			messages.LNBlockAdded(height = 123457))
+
+
 	def test_invalidRequest(self):
 		m = Mock(return_value=None)
 		with patch.object(logging, 'exception', m):
@@ -0,0 +1,128 @@
+#    Copyright (C) 2021 by Bitonic B.V.
+#
+#    This file is part of the BL4P Client.
+#
+#    The BL4P Client is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    The BL4P Client is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with the BL4P Client. If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append('..')
+
+import metrics
+import routecache
+
+
+
+class TestRouteCache(unittest.TestCase):
+	def setUp(self):
+		self.route = \
+		[
+		{'id': 'A', 'channel': '1x1x1', 'msatoshi': 1300, 'amount_msat': '1300msat', 'delay': 20},
+		{'id': 'B', 'channel': '2x2x2', 'msatoshi': 1200, 'amount_msat': '1200msat', 'delay': 15},
+		{'id': 'C', 'channel': '3x3x3', 'msatoshi': 1000, 'amount_msat': '1000msat', 'delay': 10},
+		]
+
+
+	def test_getAmountBucket(self):
+		self.assertEqual(routecache.getAmountBucket(0), 0)
+		self.assertEqual(routecache.getAmountBucket(1024), routecache.getAmountBucket(1070))
+		self.assertNotEqual(routecache.getAmountBucket(1024), routecache.getAmountBucket(1200))
+
+
+	def test_adjustRoute(self):
+		route = copy.deepcopy(self.route)
+
+		#Larger amount: proportionally larger fees
+		newRoute = routecache.adjustRoute(route, 1000, 1050)
+		self.assertEqual([h['msatoshi'] for h in newRoute], [1365, 1260, 1050])
+		self.assertEqual([h['amount_msat'] for h in newRoute], ['1365msat', '1260msat', '1050msat'])
+		self.assertEqual([h['delay'] for h in newRoute], [20, 15, 10])
+
+		#Smaller amount: the same fees
+		newRoute = routecache.adjustRoute(route, 1000, 950)
+		self.assertEqual([h['msatoshi'] for h in newRoute], [1250, 1150, 950])
+
+		#The original is not modified:
+		self.assertEqual(route, self.route)
+
+
+	@patch.object(metrics, 'registry', metrics.Registry())
+	def test_getPut(self):
+		def getCounts():
+			return (
+				metrics.registry.counter('routecache.hits').value,
+				metrics.registry.counter('routecache.misses').value,
+				)
+
+		cache = routecache.RouteCache()
+		self.assertEqual(cache.get('C', 1000, 10), None)
+		self.assertEqual(getCounts(), (0, 1))
+
+		cache.put('C', 1000, 10, self.route)
+		self.assertEqual(cache.get('C', 1000, 10), self.route)
+		self.assertEqual([h['msatoshi'] for h in cache.get('C', 1020, 10)], [1326, 1224, 1020])
+		self.assertEqual(getCounts(), (2, 1))
+
+		#Different key:
+		self.assertEqual(cache.get('D', 1000, 10), None)
+		self.assertEqual(cache.get('C', 2000, 10), None)
+		self.assertEqual(cache.get('C', 1000, 11), None)
+		self.assertEqual(getCounts(), (2, 4))
+
+		#Empty routes are not stored:
+		cache.put('D', 1000, 10, [])
+		self.assertEqual(cache.get('D', 1000, 10), None)
+
+
+	def test_TTL(self):
+		cache = routecache.RouteCache(TTL=10.0)
+		with patch.object(routecache.time, 'monotonic', lambda: 100.0):
+			cache.put('C', 1000, 10, self.route)
+		with patch.object(routecache.time, 'monotonic', lambda: 110.0):
+			self.assertEqual(cache.get('C', 1000, 10), self.route)
+		with patch.object(routecache.time, 'monotonic', lambda: 110.1):
+			self.assertEqual(cache.get('C', 1000, 10), None)
+		self.assertEqual(len(cache.entries), 0)
+
+
+	def test_LRU(self):
+		cache = routecache.RouteCache(maxSize=2)
+		cache.put('A', 1000, 10, self.route)
+		cache.put('B', 1000, 10, self.route)
+		cache.get('A', 1000, 10)
+		cache.put('C', 1000, 10, self.route)
+
+		self.assertEqual(cache.get('B', 1000, 10), None) #least recently used
+		self.assertNotEqual(cache.get('A', 1000, 10), None)
+		self.assertNotEqual(cache.get('C', 1000, 10), None)
+
+
+	def test_invalidate(self):
+		cache = routecache.RouteCache()
+		cache.put('A', 1000, 10, self.route)
+		cache.put('A', 2000, 10, self.route)
+		cache.put('B', 1000, 10, self.route)
+		cache.invalidate('A')
+
+		self.assertEqual(cache.get('A', 1000, 10), None)
+		self.assertEqual(cache.get('A', 2000, 10), None)
+		self.assertNotEqual(cache.get('B', 1000, 10), None)
+
+
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
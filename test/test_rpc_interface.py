@@ -19,13 +19,14 @@ import asyncio
 import json
 import sys
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from utils import asynciotest, DummyReader, DummyWriter
 
 sys.path.append('..')
 
 import messages
+import metrics
 import rpc_interface
 
 
@@ -43,14 +44,18 @@ class TestRPCInterface(unittest.TestCase):
 		self.assertEqual(self.rpc.inputStream, self.input)
 		self.assertEqual(self.rpc.outputStream, self.output)
 		self.assertEqual(self.rpc.client, self.client)
-		self.assertEqual(self.rpc.handlerMethods, {messages.LNPay: self.rpc.sendPay})
+		self.assertEqual(self.rpc.handlerMethods,
+			{
+			messages.LNPay       : self.rpc.sendPay,
+			messages.LNBlockAdded: self.rpc.handleBlockAdded,
+			})
 
 		called = []
 		async def setCalled():
 			called.append(True)
 
 		self.rpc.handleIncomingData = setCalled
-		self.input.buffer = b'{"id": 0, "result": {"id": "foo"}}\n\n'
+		self.input.buffer = b'{"id": 0, "result": {"id": "foo", "blockheight": 123456}}\n\n'
 		await self.rpc.startupRPC()
 		await asyncio.sleep(0.1)
 		await self.rpc.shutdown()
@@ -58,6 +63,8 @@ class TestRPCInterface(unittest.TestCase):
 		self.assertEqual(called, [True])
 		self.assertEqual(self.input.buffer, b'')
 		self.assertEqual(self.rpc.nodeID, 'foo')
+		self.assertEqual(self.rpc.blockHeight, 123456)
+		self.assertEqual(self.rpc.blockHeightTask, None)
 
 
 	def checkJSONOutput(self, reference):
@@ -196,6 +203,103 @@ class TestRPCInterface(unittest.TestCase):
 			))
 
 
+	def test_sendPay_knownBlockHeight(self):
+		self.rpc.blockHeight = 123456
+		self.rpc.handleMessage(messages.LNPay(
+			localOrderID = 6,
+			destinationNodeID = 'Destination',
+			maxSenderCryptoAmount = 1248,
+			recipientCryptoAmount = 1234,
+			minCLTVExpiryDelta = 42,
+			fiatAmount = 0xdeadbeef,
+			offerID = 0x8008,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			))
+		self.output.buffer = b''
+
+		self.rpc.handleResult(0,
+			{
+			'route':
+				[
+				{
+				'id': 'Intermediate',
+				'msatoshi': 1247,
+				'delay': 12,
+				'channel': '103x1x1',
+				'style': 'legacy'
+				},
+				{
+				'id': 'Destination',
+				'msatoshi': 1234,
+				'delay': 10,
+				'channel': '199x2x3',
+				'style': 'legacy'
+				},
+				],
+			})
+
+		#No getinfo call:
+		self.checkJSONOutput(
+			{
+			'jsonrpc': '2.0',
+			'id': 1,
+			'method': 'createonion',
+			'params':
+				{
+				'hops':
+					[
+					{'payload': '000000c7000002000300000000000004d20001e24a000000000000000000000000000000000000000000000000', 'pubkey': 'Intermediate'},
+					{'payload': '12fe424c34500c00000000deadbeef00008008', 'pubkey': 'Destination'}
+					],
+				'assocdata': '0123456789abcdef',
+				}
+			})
+
+
+	@patch.object(metrics, 'registry', metrics.Registry())
+	def test_sendPay_routeCache(self):
+		self.rpc.blockHeight = 123456
+		def makeMessage(amount, maxSenderCryptoAmount, paymentHash):
+			return messages.LNPay(
+				localOrderID = 6,
+				destinationNodeID = 'Destination',
+				maxSenderCryptoAmount = maxSenderCryptoAmount,
+				recipientCryptoAmount = amount,
+				minCLTVExpiryDelta = 42,
+				fiatAmount = 0xdeadbeef,
+				offerID = 0x8008,
+				paymentHash = paymentHash,
+				)
+		route = \
+		[
+		{'id': 'Intermediate', 'msatoshi': 1247, 'delay': 12, 'channel': '103x1x1', 'style': 'legacy'},
+		{'id': 'Destination' , 'msatoshi': 1234, 'delay': 10, 'channel': '199x2x3', 'style': 'legacy'},
+		]
+
+		self.rpc.handleMessage(makeMessage(1234, 1248, b'hash0'))
+		self.assertEqual(self.rpc.ongoingRequests[0][0], 'getroute')
+		self.rpc.handleResult(0, {'route': route})
+		self.assertEqual(self.rpc.ongoingRequests[1][0], 'createonion')
+
+		#Cache hit: no getroute
+		self.rpc.handleMessage(makeMessage(1240, 1260, b'hash1'))
+		name, message = self.rpc.ongoingRequests[2]
+		self.assertEqual(name, 'createonion')
+		self.assertEqual([h['msatoshi'] for h in message.route], [1254, 1240])
+		self.assertEqual(message.senderCryptoAmount, 1254)
+		self.assertEqual(metrics.registry.getInfo()['counters'],
+			{'routecache.hits': 1, 'routecache.misses': 1})
+
+		#Cached route is too expensive: getroute
+		self.rpc.handleMessage(makeMessage(1240, 1250, b'hash2'))
+		self.assertEqual(self.rpc.ongoingRequests[3][0], 'getroute')
+
+		#Payment failure invalidates the cache:
+		self.rpc.handleError(2, 203, 'Transaction was refused')
+		self.rpc.handleMessage(makeMessage(1234, 1248, b'hash3'))
+		self.assertEqual(self.rpc.ongoingRequests[4][0], 'getroute')
+
+
 	def test_sendPay_maxSenderCryptoAmountExceeded(self):
 		msg = messages.LNPay(
 			localOrderID = 6,
@@ -218,11 +322,18 @@ class TestRPCInterface(unittest.TestCase):
 			'params': {'cltv': 42, 'id': 'Destination', 'msatoshi': 1234, 'riskfactor': 1},
 			})
 
-		with self.assertRaises(Exception):
-			self.rpc.handleResult(0,
-				{
-				'route': [{'msatoshi': 1249}, {'msatoshi': 1234}],
-				})
+		self.rpc.handleResult(0,
+			{
+			'route': [{'msatoshi': 1249}, {'msatoshi': 1234}],
+			})
+
+		self.client.handleIncomingMessage.assert_called_once_with(messages.LNPayResult(
+			localOrderID = 6,
+			senderCryptoAmount = 0,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			paymentPreimage = None,
+			))
+		self.assertEqual(self.rpc.paymentPipeline.inFlight, {})
 
 
 	def test_sendPay_recipientRefusedTransaction(self):
@@ -294,6 +405,319 @@ class TestRPCInterface(unittest.TestCase):
 			))
 
 
+	@asynciotest
+	async def test_sendPay_timeout(self):
+		self.rpc.paymentPipeline.stageTimeouts['getroute'] = 0.01
+		msg = messages.LNPay(
+			localOrderID = 6,
+			destinationNodeID = 'Destination',
+			maxSenderCryptoAmount = 1248,
+			recipientCryptoAmount = 1234,
+			minCLTVExpiryDelta = 42,
+			fiatAmount = 0xdeadbeef,
+			offerID = 0x8008,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			)
+
+		self.rpc.handleMessage(msg)
+		await asyncio.sleep(0.05)
+
+		self.client.handleIncomingMessage.assert_called_once_with(messages.LNPayResult(
+			localOrderID = 6,
+			senderCryptoAmount = 0,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			paymentPreimage = None,
+			))
+		self.assertEqual(self.rpc.paymentPipeline.inFlight, {})
+
+		#A late result is ignored:
+		self.output.buffer = b''
+		self.rpc.handleResult(0, {'route': [{'msatoshi': 1247}, {'msatoshi': 1234}]})
+		self.assertEqual(self.output.buffer, b'')
+
+
+	def startPaymentUntilSendOnion(self):
+		self.rpc.handleMessage(messages.LNPay(
+			localOrderID = 6,
+			destinationNodeID = 'Destination',
+			maxSenderCryptoAmount = 1248,
+			recipientCryptoAmount = 1234,
+			minCLTVExpiryDelta = 42,
+			fiatAmount = 0xdeadbeef,
+			offerID = 0x8008,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			))
+		self.rpc.handleResult(0, {'route': [{'id': 'Destination', 'msatoshi': 1247, 'delay': 10, 'channel': '199x2x3', 'style': 'legacy'}]})
+		self.rpc.handleResult(1, {'blockheight': 123456})
+		self.rpc.handleResult(2, {'onion': 'The onion', 'shared_secrets': ['Secret 1']})
+		self.output.buffer = b''
+
+
+	def checkPaymentFailed(self):
+		self.client.handleIncomingMessage.assert_called_once_with(messages.LNPayResult(
+			localOrderID = 6,
+			senderCryptoAmount = 1247,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			paymentPreimage = None,
+			))
+		self.assertEqual(self.rpc.paymentPipeline.inFlight, {})
+
+
+	def checkWaitSendPay(self, ID):
+		self.checkJSONOutput(
+			{
+			'jsonrpc': '2.0',
+			'id': ID,
+			'method': 'waitsendpay',
+			'params':
+				{
+				'payment_hash': '0123456789abcdef',
+				},
+			})
+
+
+	def test_sendPay_sendOnionError(self):
+		self.startPaymentUntilSendOnion()
+
+		self.rpc.handleError(3, 204, 'Failure along route')
+
+		self.checkPaymentFailed()
+
+
+	def test_sendPay_sendOnionInProgress(self):
+		self.startPaymentUntilSendOnion()
+
+		self.rpc.handleError(3, 200, 'Payment is in progress')
+
+		self.checkWaitSendPay(4)
+		self.assertTrue(self.rpc.paymentPipeline.isAtStage(bytes.fromhex('0123456789abcdef'), 'waitsendpay'))
+
+
+	def test_sendPay_waitSendPayError(self):
+		self.startPaymentUntilSendOnion()
+		self.rpc.handleResult(3, {})
+
+		self.rpc.handleError(4, 204, 'Failure along route')
+
+		self.checkPaymentFailed()
+
+
+	def test_sendPay_waitSendPayInProgress(self):
+		self.startPaymentUntilSendOnion()
+		self.rpc.handleResult(3, {})
+		self.output.buffer = b''
+
+		self.rpc.handleError(4, 200, 'Timed out')
+
+		self.checkWaitSendPay(5)
+		self.client.handleIncomingMessage.assert_not_called()
+
+		self.rpc.handleResult(5, {'status': 'complete', 'payment_preimage': 'cafecafe'})
+
+		self.client.handleIncomingMessage.assert_called_once_with(messages.LNPayResult(
+			localOrderID = 6,
+			senderCryptoAmount = 1247,
+			paymentHash = bytes.fromhex('0123456789abcdef'),
+			paymentPreimage = bytes.fromhex('cafecafe'),
+			))
+		self.assertEqual(self.rpc.paymentPipeline.inFlight, {})
+
+
+	@asynciotest
+	async def test_sendPay_waitSendPayTimeout(self):
+		self.rpc.paymentPipeline.stageTimeouts['waitsendpay'] = 0.01
+		self.startPaymentUntilSendOnion()
+		self.rpc.handleResult(3, {})
+		self.output.buffer = b''
+
+		await asyncio.sleep(0.015)
+
+		#The payment is not canceled, but lightningd is asked again:
+		self.checkWaitSendPay(5)
+		self.client.handleIncomingMessage.assert_not_called()
+
+		#The timeout is re-armed:
+		self.output.buffer = b''
+		await asyncio.sleep(0.015)
+		self.checkWaitSendPay(6)
+
+		#The first result finishes the payment; later ones are ignored:
+		self.rpc.handleError(4, 204, 'Failure along route')
+		self.rpc.handleError(5, 204, 'Failure along route')
+		self.checkPaymentFailed()
+
+
+	def test_blockHeight(self):
+		self.assertEqual(self.rpc.blockHeight, None)
+
+		self.rpc.handleMessage(messages.LNBlockAdded(height = 100))
+		self.assertEqual(self.rpc.blockHeight, 100)
+		self.rpc.handleMessage(messages.LNBlockAdded(height = 101))
+		self.assertEqual(self.rpc.blockHeight, 101)
+
+		#Never goes back:
+		self.rpc.setBlockHeight(99)
+		self.assertEqual(self.rpc.blockHeight, 101)
+
+		#Refresh results:
+		self.rpc.sendStoredRequest(rpc_interface.blockHeightRefreshMessage(height=0), 'getinfo', {})
+		self.rpc.handleResult(0, {'blockheight': 102})
+		self.assertEqual(self.rpc.blockHeight, 102)
+
+
+	@asynciotest
+	async def test_refreshBlockHeight(self):
+		with patch.object(rpc_interface, 'BLOCKHEIGHT_REFRESH_INTERVAL', 0.1):
+			task = asyncio.ensure_future(self.rpc.refreshBlockHeight())
+
+			#Refreshes immediately if the block height is unknown:
+			await asyncio.sleep(0.05)
+			self.checkJSONOutput({'jsonrpc': '2.0', 'id': 0, 'method': 'getinfo', 'params': {}})
+			self.rpc.handleResult(0, {'blockheight': 100})
+
+			#No refresh if it's up-to-date:
+			await asyncio.sleep(0.07)
+			self.rpc.handleMessage(messages.LNBlockAdded(height = 101))
+			await asyncio.sleep(0.07)
+			self.assertEqual(self.output.buffer, b'')
+
+			#Refresh if it's getting old:
+			await asyncio.sleep(0.07)
+			self.checkJSONOutput({'jsonrpc': '2.0', 'id': 1, 'method': 'getinfo', 'params': {}})
+
+			task.cancel()
+			await task
+
+
+	@asynciotest
+	async def test_connectionPool(self):
+		class BlockingReader:
+			async def read(self, n):
+				await asyncio.Future() #never finishes
+
+		connections = []
+		async def open_unix_connection(path):
+			self.assertEqual(path, 'foo/bar')
+			connections.append((BlockingReader(), DummyWriter()))
+			return connections[-1]
+
+		def getOutput(i):
+			writer = connections[i][1]
+			obj, length = json.JSONDecoder().raw_decode(writer.buffer.decode('UTF-8'))
+			writer.buffer = b''
+			return obj['method'], obj['id']
+
+		self.rpc.startup()
+		with patch.object(asyncio, 'open_unix_connection', open_unix_connection):
+			await self.rpc.startupPool('foo/bar', 3)
+			self.assertEqual(len(connections), 2)
+			self.assertEqual(self.rpc.connectionPool[0], self.rpc)
+
+			#Round-robin over the pool, including the main connection:
+			for i in range(3):
+				self.rpc.sendStoredRequest('msg%d' % i, 'getroute', {})
+			self.assertEqual(getOutput(0), ('getroute', 0))
+			self.assertEqual(getOutput(1), ('getroute', 0))
+			self.checkJSONOutput({'jsonrpc': '2.0', 'id': 0, 'method': 'getroute', 'params': {}})
+
+			#Long poll calls each get their own connection:
+			self.rpc.sendStoredRequest('msg3', 'waitsendpay', {})
+			self.rpc.sendStoredRequest('msg4', 'waitsendpay', {})
+			await asyncio.sleep(0)
+			self.assertEqual(len(connections), 4)
+			self.assertEqual(getOutput(2), ('waitsendpay', 0))
+			self.assertEqual(getOutput(3), ('waitsendpay', 0))
+			self.assertEqual(self.rpc.longPollConnections[0].ongoingRequests, {0: ('waitsendpay', 'msg3')})
+
+			#Results go to the RPC interface:
+			handleStoredRequestResult = Mock()
+			with patch.object(self.rpc, 'handleStoredRequestResult', handleStoredRequestResult):
+				self.rpc.longPollConnections[0].handleResult(0, 'foo')
+			handleStoredRequestResult.assert_called_once_with('msg3', 'waitsendpay', 'foo')
+
+			#Idle connections are re-used:
+			self.rpc.sendStoredRequest('msg5', 'waitsendpay', {})
+			self.assertEqual(len(connections), 4)
+			self.assertEqual(getOutput(2), ('waitsendpay', 1))
+
+			await self.rpc.shutdown()
+			self.assertEqual([w.closed for r, w in connections], [True] * 4)
+			self.assertEqual(self.rpc.connectionPool, [self.rpc])
+			self.assertEqual(self.rpc.longPollConnections, [])
+
+
+	@asynciotest
+	async def test_longPollConnectionLimit(self):
+		class BlockingReader:
+			async def read(self, n):
+				await asyncio.Future() #never finishes
+
+		connections = []
+		async def open_unix_connection(path):
+			await asyncio.sleep(0.01) #opening a connection takes time
+			connections.append((BlockingReader(), DummyWriter()))
+			return connections[-1]
+
+		self.rpc.startup()
+		with patch.object(asyncio, 'open_unix_connection', open_unix_connection):
+			with patch.object(rpc_interface, 'MAX_LONG_POLL_CONNECTIONS', 3):
+				await self.rpc.startupPool('foo/bar', 1)
+
+				#A burst of long poll calls, before any connection is open:
+				for i in range(10):
+					self.rpc.sendStoredRequest('msg%d' % i, 'waitsendpay', {})
+				await asyncio.sleep(0.05)
+
+				self.assertEqual(len(connections), 3)
+				self.assertEqual(self.rpc.pendingLongPollConnections, 0)
+				self.assertEqual(len(self.rpc.longPollConnections), 3)
+
+				#The others were sent over the main connection:
+				self.assertEqual(len(self.rpc.ongoingRequests), 7)
+
+				await self.rpc.shutdown()
+
+
+	def test_metrics(self):
+		registry = metrics.Registry()
+		with patch.object(metrics, 'registry', registry):
+			with patch.object(self.rpc, 'handleStoredRequestResult') as handleStoredRequestResult:
+				with patch.object(self.rpc, 'handleStoredRequestError') as handleStoredRequestError:
+					self.rpc.sendStoredRequest('msg1', 'foo', {})
+					self.rpc.sendStoredRequest('msg2', 'bar', {})
+					self.assertEqual(set(self.rpc.requestStartTimes.keys()), {0, 1})
+
+					self.rpc.handleResult(0, {'x': 'y'})
+					self.rpc.handleError(1, 42, 'error')
+			handleStoredRequestResult.assert_called_once_with('msg1', 'foo', {'x': 'y'})
+			handleStoredRequestError.assert_called_once_with('msg2', 'bar', 42)
+			self.assertEqual(self.rpc.requestStartTimes, {})
+
+			msg = messages.LNPay(
+				localOrderID = 6,
+				destinationNodeID = 'Destination',
+				maxSenderCryptoAmount = 1248,
+				recipientCryptoAmount = 1234,
+				minCLTVExpiryDelta = 42,
+				fiatAmount = 0xdeadbeef,
+				offerID = 0x8008,
+				paymentHash = b'foo',
+				)
+			with patch.object(self.rpc.paymentPipeline, 'finish'):
+				self.rpc.finishPayment(msg, b'bar')
+				self.rpc.finishPayment(msg, None)
+				self.rpc.finishPayment(msg, None)
+
+		self.assertEqual(registry.histogram('rpc.foo').count, 1)
+		self.assertEqual(registry.histogram('rpc.bar').count, 1)
+		self.assertEqual(registry.getInfo()['counters'],
+			{
+			'rpc.bar.errors': 1,
+			'rpc.payments.succeeded': 1,
+			'rpc.payments.failed': 2,
+			})
+
+
 	def test_storedRequestResult_bug(self):
 		#This can only happen if there's a bug in the code.
 		with self.assertRaises(Exception):
@@ -28,6 +28,18 @@ class Foo(simplestruct.Struct):
 	baz = None
 
 
+class Empty(simplestruct.Struct):
+	pass
+
+
+class Derived(Foo):
+	qux = 0
+	bar = 1 #re-declared
+
+	def method(self):
+		return self.bar + self.qux
+
+
 
 class TestStruct(unittest.TestCase):
 	def test_construction(self):
@@ -45,6 +57,41 @@ class TestStruct(unittest.TestCase):
 			obj = Foo(baz=0)
 
 
+	def test_slots(self):
+		obj = Foo(bar=1, baz='z')
+		self.assertFalse(hasattr(obj, '__dict__'))
+		obj.bar = 2
+		self.assertEqual(obj.bar, 2)
+		with self.assertRaises(AttributeError):
+			obj.x = 0
+
+
+	def test_inheritance(self):
+		self.assertEqual(Derived._elementNames, ('bar', 'baz', 'qux'))
+		self.assertEqual(Derived.__slots__, ('qux',))
+		obj = Derived(bar=1, baz=2, qux=3)
+		self.assertEqual(obj.method(), 4)
+		self.assertFalse(hasattr(obj, '__dict__'))
+
+		with self.assertRaises(KeyError):
+			Derived(bar=1, baz=2)
+
+		self.assertNotEqual(obj, Foo(bar=1, baz=2))
+		self.assertNotEqual(Foo(bar=1, baz=2), obj)
+
+
+	def test_emptyStruct(self):
+		self.assertEqual(Empty(), Empty())
+		self.assertEqual(repr(Empty()), 'Empty()')
+		with self.assertRaises(KeyError):
+			Empty(x=0)
+
+
+	def test_repr(self):
+		self.assertEqual(repr(Foo(bar=1, baz='z')), "Foo(bar=1, baz='z')")
+		self.assertEqual(str(Foo(bar=1, baz='z')), "Foo(bar=1, baz='z')")
+
+
 	def test_str(self):
 		obj = Foo(bar='contents A', baz='contents B')
 		s = str(obj)
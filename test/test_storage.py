@@ -15,9 +15,15 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import os
+import sqlite3
 import sys
+import time
 import unittest
+from unittest.mock import patch, Mock
+
+from utils import asynciotest
 
 sys.path.append('..')
 
@@ -56,11 +62,147 @@ class TestStorage(unittest.TestCase):
 		self.assertEqual(tables['configuration'],    'CREATE TABLE `configuration` ( `name` TEXT, `value` TEXT)')
 		self.assertEqual(tables['buyOrders'],        'CREATE TABLE `buyOrders` ( `ID` INTEGER, `limitRate` INTEGER, `amount` INTEGER, `status` INTEGER, PRIMARY KEY(`ID`))')
 		self.assertEqual(tables['sellOrders'],       'CREATE TABLE `sellOrders` ( `ID` INTEGER, `limitRate` INTEGER, `amount` INTEGER, `status` INTEGER, PRIMARY KEY(`ID`))')
-		self.assertEqual(tables['counterOffers'],    'CREATE TABLE `counterOffers` ( `ID` INTEGER, `blob` BLOB, PRIMARY KEY(`ID`))')
+		self.assertEqual(tables['counterOffers'],    'CREATE TABLE `counterOffers` ( `ID` INTEGER, `blob` BLOB, `hash` BLOB, PRIMARY KEY(`ID`))')
 		self.assertEqual(tables['buyTransactions'],  'CREATE TABLE `buyTransactions` ( `ID` INTEGER, `buyOrder` INTEGER, `status` INTEGER, `fiatAmount` INTEGER, `cryptoAmount` INTEGER, `paymentHash` BLOB, `paymentPreimage` BLOB, PRIMARY KEY(`ID`), FOREIGN KEY(`buyOrder`) REFERENCES buyOrders(ID))')
 		self.assertEqual(tables['sellTransactions'], 'CREATE TABLE `sellTransactions` ( `ID` INTEGER, `sellOrder` INTEGER, `counterOffer` INTEGER, `status` INTEGER, `buyerFiatAmount` INTEGER, `sellerFiatAmount` INTEGER, `buyerCryptoAmount` INTEGER, `sellerCryptoAmount` INTEGER, `senderTimeoutDelta` INTEGER, `lockedTimeoutDelta` INTEGER, `CLTVExpiryDelta` INTEGER, `paymentHash` BLOB, `paymentPreimage` BLOB, PRIMARY KEY(`ID`), FOREIGN KEY(`sellOrder`) REFERENCES sellOrders(ID), FOREIGN KEY(`counterOffer`) REFERENCES counterOffers(ID))')
 
 
+	def test_migrate(self):
+		def getIndexes():
+			cursor = self.storage.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")
+			return set(x[0] for x in cursor)
+
+		def getQueryPlan(query):
+			cursor = self.storage.execute('EXPLAIN QUERY PLAN ' + query)
+			return ' '.join(x[-1] for x in cursor)
+
+		expectedIndexes = \
+		{
+		'buyTransactions_buyOrder_status',
+		'buyTransactions_paymentHash',
+		'sellTransactions_sellOrder_status',
+		}
+
+		#New database:
+		self.assertEqual(self.storage.getSchemaVersion(), len(storage.schemaMigrations))
+		self.assertTrue(expectedIndexes.issubset(getIndexes()))
+
+		self.assertIn('COVERING INDEX buyTransactions_buyOrder_status',
+			getQueryPlan('SELECT ID from buyTransactions WHERE buyOrder = 1 AND status != 4 AND status != 5'))
+		self.assertIn('COVERING INDEX buyTransactions_paymentHash',
+			getQueryPlan("SELECT ID from buyTransactions WHERE paymentHash = x'00'"))
+		self.assertIn('COVERING INDEX sellTransactions_sellOrder_status',
+			getQueryPlan('SELECT ID from sellTransactions WHERE sellOrder = 1 AND status != 4 AND status != 5'))
+
+		#Old database:
+		for index in expectedIndexes:
+			self.storage.execute('DROP INDEX `%s`' % index)
+		self.storage.execute('PRAGMA user_version = 0')
+		self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+		self.storage.shutdown()
+		self.storage = storage.Storage(self.filename)
+		self.assertEqual(self.storage.getSchemaVersion(), len(storage.schemaMigrations))
+		self.assertTrue(expectedIndexes.issubset(getIndexes()))
+		self.assertEqual(list(self.storage.execute('SELECT limitRate,amount FROM buyOrders')), [(1234, 1)])
+
+		#Database from newer software:
+		def setVersion(version):
+			connection = sqlite3.connect(self.filename)
+			connection.execute('PRAGMA user_version = %d' % version)
+			connection.close()
+		self.storage.shutdown()
+		setVersion(len(storage.schemaMigrations) + 1)
+		with self.assertRaises(Exception):
+			storage.Storage(self.filename)
+		setVersion(len(storage.schemaMigrations))
+		self.storage = storage.Storage(self.filename)
+
+
+	def test_dataMigration(self):
+		for i in range(25):
+			self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (?, 1)', [i])
+
+		batchSizes = []
+		def convertBatch(s, batchSize):
+			self.assertEqual(s.transactionDepth, 1)
+			batchSizes.append(batchSize)
+			return s.execute(
+				'UPDATE `buyOrders` SET `amount` = 2 WHERE `ID` IN '
+				'(SELECT `ID` FROM `buyOrders` WHERE `amount` = 1 LIMIT ?)',
+				[batchSize]).rowcount
+
+		migration = storage.DataMigration(convertBatch, batchSize=10)
+		with patch.object(self.storage, 'commit', Mock(wraps=self.storage.commit)) as commit:
+			migration.run(self.storage)
+		self.assertEqual(batchSizes, [10, 10, 10, 10])
+		self.assertEqual(commit.call_count, 4)
+		self.assertEqual(list(self.storage.execute('SELECT DISTINCT amount FROM buyOrders')), [(2,)])
+
+		#Resuming an interrupted migration:
+		migration = storage.DataMigration.fromQuery(
+			'UPDATE `buyOrders` SET `amount` = 3 WHERE `ID` IN '
+			'(SELECT `ID` FROM `buyOrders` WHERE `amount` = 2 LIMIT ?)',
+			batchSize=10)
+		originalConvertBatch = migration.convertBatch
+		def failingConvertBatch(s, batchSize):
+			if s.execute('SELECT COUNT(*) FROM buyOrders WHERE amount = 3').fetchone()[0] >= 10:
+				raise Exception('interrupted')
+			return originalConvertBatch(s, batchSize)
+		with patch.object(migration, 'convertBatch', failingConvertBatch):
+			with self.assertRaises(Exception):
+				migration.run(self.storage)
+		self.assertEqual(list(self.storage.execute('SELECT amount, COUNT(*) FROM buyOrders GROUP BY amount')), [(2, 15), (3, 10)])
+		migration.run(self.storage)
+		self.assertEqual(list(self.storage.execute('SELECT DISTINCT amount FROM buyOrders')), [(3,)])
+
+		#Data migrations as part of a schema migration:
+		self.storage.execute('PRAGMA user_version = 0')
+		migrations = \
+		[
+			[
+			'CREATE INDEX IF NOT EXISTS `foo` ON `buyOrders` (`amount`)',
+			storage.DataMigration.fromQuery(
+				'UPDATE `buyOrders` SET `amount` = 4 WHERE `ID` IN '
+				'(SELECT `ID` FROM `buyOrders` WHERE `amount` = 3 LIMIT ?)'),
+			],
+		]
+		with patch.object(storage, 'schemaMigrations', migrations):
+			self.storage.migrate()
+		self.assertEqual(self.storage.getSchemaVersion(), 1)
+		self.assertEqual(list(self.storage.execute('SELECT DISTINCT amount FROM buyOrders')), [(4,)])
+
+
+	def test_hashCounterOffers(self):
+		#Old database with duplicate counter offers:
+		self.storage.shutdown()
+		connection = sqlite3.connect(self.filename)
+		connection.execute('PRAGMA user_version = 1')
+		connection.execute('DROP INDEX `counterOffers_hash`')
+		connection.execute('ALTER TABLE `counterOffers` DROP COLUMN `hash`')
+		for ID, blob in [(1, b'foo'), (2, b'bar'), (3, b'foo'), (4, b'foo')]:
+			connection.execute('INSERT INTO `counterOffers` (`ID`, `blob`) VALUES (?, ?)', [ID, blob])
+		for ID, counterOffer in [(11, 3), (12, 2), (13, 1), (14, 4), (15, 3)]:
+			connection.execute('INSERT INTO `sellTransactions` (`ID`, `counterOffer`) VALUES (?, ?)', [ID, counterOffer])
+		connection.commit()
+		connection.close()
+
+		with patch.object(storage.schemaMigrations[1][-1], 'batchSize', 3):
+			self.storage = storage.Storage(self.filename)
+
+		self.assertEqual(self.storage.getSchemaVersion(), len(storage.schemaMigrations))
+		self.assertEqual(list(self.storage.execute('SELECT `ID`, `blob`, `hash` FROM `counterOffers` ORDER BY `ID`')),
+			[
+			(1, b'foo', storage.getContentHash(b'foo')),
+			(2, b'bar', storage.getContentHash(b'bar')),
+			])
+		self.assertEqual(list(self.storage.execute('SELECT `ID`, `counterOffer` FROM `sellTransactions` ORDER BY `ID`')),
+			[(11, 1), (12, 2), (13, 1), (14, 1), (15, 1)])
+
+		with self.assertRaises(sqlite3.IntegrityError):
+			self.storage.execute('INSERT INTO `counterOffers` (`blob`, `hash`) VALUES (?, ?)',
+				[b'foo', storage.getContentHash(b'foo')])
+
+
 	def test_persistency(self):
 		self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
 
@@ -111,6 +253,193 @@ class TestStorage(unittest.TestCase):
 		self.assertEqual(len(values), 0)
 
 
+	def test_loadStoredObjects(self):
+		ID1 = storage.StoredObject.createStoredObject(self.storage, 'buyOrders', limitRate=1234)
+		ID2 = storage.StoredObject.createStoredObject(self.storage, 'buyOrders', limitRate=2345)
+		storage.StoredObject.createStoredObject(self.storage, 'buyOrders', limitRate=3456)
+
+		rows = storage.StoredObject.loadStoredObjects(self.storage,
+			'SELECT * FROM buyOrders WHERE limitRate < ? ORDER BY ID', [3000])
+		self.assertEqual([row['ID'] for row in rows], [ID1, ID2])
+		self.assertEqual([row['limitRate'] for row in rows], [1234, 2345])
+
+		#Loading from the values doesn't need the database:
+		with patch.object(self.storage, 'execute', Mock(side_effect=Exception())):
+			so = storage.StoredObject(self.storage, 'buyOrders', ID2, rows[1])
+		self.assertEqual(so.ID, ID2)
+		self.assertEqual(so.limitRate, 2345)
+		self.assertEqual(so.amount, None)
+
+		rows = storage.StoredObject.loadStoredObjects(self.storage,
+			'SELECT * FROM buyOrders WHERE limitRate > ?', [4000])
+		self.assertEqual(rows, [])
+
+
+	def test_transaction(self):
+		with self.storage.transaction():
+			self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+			with self.storage.transaction():
+				self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1235, 2)')
+			#The inner block does not commit:
+			self.assertTrue(self.storage.connection.in_transaction)
+		self.assertFalse(self.storage.connection.in_transaction)
+
+		with self.assertRaises(ZeroDivisionError):
+			with self.storage.transaction():
+				self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1236, 3)')
+				1/0
+		self.assertEqual(self.storage.transactionDepth, 0)
+
+		self.storage.shutdown()
+		self.storage = storage.Storage(self.filename)
+
+		cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(1234, 1), (1235, 2)])
+
+
+	def test_WAL(self):
+		self.storage.shutdown()
+		self.storage = storage.Storage(self.filename, WAL=True)
+
+		cursor = self.storage.execute('PRAGMA journal_mode')
+		self.assertEqual(list(cursor), [('wal',)])
+
+		self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+		self.storage.shutdown()
+		self.storage = storage.Storage(self.filename)
+
+		cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(1234, 1)])
+
+
+
+class TestAsyncStorage(unittest.TestCase):
+	def setUp(self):
+		self.filename = '_test.db'
+		try:
+			os.remove(self.filename)
+		except FileNotFoundError:
+			pass
+		self.storage = storage.AsyncStorage(self.filename)
+
+
+	def tearDown(self):
+		self.storage.shutdown()
+		os.remove(self.filename)
+
+
+	@asynciotest
+	async def test_writes(self):
+		cursor = self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+		self.assertTrue(isinstance(cursor, storage.PendingCursor))
+		self.assertEqual(cursor.lastrowid, 1)
+
+		#Read-after-write sees the queued write:
+		cursor = self.storage.execute('UPDATE `buyOrders` SET `amount` = 2')
+		self.assertEqual(cursor.rowcount, 1)
+		cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(1234, 2)])
+
+		await self.storage.flush()
+		self.assertTrue(self.storage.lastWrite.done())
+
+		#After the flush, reads are served from the read connection:
+		cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+		self.assertFalse(isinstance(cursor, storage.PendingCursor))
+		self.assertEqual(list(cursor), [(1234, 2)])
+
+
+	@asynciotest
+	async def test_reads(self):
+		self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+		await self.storage.flush()
+		self.assertEqual(self.storage.unreportedCommits, [])
+
+		#Reads don't involve the writer thread:
+		for i in range(2):
+			cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+			self.assertFalse(isinstance(cursor, storage.PendingCursor))
+			self.assertEqual(list(cursor), [(1234, 1)])
+		for i in range(2):
+			cursor = self.storage.executeRead('SELECT limitRate,amount FROM buyOrders')
+			self.assertFalse(isinstance(cursor, storage.PendingCursor))
+		self.assertTrue(self.storage.lastWrite.done())
+		self.assertEqual(self.storage.unreportedCommits, [])
+
+
+	@asynciotest
+	async def test_storedObject(self):
+		ID = storage.StoredObject.createStoredObject(self.storage, 'buyOrders', limitRate=1234)
+		so = storage.StoredObject(self.storage, 'buyOrders', ID)
+		self.assertEqual(so.limitRate, 1234)
+		so.update(limitRate=2000, amount=6)
+		await self.storage.flush()
+
+		cursor = self.storage.execute('SELECT ID,limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(ID, 2000, 6)])
+
+
+	@asynciotest
+	async def test_allocateID(self):
+		self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+
+		#The first allocation continues after the existing rows:
+		self.assertEqual(self.storage.allocateID('buyOrders'), 2)
+		self.assertEqual(self.storage.allocateID('buyOrders'), 3)
+		self.assertEqual(self.storage.allocateID('sellOrders'), 1)
+
+		#Creating an object doesn't wait for the writer thread:
+		self.storage.submit(lambda connection: time.sleep(0.1))
+		values = storage.StoredObject.insertStoredObject(self.storage, 'buyOrders', limitRate=1235, amount=2)
+		self.assertEqual(values, {'ID': 4, 'limitRate': 1235, 'amount': 2})
+		self.assertFalse(self.storage.lastWrite.done())
+
+		await self.storage.flush()
+		cursor = self.storage.execute('SELECT ID,limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(1, 1234, 1), (4, 1235, 2)])
+
+
+	@asynciotest
+	async def test_transaction(self):
+		with self.storage.transaction():
+			self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1234, 1)')
+			self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1235, 2)')
+		await self.storage.flush()
+
+		with self.assertRaises(ZeroDivisionError):
+			with self.storage.transaction():
+				self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1236, 3)')
+				1/0
+		await self.storage.flush()
+
+		#A failing statement makes the whole transaction roll back,
+		#and flush reports it:
+		with self.storage.transaction():
+			self.storage.execute('INSERT INTO `buyOrders` (`limitRate`, `amount`) VALUES (1237, 4)')
+			self.storage.execute('INSERT INTO `nonExistingTable` (`foo`) VALUES (1)')
+		with self.assertRaises(Exception) as cm:
+			await self.storage.flush()
+		self.assertTrue(isinstance(cm.exception.__cause__, sqlite3.OperationalError))
+
+		#It is only reported once:
+		await self.storage.flush()
+
+		cursor = self.storage.execute('SELECT limitRate,amount FROM buyOrders')
+		self.assertEqual(list(cursor), [(1234, 1), (1235, 2)])
+
+		#A failure is reported to the task that did the transaction:
+		async def failingTransaction():
+			with self.storage.transaction():
+				self.storage.execute('INSERT INTO `nonExistingTable` (`foo`) VALUES (1)')
+			await asyncio.sleep(0.1)
+			await self.storage.flush()
+		task = asyncio.ensure_future(failingTransaction())
+		await asyncio.sleep(0)
+		await self.storage.flush()
+		with self.assertRaises(Exception):
+			await task
+
+
 
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
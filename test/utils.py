@@ -16,6 +16,12 @@
 #    along with BL4P Client. If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+from contextlib import contextmanager
+import sys
+
+sys.path.append('..')
+
+from bl4p_api import offer
 
 
 #Transaction states:
@@ -37,15 +43,31 @@ def asynciotest(oldMethod):
 
 
 
+def makeOffer(bid, ask, ID, bidCurrency='eur', askCurrency='btc', **kwargs):
+	exchange = lambda currency: 'ln' if currency == 'btc' else 'bl3p.eu'
+	return offer.Offer(
+		bid=offer.Asset(max_amount=bid, max_amount_divisor=100, currency=bidCurrency, exchange=exchange(bidCurrency)),
+		ask=offer.Asset(max_amount=ask, max_amount_divisor=10, currency=askCurrency, exchange=exchange(askCurrency)),
+		address='foo', ID=ID,
+		**kwargs
+		)
+
+
+
 class DummyWriter:
 	def __init__(self):
 		self.buffer = b''
+		self.closed = False
 
 
 	def write(self, data):
 		self.buffer += data
 
 
+	def close(self):
+		self.closed = True
+
+
 
 class DummyReader:
 	def __init__(self):
@@ -66,7 +88,7 @@ class MockCursor(list):
 			setattr(self, k, v)
 
 	def fetchone(self):
-		return self.pop(0)
+		return self.pop(0) if self else None
 
 
 
@@ -74,6 +96,7 @@ class MockStorage:
 	def __init__(self, DBFile = None, test = None, init = lambda x: None, startCount = 61):
 		self.test = test
 		self.DBFile = DBFile
+		self.transactionDepth = 0
 		self.reset(startCount)
 		init(self)
 
@@ -81,6 +104,7 @@ class MockStorage:
 	def reset(self, startCount):
 		self.buyOrders = {}
 		self.buyTransactions = {}
+		self.archivedBuyTransactions = {}
 		self.sellOrders = {}
 		self.sellTransactions = {}
 		self.counterOffers = {}
@@ -88,6 +112,64 @@ class MockStorage:
 		self.counter = startCount
 
 
+	@contextmanager
+	def transaction(self):
+		self.transactionDepth += 1
+		try:
+			yield
+		finally:
+			self.transactionDepth -= 1
+
+
+	async def flush(self):
+		pass
+
+
+	def allocateID(self, tableName):
+		return None
+
+
+	def executeRead(self, query, data=[]):
+		return self.execute(query, data)
+
+
+	@staticmethod
+	def makeCursor(rows):
+		if not rows:
+			return MockCursor([], description=[])
+		keys = list(rows[0].keys())
+		values = [[row[k] for k in keys] for row in rows]
+		return MockCursor(values, description=[(k,) for k in keys])
+
+
+	def getUnfinishedBuyOrders(self):
+		return [o for o in self.buyOrders.values() if o.get('status', 0) in [0, 2]]
+
+
+	def getUnfinishedSellOrders(self):
+		return [o for o in self.sellOrders.values() if o.get('status', 0) in [0, 2]]
+
+
+	def getUnfinishedBuyTransactions(self):
+		orderIDs = [o['ID'] for o in self.getUnfinishedBuyOrders()]
+		return \
+		[
+		tx
+		for tx in self.buyTransactions.values()
+		if tx['buyOrder'] in orderIDs and tx['status'] not in [STATUS_FINISHED, STATUS_CANCELED]
+		]
+
+
+	def getUnfinishedSellTransactions(self):
+		orderIDs = [o['ID'] for o in self.getUnfinishedSellOrders()]
+		return \
+		[
+		tx
+		for tx in self.sellTransactions.values()
+		if tx['sellOrder'] in orderIDs and tx['status'] not in [STATUS_FINISHED, STATUS_CANCELED]
+		]
+
+
 	def execute(self, query, data=[]):
 		if query.startswith('INSERT INTO buyTransactions'):
 			names = query[query.index('(')+1:query.index(')')]
@@ -124,14 +206,11 @@ class MockStorage:
 			if tx['buyOrder'] == data[0] and tx['status'] not in [STATUS_FINISHED, STATUS_CANCELED]
 			]
 			return MockCursor(values)
-		elif query == 'SELECT ID from buyTransactions WHERE paymentHash = ?':
-			values = \
-			[
-			[tx['ID']]
-			for tx in self.buyTransactions.values()
-			if tx['paymentHash'] == data[0]
-			]
-			return MockCursor(values)
+		elif query == 'SELECT * from buyTransactions WHERE paymentHash = ? UNION ALL SELECT * from archivedBuyTransactions WHERE paymentHash = ?':
+			return self.makeCursor(
+				[tx for tx in self.buyTransactions.values() if tx['paymentHash'] == data[0]] + \
+				[tx for tx in self.archivedBuyTransactions.values() if tx['paymentHash'] == data[1]]
+				)
 
 		elif query.startswith('INSERT INTO buyOrders'):
 			names = query[query.index('(')+1:query.index(')')]
@@ -154,9 +233,12 @@ class MockStorage:
 			for i in range(len(names)):
 				self.buyOrders[ID][names[i]] = data[i]
 			return MockCursor([])
-		elif query == 'SELECT `ID` FROM `buyOrders` WHERE `status` = 0 OR `status` = 2':
+		elif query == 'SELECT * FROM `buyOrders` WHERE (`buyOrders`.`status` = 0 OR `buyOrders`.`status` = 2)':
+			self.test.assertEqual(data, [])
+			return self.makeCursor(self.getUnfinishedBuyOrders())
+		elif query == 'SELECT `buyTransactions`.* FROM `buyTransactions` JOIN `buyOrders` ON `buyTransactions`.`buyOrder` = `buyOrders`.`ID` WHERE (`buyOrders`.`status` = 0 OR `buyOrders`.`status` = 2) AND `buyTransactions`.`status` != 4 AND `buyTransactions`.`status` != 5':
 			self.test.assertEqual(data, [])
-			return [[x] for x in self.buyOrders.keys()]
+			return self.makeCursor(self.getUnfinishedBuyTransactions())
 		elif query == 'SELECT * from buyOrders WHERE `ID` = ?':
 			data = self.buyOrders[data[0]]
 			keys = list(data.keys())
@@ -220,23 +302,39 @@ class MockStorage:
 			for i in range(len(names)):
 				self.sellOrders[ID][names[i]] = data[i]
 			return MockCursor([])
-		elif query == 'SELECT `ID` FROM `sellOrders` WHERE `status` = 0 OR `status` = 2':
+		elif query == 'SELECT * FROM `sellOrders` WHERE (`sellOrders`.`status` = 0 OR `sellOrders`.`status` = 2)':
+			self.test.assertEqual(data, [])
+			return self.makeCursor(self.getUnfinishedSellOrders())
+		elif query == 'SELECT `sellTransactions`.* FROM `sellTransactions` JOIN `sellOrders` ON `sellTransactions`.`sellOrder` = `sellOrders`.`ID` WHERE (`sellOrders`.`status` = 0 OR `sellOrders`.`status` = 2) AND `sellTransactions`.`status` != 4 AND `sellTransactions`.`status` != 5':
+			self.test.assertEqual(data, [])
+			return self.makeCursor(self.getUnfinishedSellTransactions())
+		elif query == 'SELECT DISTINCT `counterOffers`.* FROM `counterOffers` JOIN `sellTransactions` ON `sellTransactions`.`counterOffer` = `counterOffers`.`ID` JOIN `sellOrders` ON `sellTransactions`.`sellOrder` = `sellOrders`.`ID` WHERE (`sellOrders`.`status` = 0 OR `sellOrders`.`status` = 2) AND `sellTransactions`.`status` != 4 AND `sellTransactions`.`status` != 5':
 			self.test.assertEqual(data, [])
-			return [[x] for x in self.sellOrders.keys()]
+			IDs = set(tx['counterOffer'] for tx in self.getUnfinishedSellTransactions())
+			return self.makeCursor([self.counterOffers[ID] for ID in sorted(IDs)])
 		elif query == 'SELECT * from sellOrders WHERE `ID` = ?':
 			data = self.sellOrders[data[0]]
 			keys = list(data.keys())
 			values = [data[k] for k in keys]
 			return MockCursor([values], description=[(k,) for k in keys])
 
-		elif query == 'INSERT INTO counterOffers (`blob`) VALUES (?)':
+		elif query == 'INSERT INTO counterOffers (`blob`,`hash`) VALUES (?,?)':
 			self.counterOffers[self.counter] = \
 			{
 			'ID': self.counter,
 			'blob': data[0],
+			'hash': data[1],
 			}
 			self.counter += 1
 			return MockCursor([], lastrowid=self.counter-1)
+		elif query == 'SELECT `ID` FROM `counterOffers` WHERE `hash` = ?':
+			values = \
+			[
+			[co['ID']]
+			for co in self.counterOffers.values()
+			if co.get('hash') == data[0]
+			]
+			return MockCursor(values)
 		elif query == 'SELECT * from counterOffers WHERE `ID` = ?':
 			data = self.counterOffers[data[0]]
 			keys = list(data.keys())